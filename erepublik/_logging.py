@@ -1,13 +1,19 @@
 import base64
+import copy
 import datetime
-import inspect
+import gzip
 import logging
 import os
+import queue
 import sys
+import threading
+import time
+import traceback
 import weakref
 from logging import LogRecord, handlers
 from pathlib import Path
-from typing import Any, Dict, Union
+from types import FrameType, TracebackType
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import requests
 
@@ -31,16 +37,36 @@ class ErepublikFileHandler(handlers.TimedRotatingFileHandler):
         self._file_path.parent.mkdir(parents=True, exist_ok=True)
         super().doRollover()
 
-    def emit(self, record: LogRecord) -> None:
-        self._file_path.parent.mkdir(parents=True, exist_ok=True)
-        super().emit(record)
-
 
 class ErepublikLogConsoleHandler(logging.StreamHandler):
     def __init__(self, *_):
         super().__init__(sys.stdout)
 
 
+class ErepublikQueueHandler(handlers.QueueHandler):
+    """Queues records for `QueueListener` without applying handlers' formatters on the caller's thread. Like
+    `QueueHandler`, traceback and stack are appended to the message, as they can't be pickled or formatted later.
+    """
+
+    _formatter = logging.Formatter()
+
+    def prepare(self, record: LogRecord) -> LogRecord:
+        record = copy.copy(record)
+        msg = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self._formatter.formatException(record.exc_info)
+        if record.exc_text:
+            msg = f"{msg}\n{record.exc_text}"
+        if record.stack_info:
+            msg = f"{msg}\n{self._formatter.formatStack(record.stack_info)}"
+        record.message = record.msg = msg
+        record.args = None
+        record.exc_info = None
+        record.exc_text = None
+        record.stack_info = None
+        return record
+
+
 class ErepublikFormatter(logging.Formatter):
     """override logging.Formatter to use an aware datetime object"""
 
@@ -48,6 +74,15 @@ class ErepublikFormatter(logging.Formatter):
     info_fmt = "[%(asctime)s] %(msg)s"
     default_fmt = "[%(asctime)s] %(levelname)s: %(msg)s"
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._level_styles = {
+            logging.DEBUG: logging.PercentStyle(self.dbg_fmt),
+            logging.INFO: logging.PercentStyle(self.info_fmt),
+        }
+        self._style = logging.PercentStyle(self.default_fmt)
+        self._fmt = self.default_fmt
+
     def converter(self, timestamp: Union[int, float]) -> datetime.datetime:
         return datetime.datetime.fromtimestamp(timestamp).astimezone(erep_tz)
 
@@ -64,18 +99,12 @@ class ErepublikFormatter(logging.Formatter):
         called to format the event time. If there is exception information,
         it is formatted using formatException() and appended to the message.
         """
-        if record.levelno == logging.DEBUG:
-            self._fmt = self.dbg_fmt
-        elif record.levelno == logging.INFO:
-            self._fmt = self.info_fmt
-        else:
-            self._fmt = self.default_fmt
-        self._style = logging.PercentStyle(self._fmt)
+        style = self._level_styles.get(record.levelno, self._style)
 
         record.message = record.getMessage()
-        if self.usesTime():
+        if style.usesTime():
             record.asctime = self.formatTime(record, self.datefmt)
-        s = self.formatMessage(record)
+        s = style.format(record)
         if record.exc_info:
             # Cache the traceback text to avoid converting it multiple times
             # (it's constant anyway)
@@ -91,11 +120,23 @@ class ErepublikFormatter(logging.Formatter):
             s = dt.strftime("%Y-%m-%d %H:%M:%S")
         return s
 
-    def usesTime(self):
-        return self._style.usesTime()
-
 
 class ErepublikErrorHTTTPHandler(handlers.HTTPHandler):
+    """Uploads errors in background thread
+
+    Context which can change (last response, locals) is captured in `emit`, everything else - citizen's instance json,
+    log tails, compression and upload - is done by the upload thread. Errors of the same type raised at the same
+    place are uploaded once per `dedup_window` seconds, the number of skipped repeats is sent with the next upload.
+    """
+
+    max_queue: int = 20
+    dedup_window: int = 600
+    max_attachment_size: int = 1024 * 1024
+    log_tail_size: int = 256 * 1024
+    _queue: "queue.Queue[Optional[Dict[str, Any]]]"
+    _thread: Optional[threading.Thread]
+    _seen: Dict[Tuple[str, str], Tuple[float, int]]
+
     def __init__(self, reporter: Reporter):
         logging.Handler.__init__(self, level=logging.ERROR)
         self._reporter = weakref.ref(reporter)
@@ -105,12 +146,16 @@ class ErepublikErrorHTTTPHandler(handlers.HTTPHandler):
         self.secure = True
         self.credentials = (str(reporter.citizen_id), reporter.key)
         self.context = None
+        self._queue = queue.Queue(self.max_queue)
+        self._thread = None
+        self._seen = {}
+        self.dropped = 0
 
     @property
     def reporter(self):
         return self._reporter()
 
-    def _get_last_response(self) -> Dict[str, str]:
+    def _get_last_response(self) -> Dict[str, Any]:
         response = self.reporter.citizen.r
         url = response.url
         last_index = url.index("?") if "?" in url else len(response.url)
@@ -138,27 +183,44 @@ class ErepublikErrorHTTTPHandler(handlers.HTTPHandler):
             mimetype="application/json" if ext == "json" else "text/html",
         )
 
-    def _get_local_vars(self) -> str:
-        trace = inspect.trace()
-        local_vars = {}
-        if trace:
-            local_vars = trace[-1][0].f_locals
-            if local_vars.get("__name__") == "__main__":
-                local_vars.update(
-                    commit_id=local_vars.get("COMMIT_ID"),
-                    interactive=local_vars.get("INTERACTIVE"),
-                    version=local_vars.get("__version__"),
-                    config=local_vars.get("CONFIG"),
-                )
-        else:
-            stack = inspect.stack()
-            report_error_caller_found = False
-            for frame in stack:
-                if report_error_caller_found:
-                    local_vars = frame.frame.f_locals
-                    break
-                if "report_error" in str(frame.frame):
-                    report_error_caller_found = True
+    @staticmethod
+    def _last_traceback(record: logging.LogRecord) -> Optional[TracebackType]:
+        tb = record.exc_info[2] if record.exc_info else None
+        while tb is not None and tb.tb_next is not None:
+            tb = tb.tb_next
+        return tb
+
+    @classmethod
+    def _error_frame(cls, record: logging.LogRecord) -> Optional[FrameType]:
+        """Frame where the exception was raised or the frame which called `report_error`"""
+        tb = cls._last_traceback(record)
+        if tb is not None:
+            return tb.tb_frame
+        frame = sys._getframe()
+        while frame is not None:
+            if frame.f_code.co_name == "report_error":
+                return frame.f_back
+            frame = frame.f_back
+        return None
+
+    @classmethod
+    def _error_key(cls, record: logging.LogRecord) -> Tuple[str, str]:
+        """Exception type and the place where it was raised"""
+        tb = cls._last_traceback(record)
+        if tb is not None:
+            return record.exc_info[0].__name__, f"{tb.tb_frame.f_code.co_filename}:{tb.tb_lineno}"
+        return str(record.msg), f"{record.pathname}:{record.lineno}"
+
+    def _get_local_vars(self, record: logging.LogRecord) -> str:
+        frame = self._error_frame(record)
+        local_vars = dict(frame.f_locals) if frame is not None else {}
+        if local_vars.get("__name__") == "__main__":
+            local_vars.update(
+                commit_id=local_vars.get("COMMIT_ID"),
+                interactive=local_vars.get("INTERACTIVE"),
+                version=local_vars.get("__version__"),
+                config=local_vars.get("CONFIG"),
+            )
 
         if "state_thread" in local_vars:
             local_vars.pop("state_thread", None)
@@ -177,38 +239,130 @@ class ErepublikErrorHTTTPHandler(handlers.HTTPHandler):
             return self.reporter.citizen.to_json(False)
         return ""
 
-    def mapLogRecord(self, record: logging.LogRecord) -> Dict[str, Any]:
-        data = super().mapLogRecord(record)
+    def _get_log_tails(self) -> List[Tuple[str, bytes]]:
+        log_dir = Path("log")
+        if not log_dir.is_dir():
+            return []
+        tails = []
+        for log_file in sorted(log_dir.glob("*.log")):
+            try:
+                with log_file.open("rb") as f:
+                    f.seek(0, os.SEEK_END)
+                    f.seek(max(0, f.tell() - self.log_tail_size))
+                    tails.append((log_file.name, f.read()))
+            except OSError as e:
+                self._write_fallback(f"Unable to attach {log_file.name} to error report: {e!r}")
+        return tails
+
+    @staticmethod
+    def _write_fallback(msg: str):
+        """Problems of error reporting itself go to stderr - logging them would report them again"""
+        if logging.lastResort is not None:
+            record = logging.makeLogRecord(dict(name=__name__, levelno=logging.WARNING, levelname="WARNING", msg=msg))
+            logging.lastResort.handle(record)
+
+    def _attachment(self, name: str, content: Union[str, bytes], keep_tail: bool = False) -> Tuple[str, Tuple]:
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        if len(content) > self.max_attachment_size:
+            limit = self.max_attachment_size
+            content = content[-limit:] if keep_tail else content[:limit]
+        return "file", (f"{name}.gz", gzip.compress(content), "application/gzip")
 
-        # Log last response
-        resp = self._get_last_response()
-        files = [
-            ("file", (resp.get("name"), resp.get("content"), resp.get("mimetype"))),
-        ]
+    def mapLogRecord(self, record: logging.LogRecord) -> Dict[str, Any]:
+        data = {k: v for k, v in super().mapLogRecord(record).items() if k not in ["args", "exc_info"]}
+        data.update(msg=record.getMessage())
+        if record.exc_info and record.exc_info[0] is not None:
+            data.update(exc_info=record.exc_text or "".join(traceback.format_exception(*record.exc_info)))
 
-        files += list(("file", (f, open(f"log/{f}", "rb"))) for f in os.listdir("log") if f.endswith(".log"))
-        local_vars_json = self._get_local_vars()
+        files = []
+        try:
+            resp = self._get_last_response()
+            files.append(self._attachment(resp["name"], resp["content"]))
+        except Exception:  # noqa
+            pass
+        local_vars_json = self._get_local_vars(record)
         if local_vars_json:
-            files.append(("file", ("local_vars.json", local_vars_json, "application/json")))
-        instance_json = self._get_instance_json()
-        if instance_json:
-            files.append(("file", ("instance.json", instance_json, "application/json")))
+            files.append(self._attachment("local_vars.json", local_vars_json))
         data.update(files=files)
         return data
 
+    def _start_uploader(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run_uploader, name="error_uploader", daemon=True)
+            self._thread.start()
+
+    def _run_uploader(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                return
+            self._upload(data)
+
+    def _upload(self, data: Dict[str, Any]):
+        """Upload report with whatever attachments could be collected, failed steps are written to stderr"""
+        files = data.pop("files")
+        try:
+            instance_json = self._get_instance_json()
+            if instance_json:
+                files.append(self._attachment("instance.json", instance_json))
+        except Exception as e:  # noqa
+            self._write_fallback(f"Unable to attach instance.json to error report: {e!r}")
+        for name, content in self._get_log_tails():
+            files.append(self._attachment(name, content, keep_tail=True))
+
+        proto = "https" if self.secure else "http"
+        u, p = self.credentials
+        s = "Basic " + base64.b64encode(f"{u}:{p}".encode("utf-8")).strip().decode("ascii")
+        headers = {"Authorization": s}
+        try:
+            requests.post(f"{proto}://{self.host}{self.url}", headers=headers, data=data, files=files, timeout=60)
+        except Exception as e:  # noqa
+            self._write_fallback(f"Unable to upload error report '{data.get('msg')}': {e!r}")
+
+    def _is_duplicate(self, record: logging.LogRecord) -> Tuple[bool, int]:
+        """Check if error was uploaded within `dedup_window`
+
+        :return: Duplicate flag and the number of skipped repeats
+        """
+        key = self._error_key(record)
+        now = time.monotonic()
+        first_seen, repeated = self._seen.get(key, (0.0, 0))
+        if now - first_seen < self.dedup_window:
+            self._seen[key] = (first_seen, repeated + 1)
+            return True, repeated + 1
+        self._seen[key] = (now, 0)
+        for old_key, (seen_at, _) in list(self._seen.items()):
+            if now - seen_at >= self.dedup_window:
+                del self._seen[old_key]
+        return False, repeated
+
     def emit(self, record):
         """
         Emit a record.
 
-        Send the record to the Web server as a percent-encoded dictionary
+        Capture the error context and queue it for the upload thread
         """
         try:
-            proto = "https" if self.secure else "http"
-            u, p = self.credentials
-            s = "Basic " + base64.b64encode(f"{u}:{p}".encode("utf-8")).strip().decode("ascii")
-            headers = {"Authorization": s}
+            duplicate, repeated = self._is_duplicate(record)
+            if duplicate:
+                return
             data = self.mapLogRecord(record)
-            files = data.pop("files") if "files" in data else None
-            requests.post(f"{proto}://{self.host}{self.url}", headers=headers, data=data, files=files)
+            data.update(repeated=repeated)
+            try:
+                self._queue.put_nowait(data)
+            except queue.Full:
+                self.dropped += 1
+                return
+            self._start_uploader()
         except Exception:
             self.handleError(record)
+
+    def close(self):
+        if self._thread is not None and self._thread.is_alive():
+            try:
+                self._queue.put(None, timeout=5)
+            except queue.Full:
+                pass
+            self._thread.join(30)
+        super().close()
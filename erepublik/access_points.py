@@ -1,25 +1,101 @@
 import datetime
 import hashlib
 import random
+import threading
 import time
-from typing import Any, Dict, List, Mapping, Union
+from typing import Any, Dict, List, Mapping, Optional, Union
 
 from requests import Response, Session
 from requests.exceptions import ConnectionError
 from requests_toolbelt.utils import dump
 
-from erepublik import constants, utils
+from erepublik import constants, tracing, utils
+from erepublik.metrics import REGISTRY, MetricsRegistry, endpoint_name
 
-__all__ = ["SlowRequests", "CitizenAPI"]
+__all__ = ["RateController", "SlowRequests", "CitizenAPI"]
+
+
+class RateController:
+    """AIMD controller of the interval between requests
+
+    Every successful request shortens the interval by `step` seconds (additive increase of the rate), throttling,
+    server errors and CloudFlare blocks multiply it by `backoff` (multiplicative decrease). Controller with a
+    `parent` (eg. process wide controller shared by all sessions from the same IP) reports feedback to the parent too
+    and never goes faster than the parent allows.
+    """
+
+    min_interval: float
+    max_interval: float
+    step: float
+    backoff: float
+    parent: Optional["RateController"]
+    successes: int
+    slowdowns: int
+
+    def __init__(
+        self,
+        interval: float = 0.5,
+        min_interval: float = 0.25,
+        max_interval: float = 30.0,
+        step: float = 0.01,
+        backoff: float = 2.0,
+        parent: "RateController" = None,
+    ):
+        self._interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.step = step
+        self.backoff = backoff
+        self.parent = parent
+        self.successes = self.slowdowns = 0
+        self._lock = threading.Lock()
+
+    @property
+    def interval(self) -> float:
+        if self.parent is None:
+            return self._interval
+        return max(self._interval, self.parent.interval)
+
+    @interval.setter
+    def interval(self, value: float):
+        with self._lock:
+            self._interval = min(max(value, self.min_interval), self.max_interval)
+
+    def success(self):
+        with self._lock:
+            self.successes += 1
+            self._interval = max(self._interval - self.step, self.min_interval)
+        if self.parent is not None:
+            self.parent.success()
+
+    def slow_down(self):
+        with self._lock:
+            self.slowdowns += 1
+            self._interval = min(self._interval * self.backoff, self.max_interval)
+        if self.parent is not None:
+            self.parent.slow_down()
+
+    @property
+    def as_dict(self) -> Dict[str, Union[float, int]]:
+        return dict(interval=self.interval, successes=self.successes, slowdowns=self.slowdowns)
+
+
+#: Process wide rate controller, parent of every session's controller
+GLOBAL_RATE = RateController()
 
 
 class SlowRequests(Session):
     last_time: datetime.datetime
-    timeout: datetime.timedelta = datetime.timedelta(milliseconds=500)
+    rate: RateController
     debug: bool = False
+    throttle = None  # Shared throttle with `wait(seconds)` method, eg. `fleet.SharedThrottle`
+    metrics: MetricsRegistry = REGISTRY
 
     def __init__(self, proxies: Dict[str, str] = None, user_agent: str = None):
         super().__init__()
+        self.rate = RateController(parent=GLOBAL_RATE)
+        self._throttle_lock = threading.Lock()
+        self._next_request = 0.0
         if proxies:
             self.proxies = proxies
         if user_agent is None:
@@ -34,6 +110,7 @@ class SlowRequests(Session):
         return dict(
             last_time=self.last_time,
             timeout=self.timeout,
+            rate=self.rate.as_dict,
             cookies=self.cookies.get_dict(),
             debug=self.debug,
             user_agent=self.headers["User-Agent"],
@@ -42,22 +119,72 @@ class SlowRequests(Session):
         )
 
     def request(self, method, url, *args, **kwargs):
-        self._slow_down_requests()
-        self._log_request(url, method, **kwargs)
-        try:
-            resp = super().request(method, url, *args, **kwargs)
-        except ConnectionError:
-            time.sleep(1)
-            return self.request(method, url, *args, **kwargs)
-        # self._log_response(resp)
-        return resp
+        with tracing.span(f"{method} {endpoint_name(url)}", url=url, method=method) as span:
+            with tracing.span("throttle"):
+                self._slow_down_requests()
+            self._log_request(url, method, **kwargs)
+            endpoint = endpoint_name(url)
+            start = time.monotonic()
+            try:
+                resp = super().request(method, url, *args, **kwargs)
+            except ConnectionError:
+                self.metrics.inc("erepublik_requests_total", endpoint=endpoint, method=method, status="error")
+                self.metrics.inc("erepublik_request_retries_total", endpoint=endpoint, reason="connection")
+                self.rate.slow_down()
+                time.sleep(1)
+                return self.request(method, url, *args, **kwargs)
+            self._record_metrics(endpoint, method, resp, time.monotonic() - start)
+            if span is not None:
+                span.attributes.update(status=resp.status_code, bytes=len(resp.content or b""))
+            # self._log_response(resp)
+            if self._is_throttled(resp):
+                self.rate.slow_down()
+            else:
+                self.rate.success()
+            return resp
+
+    def _record_metrics(self, endpoint: str, method: str, resp: Response, seconds: float):
+        status = f"{resp.status_code // 100}xx"
+        self.metrics.inc("erepublik_requests_total", endpoint=endpoint, method=method, status=status)
+        self.metrics.observe("erepublik_request_seconds", seconds, endpoint=endpoint, method=method)
+        body = resp.request.body if resp.request is not None else None
+        if body:
+            self.metrics.inc("erepublik_request_bytes_total", len(body), endpoint=endpoint, direction="out")
+        self.metrics.inc("erepublik_request_bytes_total", len(resp.content or b""), endpoint=endpoint, direction="in")
+
+    @property
+    def timeout(self) -> datetime.timedelta:
+        """Current interval between requests, set by `rate` controller"""
+        return datetime.timedelta(seconds=self.rate.interval)
+
+    @timeout.setter
+    def timeout(self, value: datetime.timedelta):
+        self.rate.interval = value.total_seconds()
+
+    @staticmethod
+    def _is_throttled(response: Response) -> bool:
+        if response.status_code == 429 or response.status_code >= 500:
+            return True
+        if response.status_code >= 400:
+            return "<title>Attention Required! | Cloudflare</title>" in response.text
+        if "json" in response.headers.get("Content-Type", ""):
+            return '"Too many requests"' in response.text
+        return False
 
     def _slow_down_requests(self):
-        ltt = utils.good_timedelta(self.last_time, self.timeout)
-        if ltt > utils.now():
-            seconds = (ltt - utils.now()).total_seconds()
-            time.sleep(seconds if seconds > 0 else 0)
-        self.last_time = utils.now()
+        # Requests from concurrent threads still start at least `timeout` apart
+        start = time.monotonic()
+        with self._throttle_lock:
+            interval = self.rate.interval
+            if self.throttle is not None:
+                self.throttle.wait(interval)
+            else:
+                now = time.monotonic()
+                if self._next_request > now:
+                    time.sleep(self._next_request - now)
+                self._next_request = time.monotonic() + interval
+            self.last_time = utils.now()
+        self.metrics.inc("erepublik_throttle_seconds_total", time.monotonic() - start)
 
     def _log_request(self, url, method, data=None, json=None, params=None, **kwargs):
         if self.debug:
@@ -1,24 +1,33 @@
+import atexit
+import contextvars
 import logging
+import os
+import queue
 import re
+import threading
 import warnings
-import weakref
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, time, timedelta
 from decimal import Decimal
 from itertools import product
+from logging.handlers import QueueListener
 from threading import Event
 from time import sleep
-from typing import Any, Dict, List, NoReturn, Optional, Set, Tuple, TypedDict, Union
+from typing import Any, Callable, Dict, Generator, Iterable, List, NoReturn, Optional, Set, Tuple, TypedDict, Union
 
 from requests import RequestException, Response
 
 from erepublik import _types as types
-from erepublik import access_points, classes, constants, utils
+from erepublik import access_points, classes, constants, events, metrics, tracing, utils
 from erepublik._logging import (
     ErepublikErrorHTTTPHandler,
     ErepublikFileHandler,
     ErepublikFormatter,
     ErepublikLogConsoleHandler,
+    ErepublikQueueHandler,
 )
+from erepublik.profiler import SamplingProfiler
 
 
 class BaseCitizen(access_points.CitizenAPI):
@@ -46,6 +55,7 @@ class BaseCitizen(access_points.CitizenAPI):
     details: classes.Details = None
     politics: classes.Politics = None
     my_companies: classes.MyCompanies = None
+    market_stats: classes.MarketPriceStats = None
     reporter: classes.Reporter = None
     stop_threads: Event = None
     telegram: classes.TelegramReporter = None
@@ -56,20 +66,35 @@ class BaseCitizen(access_points.CitizenAPI):
     name: str = "Not logged in!"
     logged_in: bool = False
     restricted_ip: bool = False
+    _refresh_workers: int = 4
+    _events_flush_timeout: float = 10
+    _log_listener: Optional[QueueListener] = None
+    _profiler: Optional[SamplingProfiler] = None
+    journal: Optional[events.ActionJournal] = None
+    restored_from_snapshot: bool = False
+    _snapshot_version: int = 2
 
     def __init__(self, email: str = "", password: str = ""):
         super().__init__()
+        self._refresh_local = threading.local()
+        self._snapshot_sources = {}
         self.config = classes.Config()
         self.energy = classes.Energy()
         self.details = classes.Details()
         self.politics = classes.Politics()
         self.my_companies = classes.MyCompanies(self)
+        self.market_stats = classes.MarketPriceStats()
         self.reporter = classes.Reporter(self)
         self.stop_threads = Event()
         logger_class = logging.getLoggerClass()
         self.logger = logger_class("Citizen")
 
         self.telegram = classes.TelegramReporter(stop_event=self.stop_threads)
+        self.events = events.EventBus(stop_event=self.stop_threads, on_error=self._action_sink_error)
+        self.events.subscribe(self._report_action_event)
+        self.events.subscribe(self._telegram_action_event)
+        # Bus thread is a daemon, deliver what is queued before the interpreter exits
+        atexit.register(self.events.flush, self._events_flush_timeout)
 
         self.config.email = email
         self.config.password = password
@@ -84,6 +109,7 @@ class BaseCitizen(access_points.CitizenAPI):
         """
         # Idiots have fucked up their session manager - after logging in
         # You might be redirected to public homepage instead of authenticated
+        self._req.metrics.inc("erepublik_csrf_refreshes_total")
         resp = self._req.get(self.url if self.logged_in else f"{self.url}/economy/myCompanies")
         self.r = resp
         if self._errors_in_response(resp):
@@ -102,13 +128,25 @@ class BaseCitizen(access_points.CitizenAPI):
         else:
             self.report_error("Something went wrong! Can't find token in page!")
             raise classes.ErepublikException("Something went wrong! Can't find token in page! Exiting!")
+        self._update_from_page(resp.text)
+
+    @property
+    def _token_expired(self) -> bool:
+        """After 15min of inactivity token is no longer valid"""
+        return (self.now - self._req.last_time).total_seconds() >= 15 * 60
+
+    def _update_from_page(self, html: str):
+        """Update citizen info from any fetched page. Pages fetched for `refresh()` are skipped - citizen info is
+        applied from its own part under lock"""
+        if getattr(self._refresh_local, "active", False):
+            return
         try:
-            self.update_citizen_info(resp.text)
+            self.update_citizen_info(html)
         except (AttributeError, utils.json.JSONDecodeError, ValueError, KeyError):
             pass
 
     def get(self, url: str, **kwargs) -> Response:
-        if (self.now - self._req.last_time).seconds >= 15 * 60:
+        if self._token_expired:
             self.get_csrf_token()
             if "params" in kwargs:
                 if "_token" in kwargs["params"]:
@@ -119,16 +157,15 @@ class BaseCitizen(access_points.CitizenAPI):
             try:
                 response = super().get(url, **kwargs)
             except RequestException:
+                self._count_retry(url, "network")
                 self.report_error("Network error while issuing GET request")
                 self.sleep(60)
                 return self.get(url, **kwargs)
 
-            try:
-                self.update_citizen_info(response.text)
-            except (AttributeError, utils.json.JSONDecodeError, ValueError, KeyError):
-                pass
+            self._update_from_page(response.text)
 
             if self._errors_in_response(response):
+                self._count_retry(url, "error_response")
                 self.get_csrf_token()
                 self.get(url, **kwargs)
             else:
@@ -152,6 +189,7 @@ class BaseCitizen(access_points.CitizenAPI):
         try:
             response = super().post(url, data=data, json=json, **kwargs)
         except RequestException:
+            self._count_retry(url, "network")
             self.report_error("Network error while issuing POST request")
             self.sleep(60)
             return self.post(url, data=data, json=json, **kwargs)
@@ -164,6 +202,7 @@ class BaseCitizen(access_points.CitizenAPI):
             pass
 
         if self._errors_in_response(response):
+            self._count_retry(url, "error_response")
             self.get_csrf_token()
             if data:
                 data.update({"_token": self.token})
@@ -176,6 +215,10 @@ class BaseCitizen(access_points.CitizenAPI):
         self.r = response
         return response
 
+    def _count_retry(self, url: str, reason: str):
+        self._req.metrics.inc("erepublik_request_retries_total", endpoint=metrics.endpoint_name(url), reason=reason)
+
+    @tracing.traced("parse_citizen_info")
     def update_citizen_info(self, html: str = None):
         """
         Gets main page and updates most information about player
@@ -205,6 +248,13 @@ class BaseCitizen(access_points.CitizenAPI):
         if new_date:
             self.energy.set_reference_time(utils.good_timedelta(self.now, timedelta(seconds=int(new_date.group(1)))))
 
+        citizen = self._parse_citizen_info(html)
+        self._init_journal()
+        if citizen.get("dailyOrderDone", False) and not citizen.get("hasDailyOrderReward", False):
+            self._post_military_group_missions()
+
+    def _parse_citizen_info(self, html: str) -> Dict[str, Any]:
+        """Update state from main page without any requests or reports, return the page's citizen data"""
         ugly_js = re.search(r"var erepublik = ({.*}),\s+", html).group(1)
         citizen_js = utils.json.loads(ugly_js)
         citizen = citizen_js.get("citizen", {})
@@ -232,8 +282,6 @@ class BaseCitizen(access_points.CitizenAPI):
         self.details.daily_task_done = citizen.get("dailyTasksDone", False)
         self.details.daily_task_reward = citizen.get("hasReward", False)
         self.maverick = citizen.get("canSwitchDivisions", False)
-        if citizen.get("dailyOrderDone", False) and not citizen.get("hasDailyOrderReward", False):
-            self._post_military_group_missions()
 
         self.details.next_pp.sort()
         for skill in citizen.get("terrainSkills", {}).values():
@@ -249,16 +297,63 @@ class BaseCitizen(access_points.CitizenAPI):
         self.wheel_of_fortune = bool(
             re.search(r'<a id="launch_wof" class="powerspin_sidebar( show_free)?" href="javascript:">', html)
         )
+        self._snapshot_sources["citizen"] = html
+        return citizen
 
     def update_all(self):
         self.update_citizen_info()
         self.update_inventory()
 
+    def _refresh_parts(self) -> Dict[str, Tuple[Callable[[], Any], Callable[[Any], None]]]:
+        """Independent state parts which can be refreshed - fetch function and function applying fetched data.
+        Mixins extend it, parts are applied in the order they are listed.
+        """
+        return dict(
+            citizen=(lambda: self._get_main().text, self.update_citizen_info),
+            inventory=(self._fetch_inventory, lambda data: self._update_inventory_data(*data)),
+        )
+
+    @tracing.traced()
+    def refresh(self, *parts: str):
+        """Refresh state by fetching parts concurrently (requests are still throttled) and applying results one by one
+        in a defined order
+
+        :param parts: Names of parts to refresh, eg. 'money', 'inventory'. All parts if none given
+        """
+        available = self._refresh_parts()
+        unknown = set(parts) - set(available)
+        if unknown:
+            raise classes.ErepublikException(f"Unknown refresh parts: {', '.join(sorted(unknown))}")
+        names = [name for name in available if not parts or name in parts]
+        # Refresh expired token once, instead of every fetching thread doing it
+        if self._token_expired:
+            self.get_csrf_token()
+
+        def fetch(name: str) -> Any:
+            self._refresh_local.active = True
+            try:
+                with tracing.span(f"fetch_{name}"):
+                    return available[name][0]()
+            finally:
+                self._refresh_local.active = False
+
+        with ThreadPoolExecutor(max_workers=self._refresh_workers, thread_name_prefix="refresh") as executor:
+            # Run fetches in copies of the current context, so that their spans belong to this trace
+            futures = {name: executor.submit(contextvars.copy_context().run, fetch, name) for name in names}
+            for name in names:
+                self._apply_refresh(name, available[name][1], futures[name].result())
+
+    def _apply_refresh(self, name: str, apply: Callable[[Any], None], data: Any):
+        apply(data)
+
     def update_inventory(self):
         """
         Updates citizen inventory
         """
-        self._update_inventory_data(self._get_economy_inventory_items().json())
+        self._update_inventory_data(*self._fetch_inventory())
+
+    def _fetch_inventory(self) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+        return self._get_economy_inventory_items().json(), self._get_economy_my_market_offers().json()
 
     def do_captcha_challenge(self, retry: int = 0) -> bool:
         r = self._get_main_session_captcha()
@@ -318,9 +413,11 @@ class BaseCitizen(access_points.CitizenAPI):
             self.update_inventory()
         return self._inventory
 
-    def _update_inventory_data(self, inv_data: Dict[str, Any]):
+    @tracing.traced("parse_inventory")
+    def _update_inventory_data(self, inv_data: Dict[str, Any], offers_data: List[Dict[str, Any]] = None):
         if not isinstance(inv_data, dict):
             raise TypeError("Parameter `inv_data` must be dict not '{type(data)}'!")
+        self._snapshot_sources["inventory"] = (inv_data, offers_data)
 
         def _expire_value_to_python(_expire_value: str) -> Dict[str, Union[int, datetime]]:
             _data = re.search(
@@ -506,7 +603,9 @@ class BaseCitizen(access_points.CitizenAPI):
                 )
 
         offers: Dict[str, Dict[int, Dict[str, Union[str, int]]]] = {}
-        for offer in self._get_economy_my_market_offers().json():
+        if offers_data is None:
+            offers_data = self._get_economy_my_market_offers().json()
+        for offer in offers_data:
             kind = constants.INDUSTRIES[offer["industryId"]]
             offer_data = dict(
                 quality=offer.get("quality", 0),
@@ -552,42 +651,107 @@ class BaseCitizen(access_points.CitizenAPI):
             sleep(seconds)
 
     def init_logger(self):
+        """Console and file handlers run in `QueueListener` thread, error handler needs the caller's frame so it is
+        attached to the logger directly"""
+        self._stop_log_listener()
         for handler in list(self.logger.handlers):
             self.logger.removeHandler(handler)
         formatter = ErepublikFormatter()
+        log_handlers = []
         if self.config.interactive:
-            console_handler = ErepublikLogConsoleHandler()
-            console_handler.setFormatter(formatter)
-            self.logger.addHandler(console_handler)
-        file_handler = ErepublikFileHandler()
-        file_handler.setFormatter(formatter)
-        self.logger.addHandler(file_handler)
+            log_handlers.append(ErepublikLogConsoleHandler())
+        log_handlers.append(ErepublikFileHandler())
+        for handler in log_handlers:
+            handler.setFormatter(formatter)
+        log_queue = queue.SimpleQueue()
+        self._log_listener = QueueListener(log_queue, *log_handlers, respect_handler_level=True)
+        self._log_listener.start()
+        atexit.register(self._log_listener.stop)
+        self.logger.addHandler(ErepublikQueueHandler(log_queue))
         error_handler = ErepublikErrorHTTTPHandler(self.reporter)
         error_handler.setFormatter(formatter)
         self.logger.addHandler(error_handler)
         self.logger.setLevel(logging.INFO)
 
+        self._init_journal()
+
+    def _init_journal(self):
+        """Journal actions to a file of this citizen, once citizen id is known"""
+        citizen_id = self.details.citizen_id
+        if not citizen_id or self._log_listener is None:
+            return
+        if self.journal is not None:
+            if self.journal.path.name == f"actions_{citizen_id}.jsonl":
+                return
+            self.events.unsubscribe(self.journal)
+        self.journal = events.ActionJournal(f"log/actions_{citizen_id}.jsonl")
+        self.events.subscribe(self.journal)
+
+    def _stop_log_listener(self):
+        listener = self._log_listener
+        if listener is not None:
+            atexit.unregister(listener.stop)
+            listener.stop()
+            for handler in listener.handlers:
+                handler.close()
+            self._log_listener = None
+
+    @property
+    def log_handlers(self) -> List[logging.Handler]:
+        """Handlers run by the log listener"""
+        listener = self._log_listener
+        return list(listener.handlers) if listener is not None else []
+
     def set_debug(self, enable: bool):
         self.debug = bool(enable)
         self._req.debug = bool(enable)
         self.logger.setLevel(logging.DEBUG if enable else logging.INFO)
 
-        for handler in self.logger.handlers:
+        for handler in self.log_handlers:
             if isinstance(handler, (ErepublikLogConsoleHandler, ErepublikFileHandler)):
                 handler.setLevel(logging.DEBUG if enable else logging.INFO)
         self.logger.debug(f"Debug messages {'enabled' if enable else 'disabled'}!")
 
+    def set_profiling(self, enable: bool, interval: float = 0.01):
+        """Run sampling profiler over all threads, stacks are written to log/profile once per hour"""
+        if enable:
+            if self._profiler is None:
+                self._profiler = SamplingProfiler(interval, stop_event=self.stop_threads)
+            self._profiler.start()
+        elif self._profiler is not None:
+            self._profiler.stop()
+            self._profiler = None
+        self.logger.debug(f"Profiling {'enabled' if enable else 'disabled'}!")
+
+    def profile_snapshot(self) -> Optional[str]:
+        """Write stacks sampled during the current hour to a separate file
+
+        :return: Snapshot filename or None if profiling is disabled
+        """
+        if self._profiler is None:
+            return None
+        return str(self._profiler.snapshot())
+
     def set_interactive(self, enable: bool):
-        for handler in self.logger.handlers:
-            if isinstance(handler, (ErepublikLogConsoleHandler,)):
-                self.logger.removeHandler(handler)
+        if self._log_listener is None:
+            return
+        log_handlers = [h for h in self.log_handlers if not isinstance(h, ErepublikLogConsoleHandler)]
         if enable:
             handler = ErepublikLogConsoleHandler()
+            handler.setFormatter(ErepublikFormatter())
             handler.setLevel(logging.DEBUG if self.debug else logging.INFO)
-            self.logger.addHandler(handler)
-
-    def to_json(self, indent: bool = False) -> str:
-        return utils.json_dumps(self, indent=4 if indent else None, sort_keys=True)
+            log_handlers.insert(0, handler)
+        # Let the listener write out queued records before swapping handlers
+        self._log_listener.stop()
+        self._log_listener.handlers = tuple(log_handlers)
+        self._log_listener.start()
+
+    def to_json(
+        self, indent: bool = False, fields: Iterable[str] = None, depth: int = None, include_response: bool = False
+    ) -> str:
+        """Snapshot as JSON, see `snapshot()`"""
+        snapshot = self.snapshot(fields, depth, include_response)
+        return utils.json_dumps(snapshot, indent=4 if indent else None, sort_keys=True)
 
     def get_countries_with_regions(self) -> Set[constants.Country]:
         r_json = self._post_main_travel_data().json()
@@ -597,8 +761,7 @@ class BaseCitizen(access_points.CitizenAPI):
                 return_set.add(constants.COUNTRIES[country_data["id"]])
         return return_set
 
-    def dump_instance(self):
-        filename = f"{self.__class__.__name__}__dump.json"
+    def _session_data(self) -> Dict[str, Any]:
         cookie_attrs = [
             "version",
             "name",
@@ -614,17 +777,10 @@ class BaseCitizen(access_points.CitizenAPI):
             "rfc2109",
         ]
         cookies = [{attr: getattr(cookie, attr) for attr in cookie_attrs} for cookie in self._req.cookies]
-
-        with open(filename, "w") as f:
-            utils.json_dump(
-                dict(config=self.config, cookies=cookies, user_agent=self._req.headers.get("User-Agent")), f
-            )
-        self.logger.debug(f"Session saved to: '{filename}'")
+        return dict(config=self.config, cookies=cookies, user_agent=self._req.headers.get("User-Agent"))
 
     @classmethod
-    def load_from_dump(cls, dump_name: str):
-        with open(dump_name) as f:
-            data = utils.json.load(f, object_hook=utils.json_decode_object_hook)
+    def _from_session_data(cls, data: Dict[str, Any]):
         player = cls(data["config"]["email"], "")
         if data.get("cookies"):
             cookies = data.get("cookies")
@@ -638,10 +794,97 @@ class BaseCitizen(access_points.CitizenAPI):
         for k, v in data.get("config", {}).items():
             if hasattr(player.config, k):
                 setattr(player.config, k, v)
+        return player
+
+    def dump_instance(self, filename: str = None):
+        if filename is None:
+            filename = f"{self.__class__.__name__}__dump.json"
+
+        with open(filename, "w") as f:
+            utils.json_dump(self._session_data(), f)
+        self.logger.debug(f"Session saved to: '{filename}'")
+
+    @classmethod
+    def load_from_dump(cls, dump_name: str):
+        with open(dump_name) as f:
+            data = utils.json.load(f, object_hook=utils.json_decode_object_hook)
+        player = cls._from_session_data(data)
         player.init_logger()
         player._resume_session()
         return player
 
+    def _snapshot_state(self) -> Dict[str, Any]:
+        """Cached state for `save_snapshot()` - raw data the state was parsed from and cache timestamps.
+        Mixins extend it and restore their part in `_restore_snapshot_state()`.
+        """
+        return dict(
+            token=self.token,
+            logged_in=self.logged_in,
+            promos=self.promos,
+            energy_reference_time=self.energy._recovery_time,
+            sources=self._snapshot_sources,
+            request_time=self._req.last_time,
+            _last_full_update=self._last_full_update,
+            # State changed in place after it was fetched has no source to restore, so it is refetched after restore
+            _last_inventory_update=(
+                self._last_inventory_update if "inventory" in self._snapshot_sources else constants.min_datetime
+            ),
+        )
+
+    def _restore_snapshot_state(self, state: Dict[str, Any]):
+        self.token = state["token"]
+        self.logged_in = state["logged_in"]
+        self.promos = state["promos"]
+        # Parse with base parsers - they have no side effects like buying food, training or reporting
+        sources = state["sources"]
+        if "citizen" in sources:
+            self._parse_citizen_info(sources["citizen"])
+        self.energy.set_reference_time(state["energy_reference_time"])
+        if "inventory" in sources:
+            BaseCitizen._update_inventory_data(self, *sources["inventory"])
+        # Old token is refreshed by the first request if it is too old
+        self._req.last_time = state["request_time"]
+        self._last_full_update = state["_last_full_update"]
+        self._last_inventory_update = state["_last_inventory_update"]
+
+    def save_snapshot(self, filename: str = None):
+        """Save session and cached state, so that `load_from_snapshot()` can restore citizen without any requests
+
+        File is zlib compressed JSON with a header of magic bytes and format version. It is written to a temporary
+        file first and then moved in place, so a crash while saving leaves the previous snapshot intact.
+        """
+        if filename is None:
+            filename = f"{self.__class__.__name__}__snapshot.bin"
+        data = dict(self._session_data(), created=self.now, state=self._snapshot_state())
+        payload = zlib.compress(utils.json_dumps(data).encode("utf-8"), 6)
+        tmp_filename = f"{filename}.tmp"
+        with open(tmp_filename, "wb") as f:
+            f.write(b"EREP" + bytes([self._snapshot_version]) + payload)
+        os.replace(tmp_filename, filename)
+        self.logger.debug(f"Snapshot saved to: '{filename}'")
+
+    @classmethod
+    def load_from_snapshot(cls, filename: str, max_age: timedelta = timedelta(hours=1)):
+        """Restore citizen from `save_snapshot()` file. Cached state is used right away and refreshed when it expires
+        as usual. If snapshot is older than `max_age` or session wasn't logged in, session is resumed like from dump.
+        """
+        with open(filename, "rb") as f:
+            raw = f.read()
+        if raw[:4] != b"EREP" or raw[4:5] != bytes([cls._snapshot_version]):
+            raise classes.ErepublikException(f"Unsupported snapshot file: {filename}")
+        data = utils.json.loads(zlib.decompress(raw[5:]), object_hook=utils.json_decode_object_hook)
+        player = cls._from_session_data(data)
+        state = data["state"]
+        if state["logged_in"] and utils.good_timedelta(data["created"], max_age) > player.now:
+            player._restore_snapshot_state(state)
+            player.restored_from_snapshot = True
+            player.init_logger()
+            player.write_log(f"Restored as: {player.name}")
+        else:
+            player.init_logger()
+            player._resume_session()
+        return player
+
     def _resume_session(self):
         resp = self._req.get(self.url)
         try:
@@ -665,52 +908,121 @@ class BaseCitizen(access_points.CitizenAPI):
     def __repr__(self):
         return self.__str__()
 
-    @property
-    def as_dict(self):
-        ret = super().as_dict
-        ret.update(
-            name=self.name,
-            __str__=self.__str__(),
-            ebs=dict(normal=self.eb_normal, double=self.eb_double, small=self.eb_small, triple=self.eb_triple),
-            promos=self.promos,
-            inventory=self._inventory.as_dict,
-            ot_points=self.ot_points,
-            food=self.food,
-            division=self.division,
-            maveric=self.maverick,
-            eday=self.eday,
-            wheel_of_fortune=self.wheel_of_fortune,
-            debug=self.debug,
-            logged_in=self.logged_in,
-            restricted_ip=self.restricted_ip,
+    def _snapshot_fields(self) -> Dict[str, Any]:
+        """Fields of `snapshot()` - functions computing the value or dicts of them for nested fields, so that only
+        selected fields are computed. Mixins extend it.
+        """
+        return dict(
+            url=lambda: self.url,
+            request=lambda: self._req.as_dict,
+            token=lambda: self.token,
+            name=lambda: self.name,
+            __str__=self.__str__,
+            ebs=lambda: dict(normal=self.eb_normal, double=self.eb_double, small=self.eb_small, triple=self.eb_triple),
+            promos=lambda: self.promos,
+            inventory=lambda: self._inventory.as_dict,
+            ot_points=lambda: self.ot_points,
+            food=lambda: self.food,
+            division=lambda: self.division,
+            maveric=lambda: self.maverick,
+            eday=lambda: self.eday,
+            wheel_of_fortune=lambda: self.wheel_of_fortune,
+            debug=lambda: self.debug,
+            logged_in=lambda: self.logged_in,
+            restricted_ip=lambda: self.restricted_ip,
             _properties=dict(
-                now=self.now,
-                should_do_levelup=self.should_do_levelup,
-                is_levelup_reachable=self.is_levelup_reachable,
-                max_time_till_full_ff=self.max_time_till_full_ff,
-                is_levelup_close=self.is_levelup_close,
-                time_till_full_ff=self.time_till_full_ff,
-                time_till_week_change=self.time_till_week_change,
-                next_wc_start=self.next_wc_start,
-                next_reachable_energy=self.next_reachable_energy,
-                health_info=self.health_info,
+                now=lambda: self.now,
+                should_do_levelup=lambda: self.should_do_levelup,
+                is_levelup_reachable=lambda: self.is_levelup_reachable,
+                max_time_till_full_ff=lambda: self.max_time_till_full_ff,
+                is_levelup_close=lambda: self.is_levelup_close,
+                time_till_full_ff=lambda: self.time_till_full_ff,
+                time_till_week_change=lambda: self.time_till_week_change,
+                next_wc_start=lambda: self.next_wc_start,
+                next_reachable_energy=lambda: self.next_reachable_energy,
+                health_info=lambda: self.health_info,
             ),
-            _last_full_update=self._last_full_update,
-            _last_inventory_update=self._last_inventory_update,
-            config=self.config.as_dict,
-            energy=self.energy.as_dict,
-            details=self.details.as_dict,
-            politics=self.politics.as_dict,
-            my_companies=self.my_companies.as_dict,
-            reporter=self.reporter.as_dict,
-            telegram=self.telegram.as_dict,
-            stop_threads=self.stop_threads.is_set(),
-            response=self.r,
+            _last_full_update=lambda: self._last_full_update,
+            _last_inventory_update=lambda: self._last_inventory_update,
+            config=lambda: self.config.as_dict,
+            energy=lambda: self.energy.as_dict,
+            details=lambda: self.details.as_dict,
+            politics=lambda: self.politics.as_dict,
+            my_companies=lambda: self.my_companies.as_dict,
+            reporter=lambda: self.reporter.as_dict,
+            telegram=lambda: self.telegram.as_dict,
+            stop_threads=self.stop_threads.is_set,
+            response=lambda: self.r,
         )
+
+    def snapshot(
+        self, fields: Iterable[str] = None, depth: int = None, include_response: bool = False
+    ) -> Dict[str, Any]:
+        """Citizen state with only the selected fields computed
+
+        :param fields: Field names, nested fields are selected with dots, eg. `['energy', '_properties.health_info']`.
+            All fields if not given
+        :param depth: Nesting levels to include, deeper dicts and lists are replaced by a summary
+        :param include_response: Include last response with its body, only if `response` is not selected explicitly
+        :return: Snapshot dict
+        """
+        spec = self._snapshot_fields()
+        if fields is None and not include_response:
+            spec.pop("response")
+        ret = self._select_fields(spec, fields)
+        if depth is not None:
+            ret = {key: self._limit_depth(value, depth - 1) for key, value in ret.items()}
+        return ret
+
+    @classmethod
+    def _select_fields(cls, spec: Dict[str, Any], fields: Optional[Iterable[str]], prefix: str = "") -> Dict[str, Any]:
+        selected: Dict[str, Optional[List[str]]] = {}
+        for field in spec if fields is None else fields:
+            key, _, rest = field.partition(".")
+            if key not in spec:
+                raise classes.ErepublikException(f"Unknown snapshot field: {prefix}{key}")
+            if not rest or selected.get(key, []) is None:
+                selected[key] = None
+            else:
+                selected.setdefault(key, []).append(rest)
+
+        ret = {}
+        for key, sub_fields in selected.items():
+            value = spec[key]
+            if isinstance(value, dict):
+                ret[key] = cls._select_fields(value, sub_fields, f"{prefix}{key}.")
+                continue
+            value = value()
+            if sub_fields is not None:
+                if not isinstance(value, dict):
+                    raise classes.ErepublikException(f"Snapshot field {prefix}{key} has no subfields")
+                value = {sub: value[sub] for sub in sub_fields if sub in value}
+            ret[key] = value
         return ret
 
+    @classmethod
+    def _limit_depth(cls, value: Any, depth: int) -> Any:
+        if hasattr(value, "as_dict") and not isinstance(value, BaseCitizen):
+            value = value.as_dict
+        if isinstance(value, dict):
+            if depth <= 0:
+                return f"<{len(value)} keys>"
+            return {k: cls._limit_depth(v, depth - 1) for k, v in value.items()}
+        if isinstance(value, (list, tuple, set)):
+            if depth <= 0:
+                return f"<{len(value)} items>"
+            return [cls._limit_depth(v, depth - 1) for v in value]
+        return value
+
+    @property
+    def as_dict(self):
+        return self.snapshot(include_response=True)
+
     def set_locks(self):
         self.stop_threads.set()
+        self.events.flush(self._events_flush_timeout)
+        # Flushed already, don't keep stopped citizen alive until exit
+        atexit.unregister(self.events.flush)
 
     @property
     def health_info(self):
@@ -748,6 +1060,10 @@ class BaseCitizen(access_points.CitizenAPI):
         minutes_needed = round((self.energy.limit - self.energy.energy) / self.energy.interval) * 6
         return (self.energy.reference_time - self.now) + timedelta(minutes=minutes_needed)
 
+    def next_energy_time(self, food_fights: int) -> datetime:
+        """Time when energy for given amount of food fights will be available"""
+        return self.now + self.energy.time_till_energy(food_fights * 10)
+
     @property
     def max_time_till_full_ff(self) -> timedelta:
         """
@@ -841,7 +1157,7 @@ class BaseCitizen(access_points.CitizenAPI):
                 self.telegram.report_medal(msgs)
             self.write_log(f"Found awards:\n{msgs}")
             for info in data.values():
-                self.reporter.report_action("NEW_MEDAL", info)
+                self._publish_action("NEW_MEDAL", kwargs=info)
 
         levelup = re.search(r"<p>Congratulations, you have reached experience <strong>level (\d+)</strong></p>", html)
         if levelup:
@@ -850,7 +1166,7 @@ class BaseCitizen(access_points.CitizenAPI):
             self.write_log(msg)
             if self.config.telegram:
                 self.telegram.report_medal(f"Level *{level}*")
-            self.reporter.report_action("LEVEL_UP", value=level)
+            self._publish_action("LEVEL_UP", value=level)
 
     def _travel(self, country: constants.Country, region_id: int = 0) -> Response:
         data = dict(toCountryId=country.id, inRegionId=region_id)
@@ -888,8 +1204,10 @@ class BaseCitizen(access_points.CitizenAPI):
         try:
             j = response.json()
             if j["error"] and j["message"] == "Too many requests":
-                self.write_warning("Made too many requests! Sleeping for 30 seconds.")
-                self.sleep(30)
+                # Request rate has already been decreased by the session, give server some time to recover
+                seconds = round(self._req.rate.interval * 10)
+                self.write_warning(f"Made too many requests! Sleeping for {seconds} seconds.")
+                self.sleep(seconds)
         except (utils.json.JSONDecodeError, KeyError, TypeError):
             pass
         if response.status_code >= 400:
@@ -944,15 +1262,59 @@ class BaseCitizen(access_points.CitizenAPI):
         :param kwargs: Extra information regarding action
         """
         kwargs = utils.json_loads(utils.json_dumps(kwargs or {}))
-        action = action[:32]
-        if msg.startswith("Unable to"):
-            self.write_warning(msg)
+        self._publish_action(action, msg=msg, kwargs=kwargs, value=msg)
+
+    def _publish_action(
+        self,
+        action: str,
+        msg: str = None,
+        kwargs: Dict[str, Any] = None,
+        value: Any = None,
+        duration: Union[float, timedelta] = None,
+    ):
+        """Log action right away and publish its event to `events` bus, subscribed sinks - reporter, telegram and
+        action journal - get it from the bus thread
+
+        :param action: Action taken
+        :param msg: Message about the action, logged and sent to telegram
+        :param kwargs: Extra information regarding action
+        :param value: Value reported with the action
+        :param duration: Time the action took
+        """
+        if isinstance(duration, timedelta):
+            duration = duration.total_seconds()
+        event = events.ActionEvent(
+            action=action[:32],
+            time=self.now,
+            eday=self.eday,
+            citizen_id=self.details.citizen_id,
+            msg=msg,
+            kwargs=kwargs or {},
+            value=value,
+            duration=duration,
+        )
+        # Logged on the caller's thread, so that log keeps the order of actions and the caller's context
+        self._log_action_event(event)
+        self.events.publish(event)
+
+    def _log_action_event(self, event: events.ActionEvent):
+        if event.msg is None:
+            self.logger.debug(f"Action {event.action} reported")
+        elif event.msg.startswith("Unable to"):
+            self.write_warning(event.msg)
         else:
-            self.write_log(msg)
+            self.write_log(event.msg)
+
+    def _report_action_event(self, event: events.ActionEvent):
         if self.reporter.allowed:
-            self.reporter.report_action(action, kwargs, msg)
-        if self.config.telegram:
-            self.telegram.send_message(msg)
+            self.reporter.report_action(event.action, event.kwargs, event.value)
+
+    def _telegram_action_event(self, event: events.ActionEvent):
+        if self.config.telegram and event.msg is not None:
+            self.telegram.send_message(event.msg)
+
+    def _action_sink_error(self, sink: Callable, error: Exception):
+        self.write_warning(f"Action sink {getattr(sink, '__name__', sink)} failed: {error!r}")
 
 
 class CitizenAnniversary(BaseCitizen):
@@ -1008,10 +1370,36 @@ class CitizenAnniversary(BaseCitizen):
 
 
 class CitizenTravel(BaseCitizen):
+    _region_distances: Dict[Tuple[int, int], int] = None
+
     def _update_citizen_location(self, country: constants.Country, region_id: int):
         self.details.current_region = region_id
         self.details.current_country = country
 
+    def _cache_region_distances(self, regions: Union[List[Any], Dict[str, Dict[str, Any]]]):
+        """Remember distances from current region to travel data regions, distances between regions don't change"""
+        if self._region_distances is None:
+            self._region_distances = {}
+        if isinstance(regions, dict):
+            for region in regions.values():
+                if region.get("id") and region.get("distanceInKm") is not None:
+                    key = tuple(sorted((self.details.current_region, int(region["id"]))))
+                    self._region_distances[key] = int(region["distanceInKm"])
+
+    def get_cached_region_distance(self, from_region: int, to_region: int) -> Optional[int]:
+        if from_region == to_region:
+            return 0
+        return (self._region_distances or {}).get(tuple(sorted((from_region, to_region))))
+
+    def get_holding_distance(self, holding: classes.Holding) -> Optional[int]:
+        """Distance in km from current region to holding's region, travel data is requested only if not cached"""
+        distance = self.get_cached_region_distance(self.details.current_region, holding.region)
+        if distance is None:
+            self.get_travel_regions(holding=holding)
+            distance = self.get_cached_region_distance(self.details.current_region, holding.region)
+        return distance
+
+    @tracing.traced()
     def _travel(self, country: constants.Country, region_id: int = 0) -> bool:
         r_json = super()._travel(country, region_id).json()
         if not bool(r_json.get("error")):
@@ -1090,6 +1478,7 @@ class CitizenTravel(BaseCitizen):
 
     def travel_to_holding(self, holding: classes.Holding) -> bool:
         data = self._post_main_travel_data(holdingId=holding.id).json()
+        self._cache_region_distances(data.get("regions", []))
         if data.get("alreadyInRegion"):
             return True
         else:
@@ -1125,7 +1514,7 @@ class CitizenTravel(BaseCitizen):
     def get_travel_regions(
         self, holding: classes.Holding = None, battle: classes.Battle = None, country: constants.Country = None
     ) -> Union[List[Any], Dict[str, Dict[str, Any]]]:
-        return (
+        regions = (
             self._post_main_travel_data(
                 holdingId=holding.id if holding else 0,
                 battleId=battle.id if battle else 0,
@@ -1134,6 +1523,8 @@ class CitizenTravel(BaseCitizen):
             .json()
             .get("regions", [])
         )
+        self._cache_region_distances(regions)
+        return regions
 
     def get_travel_countries(self) -> Set[constants.Country]:
         warnings.simplefilter("always")
@@ -1146,69 +1537,182 @@ class CitizenTravel(BaseCitizen):
 
 
 class CitizenCompanies(BaseCitizen):
+    _last_companies_update: datetime = constants.min_datetime
+
     def update_all(self):
         super().update_all()
         self.update_companies()
 
+    def _refresh_parts(self) -> Dict[str, Tuple[Callable[[], Any], Callable[[Any], None]]]:
+        parts = super()._refresh_parts()
+        parts.update(companies=(lambda: self._get_economy_my_companies().text, self._update_companies_data))
+        return parts
+
+    def _snapshot_state(self) -> Dict[str, Any]:
+        state = super()._snapshot_state()
+        state.update(
+            _last_companies_update=(
+                self._last_companies_update if "companies" in self._snapshot_sources else constants.min_datetime
+            ),
+            pending_employees=self.my_companies.pending_employees,
+        )
+        return state
+
+    def _restore_snapshot_state(self, state: Dict[str, Any]):
+        super()._restore_snapshot_state(state)
+        if "companies" in state["sources"]:
+            CitizenCompanies._update_companies_data(self, state["sources"]["companies"])
+        self._last_companies_update = state["_last_companies_update"]
+        self.my_companies.pending_employees = {int(k): v for k, v in state.get("pending_employees", {}).items()}
+
+    def get_companies(self, force: bool = False) -> classes.MyCompanies:
+        if utils.good_timedelta(self._last_companies_update, timedelta(minutes=5)) < self.now or force:
+            self.update_companies()
+        return self.my_companies
+
     def employ_employees(self) -> bool:
         self.update_companies()
         ret = True
-        employee_companies = self.my_companies.get_employable_factories()
-        work_units_needed = sum(employee_companies.values())
-
-        if work_units_needed:
-            if work_units_needed <= self.my_companies.work_units:
-                response = self._post_economy_work("production", employ=employee_companies).json()
-                self.reporter.report_action("WORK_EMPLOYEES", response, response.get("status", False))
+        if self.my_companies.get_employable_factories():
+            employ = self.my_companies.plan_employees(
+                self.my_companies.work_units, self.inventory.raw, self._employee_unit_value
+            )
+            if employ:
+                r = self._post_economy_work("production", employ=employ)
+                response = r.json()
+                self._publish_action(
+                    "WORK_EMPLOYEES", kwargs=response, value=response.get("status", False), duration=r.elapsed
+                )
             self.update_companies()
             ret = bool(self.my_companies.get_employable_factories())
 
         return ret
 
+    def _employee_unit_value(self, company: classes.Company) -> Union[float, Decimal]:
+        """Value of one work in the company - products made at the lowest known market price if market was scanned"""
+        if company.is_raw:
+            price = self.market_stats.global_min(company._internal_industry, 1)
+        else:
+            price = self.market_stats.global_min(company.industry, company.quality)
+        return company.products_made * Decimal(str(price)) if price else company.products_made
+
     def work_as_manager_in_holding(self, holding: classes.Holding) -> Optional[Dict[str, Any]]:
         return self._work_as_manager(holding)
 
+    @tracing.traced()
     def _work_as_manager(self, wam_holding: classes.Holding) -> Optional[Dict[str, Any]]:
         if self.restricted_ip:
             return None
-        self.update_companies()
-        self.update_inventory()
-        data = {"action_type": "production"}
-        extra = {}
-        raw_factories = wam_holding.get_wam_companies(raw_factory=True)
-        fin_factories = wam_holding.get_wam_companies(raw_factory=False)
-
-        free_inventory = self.inventory.total - self.inventory.used
-        for _ in range(len(fin_factories + raw_factories) - self.energy.food_fights):
-            if not self.my_companies.remove_factory_from_wam_list(raw_factories, fin_factories):
-                raise classes.ErepublikException("Nothing removed from WAM list!")
-
-        if int(free_inventory * 0.75) < self.my_companies.get_needed_inventory_usage(fin_factories + raw_factories):
-            free_inventory = self.inventory.total - self.inventory.used
-
-        while (fin_factories + raw_factories) and free_inventory < self.my_companies.get_needed_inventory_usage(
-            fin_factories + raw_factories
-        ):
-            if not self.my_companies.remove_factory_from_wam_list(raw_factories, fin_factories):
-                raise classes.ErepublikException("Nothing removed from WAM list!")
+        self.get_companies()
+        inventory = self.get_inventory()
+        free_inventory = inventory.total - inventory.used
+        wam_list = self.my_companies.select_wam_companies(
+            wam_holding.get_wam_companies(),
+            self.energy.food_fights,
+            free_inventory,
+            inventory.raw,
+            self._employee_unit_value,
+        )
 
-        if fin_factories + raw_factories:
-            data.update(extra)
+        if wam_list:
             if not self.details.current_region == wam_holding.region:
                 self.write_warning("Unable to work as manager because of location - please travel!")
                 return
 
-            employ_factories = self.my_companies.get_employable_factories()
-            if sum(employ_factories.values()) > self.my_companies.work_units:
-                employ_factories = {}
+            employ_factories = self.my_companies.plan_employees(
+                self.my_companies.work_units, inventory.raw, self._employee_unit_value, reserved=wam_list
+            )
 
-            response = self._post_economy_work(
-                "production", wam=[c.id for c in (fin_factories + raw_factories)], employ=employ_factories
-            ).json()
+            response = self._post_economy_work("production", wam=[c.id for c in wam_list], employ=employ_factories)
+            response = response.json()
+            if not self._apply_wam_response(wam_list, employ_factories, response):
+                self.update_companies()
+                self.update_inventory()
             return response
 
+    def _apply_wam_response(
+        self, wam_list: List[classes.Company], employ: Dict[int, int], response: Dict[str, Any]
+    ) -> bool:
+        """Apply `/economy/work` production response to cached companies and inventory instead of downloading them
+        again.
+
+        :param wam_list: Companies which were sent to work
+        :param employ: Employee work units which were sent
+        :param response: Parsed work response
+        :return: False if response does not match cached state and full refresh is needed
+        """
+        if not response.get("status"):
+            # Nothing was produced, but whatever caused the failure may be resolved by buying raw or food
+            self._last_inventory_update = constants.min_datetime
+            return True
+        production: Dict[str, Union[int, float, Dict[str, int]]] = response.get("result", {}).get("production", {})
+
+        final_names = dict(food="Food", weapon="Weapon", house="House", airplane="Aircraft")
+        raw_names = {1: "foodRaw", 2: "weaponRaw", 4: "houseRaw", 23: "airplaneRaw"}
+        produced_kinds = {kind for kind, data in production.items() if data}
+        if not produced_kinds <= set(final_names) | set(raw_names.values()):
+            return False
+        for company in wam_list:
+            kind = constants.INDUSTRIES[company._internal_industry]
+            kind = (kind if company.is_raw else kind.lower()).replace("aircraft", "airplane")
+            if kind not in produced_kinds:
+                return False
+
+        # Validate raw usage before changing anything, so that failed check leaves cached state intact
+        inventory = self._inventory
+        # Inventory names raw by industry (aircraftRaw), work response by product (airplaneRaw)
+        raw_change: Dict[str, float] = {
+            constants.INDUSTRIES[constants.INDUSTRIES[kind]]: production[kind]
+            for kind in produced_kinds
+            if kind in raw_names.values()
+        }
+        produced_raw = set(raw_change)
+        for company in wam_list:
+            if not company.is_raw:
+                kind = constants.INDUSTRIES[constants.INDUSTRIES[raw_names.get(company.industry)]]
+                raw_change[kind] = raw_change.get(kind, 0) + float(company.raw_usage)
+        for kind, change in raw_change.items():
+            raw = inventory.raw.get(kind, {}).get(0)
+            if (raw["amount"] if raw else 0) + change < 0 or (raw is None and kind not in produced_raw):
+                return False
+
+        storage_change = 0
+        for kind in produced_kinds & set(final_names):
+            items = inventory.final.setdefault(final_names[kind], {})
+            for quality, amount in production[kind].items():
+                quality, amount = int(quality), int(amount)
+                if quality not in items:
+                    # Unknown item metadata, let next inventory request build it
+                    self._last_inventory_update = constants.min_datetime
+                    items[quality] = dict(kind=final_names[kind], quality=quality, amount=0)
+                items[quality]["amount"] = int(items[quality].get("amount") or 0) + amount
+                if kind == "food" and f"q{quality}" in constants.FOOD_ENERGY:
+                    self.food[f"q{quality}"] += amount
+                storage_change += amount
+        for kind, change in raw_change.items():
+            raw = inventory.raw.setdefault(kind, {}).setdefault(0, dict(name=kind, amount=0, icon=""))
+            raw["amount"] += change
+            storage_change += change
+        for company in wam_list:
+            company.already_worked = True
+        self.my_companies.invalidate_aggregates()
+        inventory.used += round(storage_change)
+        self.food["total"] = sum([self.food[q] * constants.FOOD_ENERGY[q] for q in constants.FOOD_ENERGY])
+
+        if employ:
+            self.my_companies.work_units -= sum(employ.values())
+            # Raw consumed by employees is not known from the response
+            self._last_inventory_update = constants.min_datetime
+        # Cached pages no longer describe the state
+        self._snapshot_sources.pop("inventory", None)
+        self._snapshot_sources.pop("companies", None)
+        return True
+
     def update_companies(self):
-        html = self._get_economy_my_companies().text
+        self._update_companies_data(self._get_economy_my_companies().text)
+
+    @tracing.traced("parse_companies")
+    def _update_companies_data(self, html: str):
         page_details = utils.json.loads(re.search(r"var pageDetails\s+= ({.*});", html).group(1))
         self.my_companies.work_units = int(page_details.get("total_works", 0))
 
@@ -1217,13 +1721,15 @@ class CitizenCompanies(BaseCitizen):
         if have_holdings and have_companies:
             self.my_companies.prepare_holdings(utils.json.loads(have_holdings.group(1)))
             self.my_companies.prepare_companies(utils.json.loads(have_companies.group(1)))
+        self._last_companies_update = self.now
+        self._snapshot_sources["companies"] = html
 
     def assign_company_to_holding(self, company: classes.Company, holding: classes.Holding) -> Response:
         """
         Assigns factory to new holding
         """
         self.logger.debug(f"{company} moved to {holding}")
-        company._holding = weakref.ref(holding)
+        self.my_companies.move_company(company, holding)
         return self._post_economy_assign_to_holding(company.id, holding.id)
 
     def create_factory(self, industry_id: int, building_type: int = 1) -> Response:
@@ -1242,20 +1748,76 @@ class CitizenCompanies(BaseCitizen):
 
 
 class CitizenEconomy(CitizenTravel):
+    _last_exchange_page: Optional[Tuple[Tuple[int, int], Response, Dict[str, Any], datetime]] = None
+    _exchange_page_ttl: int = 60
+
     def update_all(self):
         super().update_all()
         self.update_money()
 
+    def _refresh_parts(self) -> Dict[str, Tuple[Callable[[], Any], Callable[[Any], None]]]:
+        def apply(resp: Response):
+            self._last_exchange_page = ((0, 62), resp, resp.json(), self.now)
+            self._update_money_data(self._last_exchange_page[2])
+
+        parts = super()._refresh_parts()
+        parts.update(money=(lambda: self._post_economy_exchange_retrieve(False, 0, 62), apply))
+        return parts
+
+    def _snapshot_state(self) -> Dict[str, Any]:
+        state = super()._snapshot_state()
+        state.update(money=dict(cc=self.details.cc, gold=self.details.gold))
+        return state
+
+    def _restore_snapshot_state(self, state: Dict[str, Any]):
+        super()._restore_snapshot_state(state)
+        self.details.cc = state["money"]["cc"]
+        self.details.gold = state["money"]["gold"]
+
     def update_money(self, page: int = 0, currency: int = 62):
         """
         Gets monetary market offers to get exact amount of CC and Gold available
         """
+        self._get_monetary_market_page(page, currency)
+
+    def _update_money_data(self, exchange_data: Dict[str, Any]):
+        self.details.cc = float(exchange_data.get("ecash").get("value"))
+        self.details.gold = float(exchange_data.get("gold").get("value"))
+
+    def _get_monetary_market_page(self, page: int = 0, currency: int = 62) -> Dict[str, Any]:
+        """Retrieve monetary market page and update CC and Gold balances from it.
+        Page is reused if no other request has been made since it was retrieved and it isn't older than
+        `_exchange_page_ttl` seconds.
+
+        :param page: Page number starting from 0
+        :param currency: currency kind - gold = 62, cc = 1
+        :return: Parsed exchange response
+        """
         if currency not in [1, 62]:
             currency = 62
-        resp = self._post_economy_exchange_retrieve(False, page, currency)
-        resp_data = resp.json()
-        self.details.cc = float(resp_data.get("ecash").get("value"))
-        self.details.gold = float(resp_data.get("gold").get("value"))
+        cached = self._last_exchange_page
+        fresh = cached and (self.now - cached[3]).total_seconds() < self._exchange_page_ttl
+        if fresh and cached[0] == (page, currency) and cached[1] is self.r:
+            resp_data = cached[2]
+        else:
+            resp = self._post_economy_exchange_retrieve(False, page, currency)
+            resp_data = resp.json()
+            self._last_exchange_page = ((page, currency), resp, resp_data, self.now)
+        self._update_money_data(resp_data)
+        return resp_data
+
+    @staticmethod
+    def _parse_monetary_offers(exchange_data: Dict[str, Any]) -> List[Dict[str, Union[int, float]]]:
+        offers = re.findall(
+            r"id='purchase_(\d+)' data-i18n='Buy for' data-currency='GOLD' "
+            r"data-price='(\d+\.\d+)' data-max='(\d+\.\d+)' trigger='purchase'",
+            exchange_data.get("buy_mode", ""),
+            re.M | re.I | re.S,
+        )
+        ret = [
+            dict(offer_id=int(offer_id), price=float(price), amount=float(amount)) for offer_id, price, amount in offers
+        ]
+        return sorted(ret, key=lambda o: (o["price"], -o["amount"]))
 
     def check_house_durability(self) -> Dict[int, datetime]:
         ret = {}
@@ -1265,6 +1827,7 @@ class CitizenEconomy(CitizenTravel):
             ret.update({house_quality: till})
         return ret
 
+    @tracing.traced()
     def buy_and_activate_house(self, q: int) -> Optional[Dict[int, datetime]]:
         original_region = self.details.current_country, self.details.current_region
         ok_to_activate = False
@@ -1459,6 +2022,8 @@ class CitizenEconomy(CitizenTravel):
             self.travel_to_residence()
         return json_ret
 
+    @tracing.traced()
+    @metrics.timed("get_market_offers")
     def get_market_offers(
         self, product_name: str, quality: int = None, country: constants.Country = None
     ) -> Dict[str, classes.OfferItem]:
@@ -1489,25 +2054,31 @@ class CitizenEconomy(CitizenTravel):
 
         start_dt = self.now
         iterable = [countries, [quality] if quality else range(1, max_quality + 1)]
+        industry = constants.INDUSTRIES[product_name]
         for country, q in product(*iterable):
-            r = self._post_economy_marketplace(country.id, constants.INDUSTRIES[product_name], q).json()
+            r = self._post_economy_marketplace(country.id, industry, q).json()
             obj = offers[f"q{q}"]
             if not r.get("error", False):
-                for offer in r["offers"]:
-                    if obj.price > float(offer["priceWithTaxes"]) or (
-                        obj.price == float(offer["priceWithTaxes"]) and obj.amount < int(offer["amount"])
-                    ):
-                        offers[f"q{q}"] = obj = classes.OfferItem(
-                            float(offer["priceWithTaxes"]),
-                            constants.COUNTRIES[int(offer["country_id"])],
-                            int(offer["amount"]),
-                            int(offer["id"]),
-                            int(offer["citizen_id"]),
-                        )
+                scanned = [
+                    classes.OfferItem(
+                        float(offer["priceWithTaxes"]),
+                        constants.COUNTRIES[int(offer["country_id"])],
+                        int(offer["amount"]),
+                        int(offer["id"]),
+                        int(offer["citizen_id"]),
+                    )
+                    for offer in r["offers"]
+                ]
+                self.market_stats.add_offers(industry, q, country.id, scanned)
+                for offer in scanned:
+                    if obj.price > offer.price or (obj.price == offer.price and obj.amount < offer.amount):
+                        offers[f"q{q}"] = obj = offer
         self.logger.debug(f"Scraped market in {self.now - start_dt}!")
 
         return offers
 
+    @tracing.traced()
+    @metrics.timed("buy_food")
     def buy_food(self, energy_amount: int = 0):
         hp_needed = energy_amount if energy_amount else 48 * self.energy.interval * 10 - self.food["total"]
         local_offers = self.get_market_offers("food", country=self.details.current_country)
@@ -1537,21 +2108,57 @@ class CitizenEconomy(CitizenTravel):
             self._report_action("BUY_FOOD", s)
 
     def get_monetary_offers(self, currency: int = 62) -> List[Dict[str, Union[int, float]]]:
-        if currency not in [1, 62]:
-            currency = 62
-        resp = self._post_economy_exchange_retrieve(False, 0, currency).json()
-        ret = []
-        offers = re.findall(
-            r"id='purchase_(\d+)' data-i18n='Buy for' data-currency='GOLD' "
-            r"data-price='(\d+\.\d+)' data-max='(\d+\.\d+)' trigger='purchase'",
-            resp["buy_mode"],
-            re.M | re.I | re.S,
-        )
+        return self._parse_monetary_offers(self._get_monetary_market_page(0, currency))
 
-        for offer_id, price, amount in offers:
-            ret.append(dict(offer_id=int(offer_id), price=float(price), amount=float(amount)))
+    def iter_monetary_offers(
+        self, currency: int = 62, amount: float = 0
+    ) -> Generator[Dict[str, Union[int, float]], None, None]:
+        """Lazily iterate over monetary market offers of all pages, next page is retrieved only when needed
 
-        return sorted(ret, key=lambda o: (o["price"], -o["amount"]))
+        :param currency: currency kind - gold = 62, cc = 1
+        :param amount: stop as soon as offers covering this amount have been yielded, 0 - iterate over all pages
+        """
+        seen_offers: Set[int] = set()
+        covered = 0.0
+        page = 0
+        while True:
+            offers = [
+                o
+                for o in self._parse_monetary_offers(self._get_monetary_market_page(page, currency))
+                if o["offer_id"] not in seen_offers
+            ]
+            if not offers:
+                return
+            for offer in offers:
+                seen_offers.add(offer["offer_id"])
+                yield offer
+                covered += offer["amount"]
+                if amount and covered >= amount:
+                    return
+            page += 1
+
+    def buy_gold(self, amount: float, max_price: float = None) -> float:
+        """Buy gold from monetary market, cheapest offers first. Exchange pages are retrieved only until offers cover
+        the amount, balances are updated from the same pages.
+
+        :param amount: Amount of gold to buy
+        :param max_price: Don't buy offers more expensive than this (cc per gold)
+        :return: Amount of gold bought
+        """
+        offers = list(self.iter_monetary_offers(62, amount))
+        bought = 0.0
+        for offer in offers:
+            if max_price is not None and offer["price"] > max_price:
+                break
+            # Gold is traded in hundredths
+            affordable = int(self.details.cc / offer["price"] * 100) / 100
+            buy_amount = round(min(offer["amount"], amount - bought, affordable), 2)
+            if buy_amount <= 0:
+                break
+            if not self.buy_monetary_market_offer(offer["offer_id"], buy_amount, 62):
+                break
+            bought = round(bought + buy_amount, 2)
+        return bought
 
     def buy_monetary_market_offer(self, offer: int, amount: float, currency: int) -> int:
         """Buy from monetary market
@@ -1939,13 +2546,23 @@ class CitizenTasks(CitizenEconomy):
     ot_points: int = 0
     next_ot_time: datetime = None
 
-    @property
-    def as_dict(self):
-        d = super().as_dict
-        d.update(tg_contract=self.tg_contract, ot_points=self.ot_points, next_ot_time=self.next_ot_time)
-        return d
+    def _snapshot_fields(self) -> Dict[str, Any]:
+        fields = super()._snapshot_fields()
+        fields.update(
+            tg_contract=lambda: self.tg_contract,
+            ot_points=lambda: self.ot_points,
+            next_ot_time=lambda: self.next_ot_time,
+        )
+        return fields
+
+    @tracing.traced()
+    @metrics.timed("work")
+    def work(self, block: bool = True) -> Optional[datetime]:
+        """Work in employer's company
 
-    def work(self):
+        :param block: Sleep until there is enough energy, otherwise return time when work can be retried
+        :return: Retry time if `block` is False and there isn't enough energy
+        """
         if self.energy.food_fights >= 1:
             response = self._post_economy_work("work")
             js = response.json()
@@ -1957,16 +2574,25 @@ class CitizenTasks(CitizenEconomy):
                 elif js.get("message") in ["not_enough_health_food"]:
                     self.buy_food(120)
                 self.update_citizen_info()
-                self.work()
+                return self.work(block)
             else:
-                self.reporter.report_action("WORK", json_val=js)
+                self._publish_action("WORK", kwargs=js, duration=response.elapsed)
         else:
+            if not block:
+                return self.next_energy_time(1)
             seconds = 360 - self.now.timestamp() % 360
             self.write_warning(f"I don't have energy to work. Will sleep for {seconds}s")
             self.sleep(seconds)
             self.work()
 
-    def train(self):
+    @tracing.traced()
+    @metrics.timed("train")
+    def train(self, block: bool = True) -> Optional[datetime]:
+        """Train in all default training grounds
+
+        :param block: Sleep until there is enough energy, otherwise return time when training can be retried
+        :return: Retry time if `block` is False and there isn't enough energy
+        """
         r = self._get_main_training_grounds_json()
         tg_json = r.json()
         self.details.gold = tg_json["page_details"]["gold"]
@@ -1983,16 +2609,18 @@ class CitizenTasks(CitizenEconomy):
                 response = self._post_economy_train(tgs)
                 if not response.json().get("status"):
                     self.update_citizen_info()
-                    self.train()
+                    return self.train(block)
                 else:
-                    self.reporter.report_action("TRAIN", response.json())
+                    self._publish_action("TRAIN", kwargs=response.json(), duration=response.elapsed)
             else:
+                if not block:
+                    return self.next_energy_time(len(tgs))
                 seconds = self.now.timestamp() % 360
                 self.write_warning(f"I don't have energy to train. Will sleep for {seconds}s")
                 self.sleep(seconds)
                 self.train()
 
-    def work_ot(self):
+    def work_ot(self, block: bool = True) -> Optional[datetime]:
         # I"m not checking for 1h cooldown. Beware of nightshift work, if calling more than once every 60min
         self.update_job_info()
         if self.ot_points >= 24 and self.energy.food_fights > 1:
@@ -2005,8 +2633,10 @@ class CitizenTasks(CitizenEconomy):
                     self.find_new_job()
                 elif r.json().get("message") == "not_enough_health_food":
                     self.buy_food(120)
-                self.reporter.report_action("WORK_OT", r.json())
+                self._publish_action("WORK_OT", kwargs=r.json(), duration=r.elapsed)
         elif self.energy.food_fights < 1 and self.ot_points >= 24:
+            if not block:
+                return self.next_energy_time(2)
             seconds = 360 - self.now.timestamp() % 360
             self.write_warning(f"I don't have energy to work OT. Will sleep for {seconds}s")
             self.sleep(seconds)
@@ -2074,6 +2704,16 @@ class _Citizen(
         player.login()
         return player
 
+    @classmethod
+    def load_from_snapshot(cls, filename: str = "", max_age: timedelta = timedelta(hours=1)):
+        filename = filename if filename else f"{cls.__name__}__snapshot.bin"
+        player: _Citizen = super().load_from_snapshot(filename, max_age)  # noqa
+        if player.restored_from_snapshot:
+            player._init_reporters()
+        else:
+            player.login()
+        return player
+
     def config_setup(self, **kwargs):
         self.config.reset()
         for key, value in kwargs.items():
@@ -2082,14 +2722,17 @@ class _Citizen(
             else:
                 self.write_warning(f"Unknown config parameter! ({key}={value})")
 
-    def login(self):
-        self.get_csrf_token()
-
-        self.update_citizen_info()
+    def _init_reporters(self):
         self.reporter.do_init()
         if self.config.telegram and self.config.telegram_chat_id:
             self.telegram.do_init(self.config.telegram_chat_id, self.config.telegram_token, self.name)
             self.telegram.send_message(f"*Started* {utils.now():%F %T}")
+
+    def login(self):
+        self.get_csrf_token()
+
+        self.update_citizen_info()
+        self._init_reporters()
         self.init_logger()
 
         if self.logged_in:
@@ -2119,7 +2762,9 @@ class _Citizen(
             self.telegram.report_full_energy(self.energy.energy, self.energy.limit, self.energy.interval)
 
     def check_for_notification_medals(self):
-        notifications = self._get_main_citizen_daily_assistant().json()
+        self._update_notification_medals_data(self._get_main_citizen_daily_assistant().json())
+
+    def _update_notification_medals_data(self, notifications: Dict[str, Any]):
         data: Dict[Tuple[str, Union[float, str]], Dict[str, Union[int, str, float]]] = {}
         for medal in notifications.get("notifications", []):
             if medal.get("details", {}).get("type") == "citizenAchievement":
@@ -2168,7 +2813,7 @@ class _Citizen(
                 self.telegram.report_medal(msgs, len(data) > 1)
             self.write_log(f"Found awards:\n{msgs}")
             for info in data.values():
-                self.reporter.report_action("NEW_MEDAL", info)
+                self._publish_action("NEW_MEDAL", kwargs=info)
 
     def set_pin(self, pin: str):
         self.details.pin = str(pin[:4])
@@ -2177,13 +2822,34 @@ class _Citizen(
         # Do full update max every 5 min
         if utils.good_timedelta(self._last_full_update, timedelta(minutes=5)) < self.now or force_update:
             self._last_full_update = self.now
-            super().update_all()
-            self.update_weekly_challenge()
-            self.check_for_notification_medals()
+            self.refresh()
             self.send_state_update()
 
+    def _refresh_parts(self) -> Dict[str, Tuple[Callable[[], Any], Callable[[Any], None]]]:
+        parts = super()._refresh_parts()
+        parts.update(
+            weekly_challenge=(
+                lambda: self._get_main_weekly_challenge_data().json(),
+                self._update_weekly_challenge_data,
+            ),
+            medals=(lambda: self._get_main_citizen_daily_assistant().json(), self._update_notification_medals_data),
+        )
+        return parts
+
+    def _snapshot_state(self) -> Dict[str, Any]:
+        state = super()._snapshot_state()
+        state.update(weekly_challenge=dict(pp=self.details.pp, next_pp=self.details.next_pp))
+        return state
+
+    def _restore_snapshot_state(self, state: Dict[str, Any]):
+        super()._restore_snapshot_state(state)
+        self.details.pp = state["weekly_challenge"]["pp"]
+        self.details.next_pp = list(state["weekly_challenge"]["next_pp"])
+
     def update_weekly_challenge(self):
-        data = self._get_main_weekly_challenge_data().json()
+        self._update_weekly_challenge_data(self._get_main_weekly_challenge_data().json())
+
+    def _update_weekly_challenge_data(self, data: Dict[str, Any]):
         self.details.pp = data.get("player", {}).get("prestigePoints", 0)
         self.details.next_pp.clear()
         max_collectable_id = data.get("maxRewardId")
@@ -2246,10 +2912,19 @@ class _Citizen(
         self.reporter.send_state_update(**data)
 
     def send_inventory_update(self):
-        self.reporter.report_action("INVENTORY", json_val=self.inventory.as_dict)
+        self._send_changes("INVENTORY", self.inventory.tracker.changes(self.inventory.as_dict))
 
     def send_my_companies_update(self):
-        self.reporter.report_action("COMPANIES", json_val=self.my_companies.as_dict)
+        self._send_changes("COMPANIES", self.my_companies.tracker.changes(self.my_companies.as_dict))
+
+    def _send_changes(self, action: str, changes: Optional[Dict[str, Any]]):
+        """Report full snapshot as `action` or only the delta as `action`_DELTA, nothing if state has not changed"""
+        if changes is None:
+            return
+        if changes["full"]:
+            self.reporter.report_action(action, json_val=changes["state"])
+        else:
+            self.reporter.report_action(f"{action}_DELTA", json_val=changes)
 
     def sell_produced_product(self, kind: str, quality: int = 1, amount: int = 0):
         if not amount:
@@ -2259,17 +2934,60 @@ class _Citizen(
             amount = inv_resp.get("inventoryItems").get(category).get("items").get(item).get("amount", 0)
 
         if amount >= 1:
-            lowest_price = self.get_market_offers(kind, int(quality), self.details.citizenship)[f"q{int(quality)}"]
-
-            if lowest_price.citizen_id == self.details.citizen_id:
-                price = lowest_price.price
-            else:
-                price = lowest_price.price - 0.01
-
+            price = self._get_sell_price(kind, int(quality))
             self.post_market_offer(
                 industry=constants.INDUSTRIES[kind], amount=int(amount), quality=int(quality), price=price
             )
 
+    def _get_sell_price(self, kind: str, quality: int, max_age: int = 5, floor_percentile: float = 25) -> float:
+        """Price for selling in citizenship market - undercut the lowest offer, but never go below given percentile
+        of recently seen best prices. Market is scanned only if there is no scan younger than `max_age` minutes.
+        """
+        industry = constants.INDUSTRIES[kind]
+        country = self.details.citizenship
+        last_update = self.market_stats.last_update(industry, quality, country.id)
+        if last_update is None or utils.good_timedelta(last_update, timedelta(minutes=max_age)) < self.now:
+            self.get_market_offers(kind, quality, country)
+        lowest_price = self.market_stats.best_offer(industry, quality, country.id)
+        if lowest_price is None:
+            lowest_price = classes.OfferItem()
+
+        if lowest_price.citizen_id == self.details.citizen_id:
+            price = lowest_price.price
+        else:
+            price = lowest_price.price - 0.01
+        price_floor = self.market_stats.percentile(industry, quality, country.id, floor_percentile)
+        if price_floor is not None:
+            price = max(price, round(price_floor, 2))
+        return price
+
+    def sell_produced_products(self, products: Dict[str, Dict[int, int]]):
+        """Sell multiple products in one pass - inventory is read once and every (industry, quality) cell is scanned
+        at most once before posting all offers
+
+        :param products: Product kind mapped to qualities and amounts to sell, amount 0 - sell everything in storage
+        """
+        inventory = self.get_inventory(force=True)
+        to_post: List[Tuple[int, int, int, float]] = []
+        for kind, qualities in products.items():
+            industry = constants.INDUSTRIES[kind]
+            if not industry:
+                self.write_warning(f"Trying to sell unsupported industry {kind}")
+                continue
+            final_kind = industry in [1, 2, 3, 4, 23]
+            items = (inventory.final if final_kind else inventory.raw).get(constants.INDUSTRIES[industry], {})
+            for quality, amount in qualities.items():
+                quality = int(quality)
+                available = int(items.get(quality if final_kind else 0, {}).get("amount", 0))
+                amount = min(int(amount), available) if amount else available
+                if amount < 1:
+                    continue
+                to_post.append((industry, quality, amount, self._get_sell_price(kind, quality)))
+
+        for industry, quality, amount, price in to_post:
+            self.post_market_offer(industry=industry, amount=amount, quality=quality, price=price)
+
+    @tracing.traced()
     def _wam(self, holding: classes.Holding) -> NoReturn:
         response = self.work_as_manager_in_holding(holding)
         if response is None:
@@ -2277,15 +2995,17 @@ class _Citizen(
         if response.get("status"):
             self._report_action("WORK_AS_MANAGER", "Worked as manager", kwargs=response)
             if self.config.auto_sell:
+                to_sell: Dict[str, Dict[int, int]] = {}
                 for kind, data in response.get("result", {}).get("production", {}).items():
                     if data and kind in self.config.auto_sell:
                         if kind in ["food", "weapon", "house", "airplane"]:
-                            for quality, amount in data.items():
-                                self.sell_produced_product(kind, quality, int(data))
+                            to_sell[kind] = {int(quality): int(amount) for quality, amount in data.items()}
                         elif kind.endswith("Raw"):
-                            self.sell_produced_product(kind, 1, int(data))
+                            to_sell[kind] = {1: int(data)}
                         else:
                             raise classes.ErepublikException(f"Unknown kind produced '{kind}'")
+                if to_sell:
+                    self.sell_produced_products(to_sell)
         elif self.config.auto_buy_raw and re.search(r"not_enough_[^_]*_raw", response.get("message")):
             raw_kind = re.search(r"not_enough_(\w+)_raw", response.get("message"))
             if raw_kind:
@@ -2337,6 +3057,52 @@ class _Citizen(
             self._report_action("WORK_AS_MANAGER", f"Worked as manager failed: {msg}", kwargs=response)
             self.write_warning(msg)
 
+    def plan_wam_route(self, holdings: List[classes.Holding]) -> List[classes.Holding]:
+        """Order holdings for work as manager so that travelling distance is minimal - always go to the closest
+        holding from where the citizen would be. Distances from the current region are requested if unknown, further
+        legs use cached distances only. Holdings which don't fit remaining energy or free storage are skipped.
+
+        :param holdings: Holdings to visit
+        :return: Holdings in visiting order
+        """
+        route: List[classes.Holding] = []
+        region = self.details.current_region
+        food_fights = self.energy.food_fights
+        free_storage = self.inventory.total - self.inventory.used
+        remaining = list(holdings)
+
+        def needed_storage(_holding: classes.Holding) -> Decimal:
+            return self.my_companies.get_needed_inventory_usage(_holding.get_wam_companies())
+
+        while remaining:
+            fitting = []
+            for holding in remaining:
+                # Either work in all holding factories or have 2h energy worth
+                if not food_fights or food_fights < 2 * self.energy.interval < holding.wam_count:
+                    continue
+                if needed_storage(holding) > free_storage:
+                    continue
+                fitting.append(holding)
+            if not fitting:
+                break
+
+            def distance(_holding: classes.Holding) -> Union[int, float]:
+                if region == self.details.current_region:
+                    _distance = self.get_holding_distance(_holding)
+                else:
+                    _distance = self.get_cached_region_distance(region, _holding.region)
+                return float("inf") if _distance is None else _distance
+
+            holding = min(fitting, key=lambda h: (distance(h), -h.wam_count))
+            remaining.remove(holding)
+            route.append(holding)
+            region = holding.region
+            food_fights -= min(food_fights, holding.wam_count)
+            free_storage -= needed_storage(holding)
+        return route
+
+    @tracing.traced()
+    @metrics.timed("work_as_manager")
     def work_as_manager(self) -> bool:
         """Does Work as Manager in all holdings with wam. If employees assigned - work them also
 
@@ -2347,142 +3113,100 @@ class _Citizen(
             self._report_action("IP_BLACKLISTED", "Work as manager is not allowed from restricted IP!")
             return False
         self.update_citizen_info()
-        self.update_companies()
-        wam_holdings: List[classes.Holding] = [
-            holding for holding in self.my_companies.get_wam_holdings() if holding.wam_count
-        ]
-
-        # Check for current region
-        for holding in wam_holdings:
-            if holding.region == self.details.current_region:
-                self._wam(holding)
-                self.update_companies()
         wam_holdings: List[classes.Holding] = [
-            holding for holding in wam_holdings if not holding.region == self.details.current_region
+            holding for holding in self.get_companies().get_wam_holdings() if holding.wam_count
         ]
 
-        for holding in wam_holdings:
-            # Don't travel if not enough energy (either work in all holding factories or 2h energy worth)
-            if self.energy.energy < 2 * self.energy.interval * 10 < holding.wam_count * 10:
+        while wam_holdings:
+            route = self.plan_wam_route(wam_holdings)
+            if not route:
+                self._report_action("WAM_UNAVAILABLE", "Not enough energy or storage!")
                 break
-            raw_usage = holding.get_wam_raw_usage()
-            free_storage = self.inventory.total - self.inventory.used
-            if (raw_usage["frm"] + raw_usage["wrm"]) * 100 > free_storage:
-                self._report_action("WAM_UNAVAILABLE", "Not enough storage!")
-                continue
-            self.travel_to_holding(holding)
+            holding = route[0]
+            wam_holdings.remove(holding)
+            if not holding.region == self.details.current_region:
+                self.travel_to_holding(holding)
             self._wam(holding)
-            self.update_companies()
 
-        wam_count = self.my_companies.get_total_wam_count()
+        wam_count = self.get_companies().get_total_wam_count()
         self.travel_to_residence()
         return bool(wam_count)
 
 
 class Citizen(_Citizen):
-    _concurrency_lock: Event
-    _update_lock: Event
+    locks: classes.LockManager
     _update_timeout: int = 30
     _concurrency_timeout: int = 600
 
     def __init__(self, *args, **kwargs):
-        self._concurrency_lock = Event()
-        self._concurrency_lock.set()
-        self._update_lock = Event()
-        self._update_lock.set()
+        # Location is locked before anything else - updates hold it (read) while they lock the updated resources
+        self.locks = classes.LockManager(priority=("travel",))
         super().__init__(*args, **kwargs)
 
-    def update_weekly_challenge(self):
-        if not self._update_lock.wait(self._update_timeout):
-            e = f"Update concurrency not freed in {self._update_timeout}sec!"
-            self.report_error(e)
-            return None
+    def _locked(self, resources: Tuple[str, ...], timeout: int, func, *args, write: bool = True, **kwargs):
+        """Call func while holding locks for given resources, report and return None if locks aren't acquired"""
         try:
-            self._update_lock.clear()
-            super().update_weekly_challenge()
-        finally:
-            self._update_lock.set()
+            with (self.locks.write if write else self.locks.read)(*resources, timeout=timeout):
+                return func(*args, **kwargs)
+        except classes.LockTimeoutError as e:
+            self.report_error(str(e))
+            return None
+
+    def update_citizen_info(self, html: str = None):
+        # Location must not change while page is parsed
+        self._locked(("travel",), self._update_timeout, super().update_citizen_info, html, write=False)
+
+    def update_all(self, force_update=False):
+        self._locked(("travel",), self._update_timeout, super().update_all, force_update, write=False)
+
+    def update_weekly_challenge(self):
+        self._locked(("details",), self._update_timeout, super().update_weekly_challenge)
 
     def update_companies(self):
-        if not self._update_lock.wait(self._update_timeout):
-            e = f"Update concurrency not freed in {self._update_timeout}sec!"
-            self.report_error(e)
-            return None
-        try:
-            self._update_lock.clear()
-            super().update_companies()
-        finally:
-            self._update_lock.set()
+        self._locked(("companies",), self._update_timeout, super().update_companies)
 
     def update_job_info(self):
-        if not self._update_lock.wait(self._update_timeout):
-            e = f"Update concurrency not freed in {self._update_timeout}sec!"
-            self.report_error(e)
-            return None
-        try:
-            self._update_lock.clear()
-            super().update_job_info()
-        finally:
-            self._update_lock.set()
+        self._locked(("details",), self._update_timeout, super().update_job_info)
 
     def update_money(self, page: int = 0, currency: int = 62):
-        if not self._update_lock.wait(self._update_timeout):
-            e = f"Update concurrency not freed in {self._update_timeout}sec!"
-            self.report_error(e)
-            return None
-        try:
-            self._update_lock.clear()
-            super().update_money(page, currency)
-        finally:
-            self._update_lock.set()
+        self._locked(("money",), self._update_timeout, super().update_money, page, currency)
 
     def update_inventory(self):
-        if not self._update_lock.wait(self._update_timeout):
-            e = f"Update concurrency not freed in {self._update_timeout}sec!"
-            self.report_error(e)
-            return None
-        try:
-            self._update_lock.clear()
-            super().update_inventory()
-        finally:
-            self._update_lock.set()
+        self._locked(("inventory",), self._update_timeout, super().update_inventory)
+
+    def refresh(self, *parts: str):
+        self._locked(("travel",), self._update_timeout, super().refresh, *parts, write=False)
+
+    def _apply_refresh(self, name: str, apply: Callable[[Any], None], data: Any):
+        resource = dict(citizen="details", weekly_challenge="details", medals="details").get(name, name)
+        self._locked((resource,), self._update_timeout, super()._apply_refresh, name, apply, data)
+
+    def _travel(self, country: constants.Country, region_id: int = 0) -> bool:
+        return self._locked(("travel",), self._concurrency_timeout, super()._travel, country, region_id)
 
     def _work_as_manager(self, wam_holding: classes.Holding) -> Optional[Dict[str, Any]]:
-        if not self._concurrency_lock.wait(self._concurrency_timeout):
-            e = f"Concurrency not freed in {self._concurrency_timeout}sec!"
-            self.report_error(e)
-            return None
-        try:
-            self._concurrency_lock.clear()
-            return super()._work_as_manager(wam_holding)
-        finally:
-            self._concurrency_lock.set()
+        # Location is compared with holding's region and responses may refresh citizen info, which locks travel
+        return self._locked(
+            ("travel", "companies", "inventory"), self._concurrency_timeout, super()._work_as_manager, wam_holding
+        )
+
+    def buy_gold(self, amount: float, max_price: float = None) -> float:
+        # Exchange responses may refresh citizen info, which locks travel
+        return self._locked(("travel", "money"), self._concurrency_timeout, super().buy_gold, amount, max_price) or 0.0
 
     def buy_market_offer(self, offer: classes.OfferItem, amount: int = None) -> Optional[Dict[str, Any]]:
-        if not self._concurrency_lock.wait(self._concurrency_timeout):
-            e = f"Concurrency not freed in {self._concurrency_timeout}sec!"
-            self.report_error(e)
-            return None
-        try:
-            self._concurrency_lock.clear()
-            return super().buy_market_offer(offer, amount)
-        finally:
-            self._concurrency_lock.set()
+        # Buying may travel to the offer's country, so travel is locked up front to keep the lock order
+        return self._locked(
+            ("travel", "inventory", "money"), self._concurrency_timeout, super().buy_market_offer, offer, amount
+        )
 
-    @property
-    def as_dict(self):
-        d = super().as_dict
-        d.update(
+    def _snapshot_fields(self) -> Dict[str, Any]:
+        fields = super()._snapshot_fields()
+        fields.update(
             locks=dict(
-                concurrency_lock=self._concurrency_lock.is_set(),
-                update_lock=self._update_lock.is_set(),
-                concurrency_timeout=self._concurrency_timeout,
-                update_timeout=self._update_timeout,
+                resources=lambda: self.locks.as_dict,
+                concurrency_timeout=lambda: self._concurrency_timeout,
+                update_timeout=lambda: self._update_timeout,
             )
         )
-        return d
-
-    def set_locks(self):
-        super().set_locks()
-        self._concurrency_lock.set()
-        self._update_lock.set()
+        return fields
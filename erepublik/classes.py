@@ -1,13 +1,20 @@
+import bisect
 import datetime
 import hashlib
+import queue
+import sqlite3
 import threading
+import time
 import warnings
 import weakref
+from collections import deque
+from contextlib import contextmanager
 from decimal import Decimal
 from io import BytesIO
-from typing import Any, Dict, Generator, Iterable, List, NamedTuple, NoReturn, Optional, Tuple, Union
+from pathlib import Path
+from typing import Any, Callable, Deque, Dict, Generator, Iterable, List, NamedTuple, NoReturn, Optional, Tuple, Union
 
-from requests import HTTPError, Response, Session, post
+from requests import HTTPError, RequestException, Response, Session, post
 
 from erepublik import _types as types
 from erepublik import constants, utils
@@ -27,10 +34,15 @@ __all__ = [
     "EnergyToFight",
     "Holding",
     "Inventory",
+    "LockManager",
+    "LockTimeoutError",
+    "MarketPriceStats",
     "MyCompanies",
     "OfferItem",
     "Politics",
+    "RWLock",
     "Reporter",
+    "StateDiffTracker",
     "TelegramReporter",
 ]
 
@@ -54,6 +66,10 @@ class CaptchaSessionError(ErepublikNetworkException):
     pass
 
 
+class LockTimeoutError(ErepublikException):
+    pass
+
+
 class Holding:
     id: int
     region: int
@@ -79,7 +95,7 @@ class Holding:
 
     @property
     def wam_count(self) -> int:
-        return len([1 for company in self.companies if company.wam_enabled and not company.already_worked])
+        return sum(1 for company in self.companies if company.wam_enabled and not company.already_worked)
 
     @property
     def wam_companies(self) -> Iterable["Company"]:
@@ -90,24 +106,24 @@ class Holding:
         return [company for company in self.companies if company.preset_works]
 
     def add_company(self, company: "Company") -> NoReturn:
-        self.companies.append(company)
-        self.companies.sort()
+        bisect.insort(self.companies, company)
 
     def get_wam_raw_usage(self) -> Dict[str, Decimal]:
-        frm = Decimal("0.00")
-        wrm = Decimal("0.00")
-        for company in self.wam_companies:
-            if company.industry in [1, 7, 8, 9, 10, 11]:
-                frm += company.raw_usage
-            elif company.industry in [2, 12, 13, 14, 15, 16]:
-                wrm += company.raw_usage
-        return dict(frm=frm, wrm=wrm)
+        frm = wrm = 0
+        for company in self.companies:
+            if not company.wam_enabled:
+                continue
+            if company.industry in MyCompanies._frm_fab_ids:
+                frm += company._raw_usage
+            elif company.industry in MyCompanies._wrm_fab_ids:
+                wrm += company._raw_usage
+        return dict(frm=utils.from_fixed(frm), wrm=utils.from_fixed(wrm))
 
     def get_wam_companies(self, raw_factory: bool = None) -> List["Company"]:
         raw = []
         factory = []
-        for company in self.wam_companies:
-            if not company.already_worked and not company.cannot_wam_reason == "war":
+        for company in self.companies:
+            if company.wam_enabled and not company.already_worked and not company.cannot_wam_reason == "war":
                 if company.is_raw:
                     raw.append(company)
                 else:
@@ -158,6 +174,9 @@ class Company:
     industry: int
     already_worked: bool
     preset_works: int
+    fixed_point: bool
+    _raw_usage: Union[int, Decimal]
+    _products_made: Union[int, Decimal]
 
     def __init__(
         self,
@@ -174,7 +193,11 @@ class Company:
         industry: int,
         already_worked: bool,
         preset_works: int,
+        fixed_point: bool = False,
     ):
+        """If `fixed_point` is set, `effective_bonus`, `raw_usage` and `base_production` must be integers in hundredths
+        of units (see `utils.to_fixed`) and all production math is done with integers.
+        """
         self._holding = weakref.ref(holding)
         self.id: int = _id
         self.industry: int = industry
@@ -185,10 +208,25 @@ class Company:
         self.cannot_wam_reason: str = cannot_wam_reason
         self.already_worked: bool = already_worked
         self.preset_works: int = preset_works
+        self.fixed_point: bool = fixed_point
 
-        self.products_made = self.raw_usage = Decimal(base_production) * Decimal(effective_bonus)
-        if not self.is_raw:
-            self.raw_usage = -self.products_made * raw_usage
+        if fixed_point:
+            scale = utils.FIXED_POINT_SCALE
+            self._products_made = self._raw_usage = (base_production * effective_bonus + scale // 2) // scale
+            if not self.is_raw:
+                self._raw_usage = -((self._products_made * raw_usage + scale // 2) // scale)
+        else:
+            self._products_made = self._raw_usage = Decimal(base_production) * Decimal(effective_bonus)
+            if not self.is_raw:
+                self._raw_usage = -self._products_made * raw_usage
+
+    @property
+    def products_made(self) -> Decimal:
+        return utils.from_fixed(self._products_made)
+
+    @property
+    def raw_usage(self) -> Decimal:
+        return utils.from_fixed(self._raw_usage)
 
     def _get_real_quality(self, quality) -> int:
         #  7: 'FRM q1',  8: 'FRM q2',  9: 'FRM q3', 10: 'FRM q4', 11: 'FRM q5',
@@ -295,18 +333,26 @@ class MyCompanies:
     ff_lockdown: int = 0
 
     holdings: Dict[int, Holding]
-    _companies: weakref.WeakSet
+    _companies: Dict[int, Company]
+    pending_employees: Dict[int, int]
+    tracker: "StateDiffTracker"
+    _aggregates: Dict[Any, Any]
     _citizen: weakref.ReferenceType
     companies: Generator[Company, None, None]
     _frm_fab_ids = (1, 7, 8, 9, 10, 11)
     _wrm_fab_ids = (2, 12, 13, 14, 15, 16)
     _hrm_fab_ids = (4, 18, 19, 20, 21, 22)
     _arm_fab_ids = (23, 24, 25, 26, 27, 28)
+    # Searched selections before the best one found so far is used
+    _wam_search_limit = 100_000
 
     def __init__(self, citizen):
         self._citizen = weakref.ref(citizen)
         self.holdings = dict()
-        self._companies = weakref.WeakSet()
+        self._companies = dict()
+        self.pending_employees = dict()
+        self.tracker = StateDiffTracker()
+        self._aggregates = dict()
         self.next_ot_time = utils.now()
 
     def prepare_holdings(self, holdings: Dict[str, Dict[str, Any]]):
@@ -324,51 +370,106 @@ class MyCompanies:
                 )
         if not self.holdings.get(0):
             self.holdings.update({0: Holding(0, 0, self.citizen, "Unassigned")})  # unassigned
+        self.invalidate_aggregates()
 
     def prepare_companies(self, companies: Dict[str, Dict[str, Any]]):
         """
         :param companies: Parsed JSON to dict from en/economy/myCompanies
         """
         self.__clear_data()
+        fixed_point = self.citizen.config.fixed_point_math
+        new_companies: List[Company] = []
         for company_dict in companies.values():
             holding = self.holdings.get(int(company_dict["holding_company_id"]))
             quality = company_dict.get("quality")
             is_raw = company_dict.get("is_raw")
-            if is_raw:
-                raw_usage = Decimal("0.0")
+            if fixed_point:
+                # effective_bonus is in percent, which already is hundredths of the multiplier
+                effective_bonus = round(float(company_dict.get("effective_bonus")))
+                base_production = utils.to_fixed(company_dict.get("base_production"))
+                raw_usage = 0
+                if not is_raw:
+                    raw_usage = utils.to_fixed(company_dict.get("upgrades").get(str(quality)).get("raw_usage"))
             else:
-                raw_usage = Decimal(str(company_dict.get("upgrades").get(str(quality)).get("raw_usage")))
+                effective_bonus = Decimal(str(company_dict.get("effective_bonus"))) / 100
+                base_production = Decimal(str(company_dict.get("base_production")))
+                raw_usage = Decimal("0.0")
+                if not is_raw:
+                    raw_usage = Decimal(str(company_dict.get("upgrades").get(str(quality)).get("raw_usage")))
             company = Company(
                 holding,
                 company_dict.get("id"),
                 quality,
                 is_raw,
-                Decimal(str(company_dict.get("effective_bonus"))) / 100,
+                effective_bonus,
                 raw_usage,
-                Decimal(str(company_dict.get("base_production"))),
+                base_production,
                 company_dict.get("wam_enabled"),
                 company_dict.get("can_work_as_manager"),
                 company_dict.get("cannot_work_as_manager_reason"),
                 company_dict.get("industry_id"),
                 company_dict.get("already_worked"),
                 company_dict.get("preset_works"),
+                fixed_point,
             )
-            self._companies.add(company)
-            holding.add_company(company)
+            new_companies.append(company)
+            holding.companies.append(company)
+
+        # Sort once instead of on every insert
+        for holding in self.holdings.values():
+            holding.companies.sort()
+        new_companies.sort()
+        self._companies = {company.id: company for company in new_companies}
+        self.invalidate_aggregates()
+
+    def invalidate_aggregates(self):
+        """Forget cached aggregates - must be called whenever companies, their holdings or WAM state change"""
+        self._aggregates = dict()
+
+    def _aggregate(self, key: Any, compute: Callable[[], Any]) -> Any:
+        aggregates = self._aggregates
+        if key not in aggregates:
+            aggregates[key] = compute()
+        return aggregates[key]
+
+    def get_company(self, company_id: int) -> Optional[Company]:
+        return self._companies.get(company_id)
+
+    def move_company(self, company: Company, holding: Holding):
+        """Move company to another holding"""
+        if company in company.holding.companies:
+            company.holding.companies.remove(company)
+        company._holding = weakref.ref(holding)
+        holding.add_company(company)
+        self.invalidate_aggregates()
 
     def get_employable_factories(self) -> Dict[int, int]:
-        return {company.id: company.preset_works for company in self.companies if company.preset_works}
+        return dict(
+            self._aggregate(
+                "employable",
+                lambda: {company.id: company.preset_works for company in self.companies if company.preset_works},
+            )
+        )
 
     def get_total_wam_count(self) -> int:
-        return sum([holding.wam_count for holding in self.holdings.values()])
+        return self._aggregate(
+            "wam_count",
+            lambda: sum(1 for company in self.companies if company.wam_enabled and not company.already_worked),
+        )
 
-    @staticmethod
-    def get_needed_inventory_usage(companies: Union[Company, Iterable[Company]]) -> Decimal:
-        if isinstance(companies, list):
-            return sum(company.products_made * (100 if company.is_raw else 1) for company in companies)
-        else:
+    def get_needed_inventory_usage(self, companies: Union[Company, Iterable[Company]]) -> Decimal:
+        if not isinstance(companies, list):
             return companies.products_made
 
+        def usage() -> Decimal:
+            return utils.from_fixed(
+                sum(company._products_made * (100 if company.is_raw else 1) for company in companies)
+            )
+
+        if all(self._companies.get(company.id) is company for company in companies):
+            return self._aggregate(("inventory_usage", tuple(company.id for company in companies)), usage)
+        return usage()
+
     def remove_factory_from_wam_list(self, raw_factories, final_factories):
         frm, wrm, *_ = self.get_raw_usage_for_companies(*final_factories, *raw_factories)
         inv_raw = self.citizen.inventory.raw
@@ -394,31 +495,166 @@ class MyCompanies:
                         if to_remove:
                             return final_factories.pop(final_factories.index(to_remove[0]))
 
+    def select_wam_companies(
+        self,
+        companies: Iterable[Company],
+        max_count: int,
+        free_storage: Union[int, Decimal],
+        inv_raw: types.InvRaw,
+        unit_value: Callable[[Company], Union[float, Decimal]] = None,
+    ) -> List[Company]:
+        """Select companies to work as manager in, so that the total value of work is the highest possible without
+        exceeding energy, free storage and available raw materials.
+
+        Identical companies are grouped and the amount worked in each group is searched depth first - raw material
+        companies before factories, so that raw balance can only decrease - skipping branches which can't be worth
+        more than the best selection found so far. Of equally valuable selections the one with fewer companies wins.
+
+        :param companies: WAM candidates
+        :param max_count: How many companies can be worked (energy available for work)
+        :param free_storage: Free storage space
+        :param inv_raw: Raw materials in inventory
+        :param unit_value: Value of one work in the company, defaults to amount of products made
+        :return: Companies to work in
+        """
+        if unit_value is None:
+            unit_value = Company.products_made.fget
+        candidates = sorted((c for c in companies if not c.cannot_wam_reason == "war"), key=lambda c: c.id)
+        # Work in the units companies were parsed in - scaled integers or Decimals
+        to_units = utils.to_fixed if any(c.fixed_point for c in candidates) else lambda v: Decimal(str(v))
+        fab_ids = (self._frm_fab_ids, self._wrm_fab_ids, self._hrm_fab_ids, self._arm_fab_ids)
+        balance = [
+            to_units(inv_raw.get(constants.INDUSTRIES[ids[1]], {}).get(0, {}).get("amount", 0)) for ids in fab_ids
+        ]
+        free_storage = to_units(free_storage)
+
+        # (raw kind, raw usage, storage, value) -> companies
+        groups: Dict[Tuple[Optional[int], Any, Any, Decimal], List[Company]] = {}
+        for company in candidates:
+            kind = next((k for k, ids in enumerate(fab_ids) if company.industry in ids), None)
+            storage = company._products_made * (100 if company.is_raw else 1)
+            key = (kind, company._raw_usage, storage, Decimal(str(unit_value(company))))
+            groups.setdefault(key, []).append(company)
+        order = sorted(groups, key=lambda k: (k[1] < 0, -k[3]))
+        # Most valuable works left from every position, for the upper bound of the branch
+        best_left: List[List[Decimal]] = []
+        for pos in range(len(order)):
+            values = sorted((key[3] for key in order[pos:] for _ in groups[key]), reverse=True)
+            best_left.append([sum(values[:n]) for n in range(len(values) + 1)])
+
+        counts = [0] * len(order)
+        best: Dict[str, Any] = dict(value=(Decimal(-1), 0), counts=list(counts), nodes=0)
+
+        def search(pos: int, count_left: int, storage_left, value: Decimal):
+            best["nodes"] += 1
+            if pos == len(order):
+                if (value, -sum(counts)) > best["value"]:
+                    best.update(value=(value, -sum(counts)), counts=list(counts))
+                return
+            bound = best_left[pos][min(count_left, len(best_left[pos]) - 1)]
+            if best["nodes"] > self._wam_search_limit or value + bound < best["value"][0]:
+                return
+            kind, usage, storage, work_value = order[pos]
+            most = min(len(groups[order[pos]]), count_left)
+            if storage > 0:
+                most = min(most, int(storage_left // storage))
+            if kind is not None and usage < 0:
+                most = min(most, int(balance[kind] // -usage))
+            for amount in range(max(most, 0), -1, -1):
+                counts[pos] = amount
+                if kind is not None:
+                    balance[kind] += usage * amount
+                search(pos + 1, count_left - amount, storage_left - storage * amount, value + work_value * amount)
+                if kind is not None:
+                    balance[kind] -= usage * amount
+            counts[pos] = 0
+
+        search(0, max(max_count, 0), free_storage, Decimal(0))
+        selected = [company for pos, key in enumerate(order) for company in groups[key][: best["counts"][pos]]]
+        return sorted(selected, key=lambda c: c.id)
+
+    def plan_employees(
+        self,
+        work_units: int,
+        inv_raw: types.InvRaw,
+        unit_value: Callable[[Company], Union[float, Decimal]] = None,
+        reserved: Iterable[Company] = (),
+    ) -> Dict[int, int]:
+        """Distribute available employee work units between companies with preset works. Companies with the highest
+        value of one work unit are employed first, factories only as much as available raw materials allow. Raw
+        produced by employees in raw companies is used for factories in the second pass. Work units which could not
+        be allocated are kept in `pending_employees` and these companies are employed first in the next plan.
+
+        :param work_units: Available employee work units
+        :param inv_raw: Raw materials in inventory
+        :param unit_value: Value of one work unit in the company, defaults to amount of products made
+        :param reserved: Companies worked in the same request (as manager) whose raw usage must be accounted for
+        :return: Employ mapping {company_id: work_units} for `_post_economy_work`
+        """
+        if unit_value is None:
+            unit_value = Company.products_made.fget
+        fab_ids = (self._frm_fab_ids, self._wrm_fab_ids, self._hrm_fab_ids, self._arm_fab_ids)
+        balance = [
+            Decimal(str(inv_raw.get(constants.INDUSTRIES[ids[1]], {}).get(0, {}).get("amount", 0))) for ids in fab_ids
+        ]
+
+        def raw_kind(_company: Company) -> Optional[int]:
+            return next((k for k, ids in enumerate(fab_ids) if _company.industry in ids), None)
+
+        for company in reserved:
+            if raw_kind(company) is not None:
+                balance[raw_kind(company)] += company.raw_usage
+
+        companies = [c for c in self.companies if c.preset_works > 0]
+        companies.sort(
+            key=lambda c: (c.id in self.pending_employees, unit_value(c), not c.is_raw, c.quality, -c.id), reverse=True
+        )
+        plan: Dict[int, int] = {}
+        for _ in range(2):
+            for company in companies:
+                units = min(company.preset_works - plan.get(company.id, 0), work_units)
+                kind = raw_kind(company)
+                if kind is not None and company.raw_usage < 0:
+                    units = min(units, int(balance[kind] / -company.raw_usage))
+                if units <= 0:
+                    continue
+                plan[company.id] = plan.get(company.id, 0) + units
+                work_units -= units
+                if kind is not None:
+                    balance[kind] += company.raw_usage * units
+
+        self.pending_employees = {
+            c.id: c.preset_works - plan.get(c.id, 0) for c in companies if c.preset_works > plan.get(c.id, 0)
+        }
+        return plan
+
     def get_raw_usage_for_companies(self, *companies: Company) -> Tuple[Decimal, Decimal, Decimal, Decimal]:
-        frm = wrm = hrm = arm = Decimal("0.00")
+        frm = wrm = hrm = arm = 0
         for company in companies:
             if company.industry in self._frm_fab_ids:
-                frm += company.raw_usage
+                frm += company._raw_usage
             elif company.industry in self._wrm_fab_ids:
-                wrm += company.raw_usage
+                wrm += company._raw_usage
             elif company.industry in self._hrm_fab_ids:
-                hrm += company.raw_usage
+                hrm += company._raw_usage
             elif company.industry in self._arm_fab_ids:
-                arm += company.raw_usage
-        return frm, wrm, hrm, arm
+                arm += company._raw_usage
+        return utils.from_fixed(frm), utils.from_fixed(wrm), utils.from_fixed(hrm), utils.from_fixed(arm)
 
     @property
     def companies(self) -> Generator[Company, None, None]:
-        return (c for c in self._companies)
+        return (c for c in self._companies.values())
 
     def get_wam_holdings(self) -> Generator[Holding, None, None]:
-        for holding in sorted(
-            self.holdings.values(), key=lambda h: (-len(h.get_wam_companies(False)), -len(h.get_wam_companies()))
-        ):
+        def sort_key(holding: Holding) -> Tuple[int, int]:
+            wam_companies = holding.get_wam_companies()
+            return -sum(1 for c in wam_companies if not c.is_raw), -len(wam_companies)
+
+        for holding in self._aggregate("wam_holdings", lambda: sorted(self.holdings.values(), key=sort_key)):
             yield holding
 
     def __str__(self):
-        return f"MyCompanies: {sum(1 for _ in self.companies)} companies in {len(self.holdings)} holdings"
+        return f"MyCompanies: {len(self._companies)} companies in {len(self.holdings)} holdings"
 
     def __repr__(self):
         return str(self)
@@ -448,7 +684,7 @@ class MyCompanies:
             next_ot_time=self.next_ot_time,
             ff_lockdown=self.ff_lockdown,
             holdings={str(hi): h.as_dict for hi, h in self.holdings.items()},
-            company_count=sum(1 for _ in self.companies),
+            company_count=len(self._companies),
         )
 
     @property
@@ -473,6 +709,7 @@ class Config:
     telegram_chat_id = 0
     telegram_token = ""
     spin_wheel_of_fortune = False
+    fixed_point_math = False
     # fight = False
     # air = False
     # ground = False
@@ -507,6 +744,7 @@ class Config:
         self.telegram_chat_id = 0
         self.telegram_token = ""
         self.spin_wheel_of_fortune = False
+        self.fixed_point_math = False
         # self.fight = False
         # self.air = False
         # self.ground = False
@@ -541,6 +779,7 @@ class Config:
             telegram_chat_id=self.telegram_chat_id,
             telegram_token=self.telegram_token,
             spin_wheel_of_fortune=self.spin_wheel_of_fortune,
+            fixed_point_math=self.fixed_point_math,
             # fight=self.fight,
             # air=self.air,
             # ground=self.ground,
@@ -595,6 +834,16 @@ class Energy:
             ret = self._recovery_time
         return ret
 
+    def time_till_energy(self, energy: int) -> datetime.timedelta:
+        """Time till given amount of energy is available (last interval rounded up), one interval if recovery rate is
+        unknown"""
+        if self.energy >= energy:
+            return datetime.timedelta(0)
+        if self.interval <= 0:
+            return datetime.timedelta(minutes=6)
+        intervals = -(-(energy - self.energy) // self.interval)
+        return (self.reference_time - utils.now()) + datetime.timedelta(minutes=intervals * 6)
+
     @property
     def is_recoverable_full(self):
         warnings.warn(
@@ -743,9 +992,22 @@ class House:
 
 
 class Reporter:
+    """Reports actions and state to erep.lv
+
+    Updates are stored in a bounded SQLite queue on disk and uploaded by a background thread in batches, with
+    exponential back-off if connection fails or server errors. Updates rejected by server (4xx) are moved to
+    `dead_letter` table instead of being retried. Remaining updates are flushed when citizen's `stop_threads` is set,
+    whatever can't be uploaded is kept on disk for the next run.
+    """
+
     __to_update: List[Dict[Any, Any]] = None
     key: str = ""
     allowed: bool = False
+    queue_file: Optional[str] = None
+    max_queue: int = 10000
+    batch_size: int = 50
+    max_retry_delay: int = 300
+    _db: Optional[sqlite3.Connection] = None
 
     @property
     def name(self) -> str:
@@ -767,7 +1029,7 @@ class Reporter:
             citizen_id=self.citizen_id,
             key=self.key,
             allowed=self.allowed,
-            queue=self.__to_update,
+            queue=self.queue_size,
         )
 
     def __init__(self, citizen):
@@ -777,13 +1039,23 @@ class Reporter:
         self._req.headers.update({"user-agent": "eRepublik Script Reporter v3", "erep-version": utils.__version__})
         self.__to_update = []
         self.__registered: bool = False
+        self._db_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._player_id: int = 0
 
     def do_init(self):
         self.key: str = ""
         self.__update_key()
+        # Cached for the final flush, which may run after citizen is gone
+        self._player_id = self.citizen_id
         self._req.headers.update({"erep-user-id": str(self.citizen_id), "erep-user-name": self.name})
         self.register_account()
         self.allowed = True
+        self._open_queue()
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run_uploader, name=f"{self.name}-reporter", daemon=True)
+            self._thread.start()
 
     @property
     def citizen(self):
@@ -793,28 +1065,105 @@ class Reporter:
         self.key = hashlib.md5(bytes(f"{self.name}:{self.email}", encoding="UTF-8")).hexdigest()
 
     def __bot_update(self, data: dict) -> Response:
-        if self.__to_update:
-            for unreported_data in self.__to_update:
-                unreported_data.update(player_id=self.citizen_id, key=self.key)
-                unreported_data = utils.json_loads(utils.json_dumps(unreported_data))
-                r = self._req.post(f"{self.url}/bot/update", json=unreported_data)
-                r.raise_for_status()
-            self.__to_update.clear()
         data = utils.json.loads(utils.json_dumps(data))
-        r = self._req.post(f"{self.url}/bot/update", json=data)
+        r = self._req.post(f"{self.url}/bot/update", json=data, timeout=30)
         r.raise_for_status()
         return r
 
-    def _bot_update(self, data: Dict[str, Any]) -> Optional[Response]:
+    def _bot_update(self, data: Dict[str, Any]):
+        """Queue update for upload by background thread"""
         if not self.__registered:
             self.do_init()
-        if self.allowed:
-            try:
-                return self.__bot_update(data)
-            except HTTPError:
-                self.__to_update.append(data)
-        else:
+        if self._db is None:
             self.__to_update.append(data)
+        else:
+            self._enqueue(data)
+
+    def _open_queue(self):
+        if self._db is None:
+            queue_file = Path(self.queue_file or f"log/reporter_{self.key}.sqlite")
+            queue_file.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(str(queue_file), check_same_thread=False, isolation_level=None)
+            self._db.execute("CREATE TABLE IF NOT EXISTS queue (id INTEGER PRIMARY KEY AUTOINCREMENT, data TEXT)")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS dead_letter (id INTEGER PRIMARY KEY, data TEXT, status INTEGER)"
+            )
+        while self.__to_update:
+            self._enqueue(self.__to_update.pop(0))
+
+    def _enqueue(self, data: Dict[str, Any]):
+        with self._db_lock:
+            self._db.execute("INSERT INTO queue (data) VALUES (?)", (utils.json_dumps(data),))
+            # Keep only the newest `max_queue` updates
+            self._db.execute("DELETE FROM queue WHERE id <= (SELECT MAX(id) FROM queue) - ?", (self.max_queue,))
+        self._wakeup.set()
+
+    @property
+    def queue_size(self) -> int:
+        if self._db is None:
+            return len(self.__to_update)
+        with self._db_lock:
+            return self._db.execute("SELECT COUNT(*) FROM queue").fetchone()[0]
+
+    def flush(self) -> bool:
+        """Upload queued updates in batches
+
+        :return: False if upload failed and some updates are still queued
+        """
+        if self._db is None:
+            return not self.__to_update
+        citizen = self.citizen
+        player_id = citizen.details.citizen_id if citizen is not None else self._player_id
+        del citizen
+        while True:
+            with self._db_lock:
+                rows = self._db.execute("SELECT id, data FROM queue ORDER BY id LIMIT ?", (self.batch_size,)).fetchall()
+            if not rows:
+                return True
+            uploaded, rejected = [], []
+            try:
+                for row_id, payload in rows:
+                    data = utils.json.loads(payload)
+                    data.update(player_id=player_id, key=self.key)
+                    try:
+                        self.__bot_update(data)
+                    except HTTPError as e:
+                        status = e.response.status_code if e.response is not None else 0
+                        # Timeouts and rate limits are worth retrying, other client errors won't ever succeed
+                        if not 400 <= status < 500 or status in [408, 429]:
+                            raise
+                        rejected.append((row_id, payload, status))
+                    uploaded.append((row_id,))
+            except RequestException:
+                return False
+            finally:
+                with self._db_lock:
+                    if rejected:
+                        self._db.executemany("INSERT INTO dead_letter (id, data, status) VALUES (?, ?, ?)", rejected)
+                        self._db.execute(
+                            "DELETE FROM dead_letter WHERE id <= (SELECT MAX(id) FROM dead_letter) - ?",
+                            (self.max_queue,),
+                        )
+                    self._db.executemany("DELETE FROM queue WHERE id = ?", uploaded)
+
+    def _run_uploader(self):
+        retry_delay = 0
+        while True:
+            citizen = self.citizen
+            if citizen is None or citizen.stop_threads.is_set():
+                self.flush()
+                return
+            stop_event = citizen.stop_threads
+            del citizen
+            if retry_delay:
+                stop_event.wait(retry_delay)
+            elif not self._wakeup.wait(1):
+                continue
+            self._wakeup.clear()
+            if self.flush():
+                retry_delay = 0
+            else:
+                retry_delay = min(max(retry_delay * 2, 5), self.max_retry_delay)
 
     def register_account(self):
         if not self.__registered:
@@ -1221,23 +1570,46 @@ class EnergyToFight:
 
 
 class TelegramReporter:
+    """Sends reports to Telegram chat from one long-lived sender thread
+
+    Messages are collected for `batch_delay` seconds after the last one and sent together, split at Telegram's
+    message size limit. Repeated full energy reports and medals are coalesced into counters. Requests to the chat are
+    made at most once per `min_interval` seconds and `retry_after` of rate limited requests is honoured. Messages and
+    photos which couldn't be sent are retried with the next batch with exponential back-off, up to `max_retries` times.
+    """
+
     __initialized: bool = False
-    __queue: List[str]
     chat_id: int = 0
     api_url: str = ""
     player_name: str = ""
+    max_message_length: int = 4096
+    min_interval: float = 3.0
+    batch_delay: int = 20
+    max_retries: int = 5
+    max_retry_delay: int = 600
     __thread_stopper: threading.Event
+    _queue: "queue.Queue[Tuple[str, Any]]"
+    _thread: Optional[threading.Thread]
     _last_time: datetime.datetime
     _last_full_energy_report: datetime.datetime
     _next_time: datetime.datetime
-    _threads: List[threading.Thread]
+    _last_request: float
+    _failed: int
+    _retry_items: List[Tuple[str, Any]]
+    _retries: int
+    _retry_time: datetime.datetime
 
     def __init__(self, stop_event: threading.Event = None):
-        self._threads = []
-        self.__queue = []
+        self._queue = queue.Queue()
+        self._thread = None
         self.__thread_stopper = threading.Event() if stop_event is None else stop_event
         self._last_full_energy_report = self._last_time = utils.good_timedelta(utils.now(), datetime.timedelta(hours=1))
         self._next_time = utils.now()
+        self._last_request = 0.0
+        self._failed = 0
+        self._retry_items = []
+        self._retries = 0
+        self._retry_time = utils.now()
 
     @property
     def as_dict(self):
@@ -1247,9 +1619,11 @@ class TelegramReporter:
             "player": self.player_name,
             "last_time": self._last_time,
             "next_time": self._next_time,
-            "queue": self.__queue,
+            "queue": self._queue.qsize(),
+            "failed": self._failed,
+            "retrying": len(self._retry_items),
             "initialized": self.__initialized,
-            "has_threads": not self._threads,
+            "has_threads": self._thread is not None and self._thread.is_alive(),
         }
 
     def do_init(self, chat_id: int, token: str = None, player_name: str = None):
@@ -1261,34 +1635,37 @@ class TelegramReporter:
         self.__initialized = True
         self._last_time = utils.good_timedelta(utils.now(), datetime.timedelta(minutes=-5))
         self._last_full_energy_report = utils.good_timedelta(utils.now(), datetime.timedelta(minutes=-30))
-        if self.__queue:
+        if not self._queue.empty():
             self.send_message("Telegram initialized")
+        self.__start_sender()
 
-    def send_message(self, message: str) -> bool:
-        self.__queue.append(message)
-        if not self.__initialized:
-            if self._last_time < utils.now():
-                self.__queue.clear()
-            return True
-        self._threads = [t for t in self._threads if t.is_alive()]
-        self._next_time = utils.good_timedelta(utils.now(), datetime.timedelta(seconds=20))
-        if not self._threads:
+    def __start_sender(self):
+        if self._thread is None or not self._thread.is_alive():
             name = f"telegram_{f'{self.player_name}_' if self.player_name else ''}send"
-            send_thread = threading.Thread(target=self.__send_messages, name=name)
-            send_thread.start()
-            self._threads.append(send_thread)
+            self._thread = threading.Thread(target=self.__run_sender, name=name, daemon=True)
+            self._thread.start()
 
+    def __put(self, kind: str, payload: Any) -> bool:
+        if not self.__initialized and self._last_time < utils.now():
+            # Not initialized within an hour - nobody will read these
+            return True
+        self._queue.put((kind, payload))
+        self._next_time = utils.good_timedelta(utils.now(), datetime.timedelta(seconds=self.batch_delay))
+        if self.__initialized:
+            self.__start_sender()
         return True
 
+    def send_message(self, message: str) -> bool:
+        return self.__put("message", message)
+
     def report_full_energy(self, available: int, limit: int, interval: int):
         if (utils.now() - self._last_full_energy_report).total_seconds() >= 30 * 60:
             self._last_full_energy_report = utils.now()
-            message = f"Full energy ({available}hp/{limit}hp +{interval}hp/6min)"
-            self.send_message(message)
+            self.__put("full_energy", f"Full energy ({available}hp/{limit}hp +{interval}hp/6min)")
 
     def report_medal(self, msg, multiple: bool = True):
         new_line = "\n" if multiple else ""
-        self.send_message(f"New award: {new_line}*{msg}*")
+        self.__put("medal", f"New award: {new_line}*{msg}*")
 
     def report_fight(self, battle: "Battle", invader: bool, division: "BattleDivision", damage: float, hits: int):
         side_txt = (battle.invader if invader else battle.defender).country.iso
@@ -1310,33 +1687,120 @@ class TelegramReporter:
             f"[{citizen_id}](https://www.erepublik.com/en/citizen/profile/{citizen_id})"
         )
 
-    def __send_messages(self):
-        while self._next_time > utils.now():
-            if self.__thread_stopper.is_set():
-                break
-            self.__thread_stopper.wait(utils.get_sleep_seconds(self._next_time))
-
-        message = "\n\n".join(self.__queue)
-        if self.player_name:
-            message = f"Player *{self.player_name}*\n\n" + message
-        response = post(
-            f"{self.api_url}/sendMessage", json=dict(chat_id=self.chat_id, text=message, parse_mode="Markdown")
-        )
-        self._last_time = utils.now()
-        if response.json().get("ok"):
-            self.__queue.clear()
-            return True
-        return False
-
     def send_photos(self, photos: List[Tuple[str, BytesIO]]):
+        for photo_title, photo in photos:
+            self.__put("photo", (photo_title, photo))
+
+    def __run_sender(self):
+        while True:
+            stopping = self.__thread_stopper.is_set()
+            items, self._retry_items = self._retry_items, []
+            if not items:
+                try:
+                    items = [self._queue.get(timeout=1)]
+                except queue.Empty:
+                    if stopping:
+                        return
+                    continue
+            # Wait for quiet period, so that bursts are sent together, and for back-off after failed batch
+            send_time = max(self._next_time, self._retry_time)
+            while send_time > utils.now() and not self.__thread_stopper.is_set():
+                self.__thread_stopper.wait(min(utils.get_sleep_seconds(send_time), 1))
+                send_time = max(self._next_time, self._retry_time)
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            failed = self.__send_batch(items)
+            if not failed:
+                self._retries = 0
+            elif self._retries < self.max_retries and not self.__thread_stopper.is_set():
+                self._retries += 1
+                delay = min(self.min_interval * 2**self._retries, self.max_retry_delay)
+                self._retry_time = utils.good_timedelta(utils.now(), datetime.timedelta(seconds=delay))
+                self._retry_items = failed
+            else:
+                self._retries = 0
+                self._failed += len(failed)
+
+    def __send_batch(self, items: List[Tuple[str, Any]]) -> List[Tuple[str, Any]]:
+        """Send messages and photos, return the ones which couldn't be sent"""
+        failed: List[Tuple[str, Any]] = []
+        texts: List[str] = []
+        photos: List[Tuple[str, BytesIO]] = []
+        coalesced: Dict[str, Dict[str, int]] = dict(full_energy={}, medal={})
+        for kind, payload in items:
+            if kind == "photo":
+                photos.append(payload)
+            elif kind in coalesced:
+                coalesced[kind][payload] = coalesced[kind].get(payload, 0) + 1
+            else:
+                texts.append(payload)
+        if coalesced["full_energy"]:
+            # Only the latest energy state matters
+            *_, last = coalesced["full_energy"]
+            count = sum(coalesced["full_energy"].values())
+            texts.append(last if count == 1 else f"{last} (x{count})")
+        for medal, count in coalesced["medal"].items():
+            texts.append(medal if count == 1 else f"{medal} (x{count})")
+
+        header = f"Player *{self.player_name}*\n\n" if self.player_name else ""
+        for part in self._split_message(texts, self.max_message_length - len(header)):
+            if not self.__request(
+                "sendMessage", json=dict(chat_id=self.chat_id, text=header + part, parse_mode="Markdown")
+            ):
+                failed.append(("message", part))
         for photo_title, photo in photos:
             photo.seek(0)
-            post(
-                f"https://{self.api_url}/sendPhoto",
+            if not self.__request(
+                "sendPhoto",
                 data=dict(chat_id=self.chat_id, caption=photo_title),
-                files=[("photo", ("f{utils.slugify(photo_title)}.png", photo))],
-            )
-        return
+                files=[("photo", (f"{utils.slugify(photo_title)}.png", photo))],
+            ):
+                failed.append(("photo", (photo_title, photo)))
+        self._last_time = utils.now()
+        return failed
+
+    @staticmethod
+    def _split_message(texts: List[str], limit: int) -> List[str]:
+        """Join texts into as few messages as possible, none longer than limit"""
+        parts: List[str] = []
+        current = ""
+        for text in texts:
+            while len(text) > limit:
+                if current:
+                    parts.append(current)
+                    current = ""
+                parts.append(text[:limit])
+                text = text[limit:]
+            if current and len(current) + 2 + len(text) > limit:
+                parts.append(current)
+                current = ""
+            current = f"{current}\n\n{text}" if current else text
+        if current:
+            parts.append(current)
+        return parts
+
+    def __request(self, method: str, **kwargs) -> bool:
+        for _ in range(3):
+            wait = self._last_request + self.min_interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                response = post(f"{self.api_url}/{method}", timeout=30, **kwargs)
+                data = response.json()
+            except (RequestException, ValueError):
+                return False
+            finally:
+                self._last_request = time.monotonic()
+            if data.get("ok"):
+                return True
+            retry_after = data.get("parameters", {}).get("retry_after")
+            if not retry_after:
+                return False
+            time.sleep(retry_after)
+        return False
 
 
 class OfferItem(NamedTuple):
@@ -1347,6 +1811,96 @@ class OfferItem(NamedTuple):
     citizen_id: int = 0
 
 
+class StateDiffTracker:
+    """Tracks last reported state and produces changes since then as JSON Patch (RFC 6902) operations. Every
+    `full_every`-th call (and the first one) reports a full snapshot, so receiver can resync.
+
+    State's top level sections are compared by their serialized JSON, only changed sections are diffed.
+    """
+
+    full_every: int
+    version: int
+    _reported: Optional[Dict[str, Any]]
+    _serialized: Dict[str, str]
+    _since_full: int
+
+    def __init__(self, full_every: int = 12):
+        self.full_every = full_every
+        self.reset()
+
+    def reset(self):
+        """Send full snapshot with the next report"""
+        self.version = 0
+        self._reported = None
+        self._serialized = {}
+        self._since_full = 0
+
+    @staticmethod
+    def _escape(key: Any) -> str:
+        return str(key).replace("~", "~0").replace("/", "~1")
+
+    @classmethod
+    def diff(cls, old: Any, new: Any, path: str = "") -> List[Dict[str, Any]]:
+        """JSON Patch operations transforming `old` into `new`. Dicts are compared by key, equally long lists by index,
+        anything else is replaced as a whole.
+        """
+        if type(old) is not type(new):
+            return [dict(op="replace", path=path, value=new)]
+        if isinstance(new, dict):
+            ops = []
+            for key, value in new.items():
+                key_path = f"{path}/{cls._escape(key)}"
+                if key not in old:
+                    ops.append(dict(op="add", path=key_path, value=value))
+                elif old[key] != value:
+                    ops.extend(cls.diff(old[key], value, key_path))
+            ops.extend(dict(op="remove", path=f"{path}/{cls._escape(key)}") for key in old if key not in new)
+            return ops
+        if isinstance(new, list) and len(old) == len(new):
+            ops = []
+            for idx, (old_value, value) in enumerate(zip(old, new)):
+                if old_value != value:
+                    ops.extend(cls.diff(old_value, value, f"{path}/{idx}"))
+            return ops
+        if old != new:
+            return [dict(op="replace", path=path, value=new)]
+        return []
+
+    def changes(self, state: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Changes since last report, None if nothing changed
+
+        :param state: Current state, eg. `Inventory.as_dict`
+        :return: dict(full=True, version=..., state=...) or dict(full=False, base=..., version=..., patch=[...])
+        """
+        serialized = {key: utils.json_dumps(value) for key, value in state.items()}
+        self._since_full += 1
+        if self._reported is None or self._since_full >= self.full_every:
+            state = {key: utils.json.loads(value) for key, value in serialized.items()}
+            self._reported = dict(state)
+            self._serialized = serialized
+            self._since_full = 0
+            self.version += 1
+            return dict(full=True, version=self.version, state=state)
+        patch = []
+        for key, value in serialized.items():
+            if self._serialized.get(key) == value:
+                continue
+            new = utils.json.loads(value)
+            if key in self._reported:
+                patch.extend(self.diff(self._reported[key], new, f"/{self._escape(key)}"))
+            else:
+                patch.append(dict(op="add", path=f"/{self._escape(key)}", value=new))
+            self._reported[key] = new
+        for key in [key for key in self._reported if key not in serialized]:
+            patch.append(dict(op="remove", path=f"/{self._escape(key)}"))
+            del self._reported[key]
+        self._serialized = serialized
+        if not patch:
+            return None
+        self.version += 1
+        return dict(full=False, base=self.version - 1, version=self.version, patch=patch)
+
+
 class Inventory:
     final: types.InvFinal
     active: types.InvFinal
@@ -1355,8 +1909,10 @@ class Inventory:
     market: types.InvRaw
     used: int
     total: int
+    tracker: StateDiffTracker
 
     def __init__(self):
+        self.tracker = StateDiffTracker()
         self.active = {}
         self.final = {}
         self.boosters = {}
@@ -1376,3 +1932,260 @@ class Inventory:
             total=self.total,
             used=self.used,
         )
+
+
+class MarketPriceStats:
+    """Rolling market price history per (industry, quality, country) built from market scans
+
+    For every scanned market cell a ring buffer keeps the best price and volume weighted average price of the top
+    offers, the latest order book is kept for depth calculations. Scans of empty markets update only the scan time and
+    the (empty) order book.
+    """
+
+    size: int
+    depth: int
+    _history: Dict[Tuple[int, int, int], Deque[Tuple[datetime.datetime, float, float]]]
+    _books: Dict[Tuple[int, int, int], List[OfferItem]]
+    _scanned: Dict[Tuple[int, int, int], datetime.datetime]
+
+    def __init__(self, size: int = 96, depth: int = 10):
+        self.size = size
+        self.depth = depth
+        self._history = {}
+        self._books = {}
+        self._scanned = {}
+
+    def add_offers(self, industry: int, quality: int, country_id: int, offers: Iterable[OfferItem]):
+        book = sorted(offers, key=lambda o: (o.price, -o.amount))[: self.depth]
+        key = (industry, quality, country_id)
+        self._scanned[key] = utils.now()
+        self._books[key] = book
+        if not book:
+            return
+        if key not in self._history:
+            self._history[key] = deque(maxlen=self.size)
+        self._history[key].append((self._scanned[key], book[0].price, self._vwap(book)))
+
+    def last_update(self, industry: int, quality: int, country_id: int) -> Optional[datetime.datetime]:
+        return self._scanned.get((industry, quality, country_id))
+
+    def best_offer(self, industry: int, quality: int, country_id: int) -> Optional[OfferItem]:
+        book = self._books.get((industry, quality, country_id))
+        return book[0] if book else None
+
+    def percentile(self, industry: int, quality: int, country_id: int, percent: float = 50) -> Optional[float]:
+        """Percentile of best prices over rolling history, linearly interpolated"""
+        history = self._history.get((industry, quality, country_id))
+        if not history:
+            return None
+        prices = sorted(price for _, price, _ in history)
+        rank = (len(prices) - 1) * min(max(percent, 0), 100) / 100
+        lower = int(rank)
+        upper = min(lower + 1, len(prices) - 1)
+        return prices[lower] + (prices[upper] - prices[lower]) * (rank - lower)
+
+    def vwap(self, industry: int, quality: int, country_id: int, depth: int = None) -> Optional[float]:
+        """Volume weighted average price of the top `depth` offers of the latest scan"""
+        book = self._books.get((industry, quality, country_id))
+        if not book:
+            return None
+        return self._vwap(book[:depth] if depth else book)
+
+    def global_min(self, industry: int, quality: int) -> Optional[float]:
+        prices = [book[0].price for (i, q, _), book in self._books.items() if book and i == industry and q == quality]
+        return min(prices) if prices else None
+
+    def spread(self, industry: int, quality: int, country_id: int) -> Optional[float]:
+        """Difference between the country's best price and the lowest price seen in any country"""
+        best = self.best_offer(industry, quality, country_id)
+        if best is None:
+            return None
+        return best.price - self.global_min(industry, quality)
+
+    @staticmethod
+    def _vwap(book: List[OfferItem]) -> float:
+        amount = sum(o.amount for o in book)
+        if not amount:
+            return book[0].price
+        return sum(o.price * o.amount for o in book) / amount
+
+    @property
+    def as_dict(self) -> Dict[str, Union[int, List[Dict[str, Union[int, float, datetime.datetime]]]]]:
+        return dict(
+            size=self.size,
+            depth=self.depth,
+            cells=[
+                dict(industry=i, quality=q, country=c, updated=h[-1][0], best=h[-1][1], vwap=h[-1][2], samples=len(h))
+                for (i, q, c), h in self._history.items()
+            ],
+        )
+
+
+class RWLock:
+    """Reentrant reader/writer lock with contention metrics
+
+    Any number of threads may hold the read lock, the write lock is exclusive. The thread holding the write lock may
+    acquire it again and may also acquire the read lock. Waiting writers block new readers, except threads which are
+    already reading, so read reentrancy can't deadlock. Upgrading read lock to write lock is not supported.
+    """
+
+    name: str
+    holder: Optional[str]
+    acquisitions: int
+    contentions: int
+    timeouts: int
+    wait_time: float
+    max_wait: float
+
+    def __init__(self, name: str):
+        self.name = name
+        self._cond = threading.Condition(threading.Lock())
+        self._readers: Dict[int, int] = {}
+        self._writer: Optional[int] = None
+        self._writer_depth = 0
+        self._writers_waiting = 0
+        self.holder = None
+        self.acquisitions = self.contentions = self.timeouts = 0
+        self.wait_time = self.max_wait = 0.0
+
+    def _wait(self, predicate, timeout: Optional[float]) -> bool:
+        if predicate():
+            return True
+        self.contentions += 1
+        start = time.monotonic()
+        acquired = self._cond.wait_for(predicate, timeout)
+        waited = time.monotonic() - start
+        self.wait_time += waited
+        self.max_wait = max(self.max_wait, waited)
+        if not acquired:
+            self.timeouts += 1
+        return acquired
+
+    def acquire_read(self, timeout: float = None) -> bool:
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me or me in self._readers:
+                self._readers[me] = self._readers.get(me, 0) + 1
+                return True
+            if not self._wait(lambda: self._writer is None and not self._writers_waiting, timeout):
+                return False
+            self._readers[me] = 1
+            self.acquisitions += 1
+            return True
+
+    def release_read(self):
+        me = threading.get_ident()
+        with self._cond:
+            if me not in self._readers:
+                raise RuntimeError(f"Read lock '{self.name}' released by thread which is not holding it")
+            self._readers[me] -= 1
+            if not self._readers[me]:
+                del self._readers[me]
+                self._cond.notify_all()
+
+    def acquire_write(self, timeout: float = None) -> bool:
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._writer_depth += 1
+                return True
+            if me in self._readers:
+                raise RuntimeError(f"Unable to upgrade read lock '{self.name}' to write lock")
+            self._writers_waiting += 1
+            try:
+                if not self._wait(lambda: self._writer is None and not self._readers, timeout):
+                    return False
+            finally:
+                self._writers_waiting -= 1
+            self._writer = me
+            self._writer_depth = 1
+            self.holder = threading.current_thread().name
+            self.acquisitions += 1
+            return True
+
+    def release_write(self):
+        with self._cond:
+            if self._writer != threading.get_ident():
+                raise RuntimeError(f"Write lock '{self.name}' released by thread which is not holding it")
+            self._writer_depth -= 1
+            if not self._writer_depth:
+                self._writer = self.holder = None
+                self._cond.notify_all()
+
+    @property
+    def locked(self) -> bool:
+        return self._writer is not None or bool(self._readers)
+
+    @property
+    def as_dict(self) -> Dict[str, Union[str, int, float, bool, None]]:
+        return dict(
+            name=self.name,
+            locked=self.locked,
+            holder=self.holder,
+            readers=len(self._readers),
+            acquisitions=self.acquisitions,
+            contentions=self.contentions,
+            timeouts=self.timeouts,
+            wait_time=round(self.wait_time, 3),
+            max_wait=round(self.max_wait, 3),
+        )
+
+
+class LockManager:
+    """Named per-resource reader/writer locks
+
+    Locks are created on first use. When several resources are requested at once they are acquired in one global
+    order - resources listed in `priority` first, the rest sorted - so threads can't deadlock as long as they take
+    nested locks only on resources later in that order.
+    """
+
+    _locks: Dict[str, RWLock]
+    priority: Tuple[str, ...]
+
+    def __init__(self, priority: Tuple[str, ...] = ()):
+        self._locks = {}
+        self._guard = threading.Lock()
+        self.priority = tuple(priority)
+
+    def _order(self, name: str) -> Tuple[int, str]:
+        return (self.priority.index(name) if name in self.priority else len(self.priority)), name
+
+    def get(self, name: str) -> RWLock:
+        with self._guard:
+            if name not in self._locks:
+                self._locks[name] = RWLock(name)
+            return self._locks[name]
+
+    @contextmanager
+    def _acquire(self, names: Tuple[str, ...], write: bool, timeout: Optional[float]):
+        acquired: List[RWLock] = []
+        try:
+            for name in sorted(set(names), key=self._order):
+                lock = self.get(name)
+                if not (lock.acquire_write(timeout) if write else lock.acquire_read(timeout)):
+                    holder = f" (held by {lock.holder})" if lock.holder else ""
+                    raise LockTimeoutError(f"Lock '{name}' not freed in {timeout}sec{holder}!")
+                acquired.append(lock)
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release_write() if write else lock.release_read()
+
+    def read(self, *names: str, timeout: float = None):
+        """Context manager holding shared locks for given resources
+
+        :raises LockTimeoutError: if any of locks is not acquired in `timeout` seconds
+        """
+        return self._acquire(names, False, timeout)
+
+    def write(self, *names: str, timeout: float = None):
+        """Context manager holding exclusive locks for given resources
+
+        :raises LockTimeoutError: if any of locks is not acquired in `timeout` seconds
+        """
+        return self._acquire(names, True, timeout)
+
+    @property
+    def as_dict(self) -> Dict[str, Dict[str, Union[str, int, float, bool, None]]]:
+        with self._guard:
+            return {name: lock.as_dict for name, lock in self._locks.items()}
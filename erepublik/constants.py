@@ -75,6 +75,7 @@ class Industries:
         "ticket": 3,
         "house": 4,
         "aircraft": 23,
+        "airplane": 23,
         "foodraw": 7,
         "weaponraw": 12,
         "houseraw": 18,
@@ -0,0 +1,148 @@
+import datetime
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from erepublik import utils
+
+__all__ = ["ActionEvent", "ActionJournal", "EventBus"]
+
+
+class ActionEvent(NamedTuple):
+    """Action taken by citizen, `msg` is the human readable message (if any), `value` is reported along `kwargs`"""
+
+    action: str
+    time: datetime.datetime
+    eday: int
+    citizen_id: int = 0
+    msg: Optional[str] = None
+    kwargs: Dict[str, Any] = {}
+    value: Any = None
+    duration: Optional[float] = None
+
+    @property
+    def as_dict(self) -> Dict[str, Any]:
+        return self._asdict()
+
+
+Sink = Callable[[ActionEvent], None]
+
+
+class EventBus:
+    """Delivers published events to subscribed sinks from a background thread
+
+    Publishing only puts the event in a queue. Sinks are called in the order of subscription, an exception in one
+    sink is passed to `on_error` and doesn't stop the others. The thread is started on first publish and finishes
+    delivering queued events before it exits when `stop_event` is set.
+    """
+
+    _sinks: List[Tuple[Sink, Optional[frozenset]]]
+
+    def __init__(self, stop_event: threading.Event = None, on_error: Callable[[Sink, Exception], None] = None):
+        self.stop_event = stop_event or threading.Event()
+        self.on_error = on_error
+        self._sinks = []
+        self._queue: "queue.Queue[ActionEvent]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def subscribe(self, sink: Sink, actions: List[str] = None):
+        """Add sink, if `actions` are given, only these actions are delivered to it"""
+        with self._lock:
+            self._sinks.append((sink, frozenset(actions) if actions else None))
+
+    def unsubscribe(self, sink: Sink):
+        with self._lock:
+            self._sinks = [(s, actions) for s, actions in self._sinks if s != sink]
+
+    def publish(self, event: ActionEvent):
+        self._queue.put(event)
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="event_bus", daemon=True)
+                self._thread.start()
+
+    def flush(self, timeout: float = None):
+        """Block until all published events are delivered"""
+        if timeout is None:
+            self._queue.join()
+            return
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    def _deliver(self, event: ActionEvent):
+        with self._lock:
+            sinks = list(self._sinks)
+        for sink, actions in sinks:
+            if actions is not None and event.action not in actions:
+                continue
+            try:
+                sink(event)
+            except Exception as e:  # noqa
+                if self.on_error is not None:
+                    self.on_error(sink, e)
+
+    def _run(self):
+        while True:
+            try:
+                event = self._queue.get(timeout=1)
+            except queue.Empty:
+                if self.stop_event.is_set():
+                    return
+                continue
+            try:
+                self._deliver(event)
+            finally:
+                self._queue.task_done()
+
+
+class ActionJournal:
+    """Appends events to JSONL file, rotating it when it grows over `max_bytes` (`actions.jsonl.1` is the previous)"""
+
+    def __init__(self, filename: str = "log/actions.jsonl", max_bytes: int = 10 * 1024 * 1024, backup_count: int = 5):
+        self.path = Path(filename)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._lock = threading.Lock()
+
+    def _backup(self, idx: int) -> Path:
+        return self.path.with_name(f"{self.path.name}.{idx}")
+
+    def _rotate(self):
+        for idx in range(self.backup_count - 1, 0, -1):
+            if self._backup(idx).exists():
+                self._backup(idx).replace(self._backup(idx + 1))
+        if self.backup_count:
+            self.path.replace(self._backup(1))
+        else:
+            self.path.unlink()
+
+    def write(self, event: ActionEvent):
+        line = utils.json_dumps(dict(event.as_dict, time=event.time.isoformat())) + "\n"
+        with self._lock:
+            if self.path.exists() and self.path.stat().st_size + len(line) > self.max_bytes:
+                self._rotate()
+            with self.path.open("a", encoding="utf-8") as f:
+                f.write(line)
+
+    __call__ = write
+
+    def read(self, action: str = None, since: datetime.datetime = None) -> Iterator[Dict[str, Any]]:
+        """Journal entries from the oldest to the newest, optionally filtered by action and time"""
+        files = [self._backup(idx) for idx in range(self.backup_count, 0, -1)] + [self.path]
+        for path in files:
+            if not path.exists():
+                continue
+            with path.open(encoding="utf-8") as f:
+                for line in f:
+                    entry = utils.json_loads(line)
+                    if action is not None and entry["action"] != action:
+                        continue
+                    entry["time"] = datetime.datetime.fromisoformat(entry["time"])
+                    if since is not None and entry["time"] < since:
+                        continue
+                    yield entry
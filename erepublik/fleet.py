@@ -0,0 +1,197 @@
+import multiprocessing
+import os
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from erepublik import utils
+from erepublik.access_points import SlowRequests
+from erepublik.citizen import Citizen
+from erepublik.classes import ErepublikException
+
+__all__ = ["FleetSupervisor", "SharedThrottle"]
+
+
+class SharedThrottle:
+    """Request throttle shared between processes - keeps the next allowed request time in shared memory, so all
+    workers together don't start requests more often than once per interval, but at least `min_interval` apart.
+    Plug into `SlowRequests.throttle`.
+    """
+
+    min_interval: float
+
+    def __init__(self, min_interval: float = 0):
+        self.min_interval = min_interval
+        self._next_time = multiprocessing.Value("d", 0.0, lock=False)
+        self._lock = multiprocessing.Lock()
+
+    def wait(self, interval: float):
+        """Reserve the next request slot and sleep until it"""
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next_time.value)
+            self._next_time.value = start + max(interval, self.min_interval)
+        if start > now:
+            time.sleep(start - now)
+
+
+def _dump_filename(dump_dir: Path, account: Dict[str, Any]) -> Path:
+    return dump_dir / f"{utils.slugify(account['email'])}.snapshot"
+
+
+def _run_worker(
+    accounts: List[Dict[str, Any]],
+    throttle: SharedThrottle,
+    stop_event: multiprocessing.Event,
+    dump_dir: str,
+    dump_interval: int,
+    target: Callable[[Citizen], None],
+):
+    # Worker process runs only fleet citizens - throttle every session from the first request (login or resume)
+    SlowRequests.throttle = throttle
+    dump_path = Path(dump_dir)
+    players: List[Citizen] = []
+    threads: List[threading.Thread] = []
+    for account in accounts:
+        filename = _dump_filename(dump_path, account)
+        player = None
+        if filename.exists():
+            try:
+                player = Citizen.load_from_snapshot(str(filename))
+            except (zlib.error, ValueError, KeyError, ErepublikException):
+                # Corrupted or outdated snapshot, log in anew
+                player = None
+        if player is None:
+            player = Citizen(account["email"], account["password"])
+            player.config_setup(**{k: v for k, v in account.items() if k not in ["email", "password"]})
+            player.config.email = account["email"]
+            player.config.password = account["password"]
+            player.login()
+        thread = threading.Thread(target=target, args=(player,), name=f"{player.name}-main", daemon=True)
+        thread.start()
+        players.append(player)
+        threads.append(thread)
+
+    while not stop_event.wait(dump_interval):
+        for player in players:
+            player.save_snapshot(str(_dump_filename(dump_path, dict(email=player.config.email))))
+
+    for player in players:
+        player.set_locks()
+    for thread in threads:
+        thread.join(60)
+    for player in players:
+        player.save_snapshot(str(_dump_filename(dump_path, dict(email=player.config.email))))
+
+
+class FleetSupervisor:
+    """Shards accounts across worker processes (one per core by default) which share one request throttle.
+
+    Each worker logs in (or restores from its snapshot) its accounts and runs `target(player)` for each of them in a
+    thread. Workers snapshot their citizens every `dump_interval` seconds, a crashed or restarted worker is restored
+    from these snapshots without a request storm.
+    """
+
+    accounts: List[Dict[str, Any]]
+    workers: int
+    dump_dir: Path
+    restart_delay: int
+    healthy_time: int
+    _processes: Dict[int, multiprocessing.Process]
+    _restarts: Dict[int, int]
+    _started: Dict[int, float]
+
+    def __init__(
+        self,
+        accounts: List[Dict[str, Any]],
+        workers: int = None,
+        target: Callable[[Citizen], None] = Citizen.state_update_repeater,
+        dump_dir: str = "dumps",
+        dump_interval: int = 600,
+        request_interval: float = 0.5,
+        restart_delay: int = 30,
+        healthy_time: int = 600,
+    ):
+        """
+        :param accounts: Account configs - email, password and any `Config` attribute
+        :param workers: Number of worker processes, defaults to CPU count
+        :param target: Function running a citizen until its `stop_threads` is set
+        :param dump_dir: Directory for citizen snapshots
+        :param dump_interval: Seconds between snapshots
+        :param request_interval: Min seconds between requests of the whole fleet
+        :param restart_delay: Seconds to wait before restarting crashed worker, doubled on every consecutive crash
+        :param healthy_time: Seconds a worker has to run for its crashes not to count as consecutive anymore
+        """
+        self.accounts = accounts
+        self.workers = max(1, min(workers or os.cpu_count() or 1, len(accounts)))
+        self.target = target
+        self.dump_dir = Path(dump_dir)
+        self.dump_interval = dump_interval
+        self.request_interval = request_interval
+        self.restart_delay = restart_delay
+        self.healthy_time = healthy_time
+        self.throttle = SharedThrottle(request_interval)
+        self.stop_event = multiprocessing.Event()
+        self._processes = {}
+        self._restarts = {}
+        self._started = {}
+
+    @property
+    def shards(self) -> List[List[Dict[str, Any]]]:
+        return [self.accounts[idx :: self.workers] for idx in range(self.workers)]
+
+    def _start_worker(self, shard_id: int):
+        process = multiprocessing.Process(
+            target=_run_worker,
+            args=(
+                self.shards[shard_id],
+                self.throttle,
+                self.stop_event,
+                str(self.dump_dir),
+                self.dump_interval,
+                self.target,
+            ),
+            name=f"erepublik-worker-{shard_id}",
+        )
+        process.start()
+        self._processes[shard_id] = process
+        self._started[shard_id] = time.time()
+
+    def start(self):
+        self.dump_dir.mkdir(parents=True, exist_ok=True)
+        for shard_id in range(self.workers):
+            self._start_worker(shard_id)
+
+    def supervise(self, check_interval: int = 10):
+        """Restart crashed workers until `stop()` is called"""
+        next_start: Dict[int, float] = {}
+        while not self.stop_event.wait(check_interval):
+            for shard_id, process in list(self._processes.items()):
+                if process.is_alive():
+                    if self._restarts.get(shard_id) and time.time() - self._started[shard_id] >= self.healthy_time:
+                        self._restarts[shard_id] = 0
+                    continue
+                if shard_id not in next_start:
+                    self._restarts[shard_id] = self._restarts.get(shard_id, 0) + 1
+                    delay = self.restart_delay * 2 ** min(self._restarts[shard_id] - 1, 6)
+                    next_start[shard_id] = time.time() + delay
+                if next_start[shard_id] <= time.time():
+                    del next_start[shard_id]
+                    self._start_worker(shard_id)
+
+    def stop(self, timeout: Optional[float] = 120):
+        self.stop_event.set()
+        for process in self._processes.values():
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+
+    @property
+    def as_dict(self) -> Dict[str, Any]:
+        return dict(
+            workers=self.workers,
+            alive={shard_id: process.is_alive() for shard_id, process in self._processes.items()},
+            restarts=self._restarts,
+        )
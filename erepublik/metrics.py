@@ -0,0 +1,211 @@
+import functools
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+from urllib.parse import urlparse
+
+__all__ = ["DEFAULT_BUCKETS", "MetricsRegistry", "REGISTRY", "endpoint_name", "start_metrics_server", "timed"]
+
+#: Latency histogram buckets in seconds
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+LabelsKey = Tuple[Tuple[str, str], ...]
+
+
+def _labels_key(labels: Dict[str, Any]) -> LabelsKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key: LabelsKey, **extra: str) -> str:
+    items = list(key) + list(extra.items())
+    if not items:
+        return ""
+    escaped = (k + '="' + v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"' for k, v in items)
+    return "{" + ",".join(escaped) + "}"
+
+
+def endpoint_name(url: str) -> str:
+    """Url path without language and ids, so that every endpoint gets a single time series
+
+    >>> endpoint_name("https://www.erepublik.com/en/military/battlefield/12345?param=1")
+    '/military/battlefield/:id'
+    """
+    path = urlparse(url).path
+    path = re.sub(r"^/[a-z]{2}(?=/|$)", "", path)
+    path = re.sub(r"/\d+(?=/|$)", "/:id", path)
+    return path or "/"
+
+
+class _Histogram:
+    __slots__ = ["buckets", "counts", "sum", "count"]
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[idx] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """Thread-safe counters and histograms identified by name and labels
+
+    Counters are increased with `inc()`, histograms are filled with `observe()` or `time()`. Values are read with
+    `get()`, `as_dict` and `to_prometheus()` - the latter is what `start_metrics_server` exposes.
+    """
+
+    _counters: Dict[str, Dict[LabelsKey, float]]
+    _histograms: Dict[str, Dict[LabelsKey, _Histogram]]
+    _help: Dict[str, str]
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name: str, help_text: str):
+        self._help[name] = help_text
+
+    def inc(self, name: str, value: Union[int, float] = 1, **labels):
+        key = _labels_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = _labels_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = _Histogram(self.buckets)
+            series[key].observe(value)
+
+    def time(self, name: str, **labels) -> "_Timer":
+        """Context manager observing its run time in seconds"""
+        return _Timer(self, name, labels)
+
+    def get(self, name: str, **labels) -> Optional[Union[float, Dict[str, float]]]:
+        """Counter value or histogram's count and sum, None if nothing has been recorded"""
+        key = _labels_key(labels)
+        with self._lock:
+            if key in self._counters.get(name, {}):
+                return self._counters[name][key]
+            histogram = self._histograms.get(name, {}).get(key)
+            if histogram is not None:
+                return dict(count=histogram.count, sum=histogram.sum)
+        return None
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    @property
+    def as_dict(self) -> Dict[str, List[Dict[str, Any]]]:
+        ret: Dict[str, List[Dict[str, Any]]] = {}
+        with self._lock:
+            for name, series in self._counters.items():
+                ret[name] = [dict(labels=dict(key), value=value) for key, value in series.items()]
+            for name, series in self._histograms.items():
+                ret[name] = [dict(labels=dict(key), count=h.count, sum=h.sum) for key, h in series.items()]
+        return ret
+
+    def to_prometheus(self) -> str:
+        """Metrics in Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} counter")
+                for key, value in sorted(series.items()):
+                    lines.append(f"{name}{_format_labels(key)} {value}")
+            for name, series in sorted(self._histograms.items()):
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} histogram")
+                for key, histogram in sorted(series.items()):
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f"{name}_bucket{_format_labels(key, le=str(bound))} {count}")
+                    lines.append(f"{name}_bucket{_format_labels(key, le='+Inf')} {histogram.count}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {histogram.sum}")
+                    lines.append(f"{name}_count{_format_labels(key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+class _Timer:
+    def __init__(self, registry: MetricsRegistry, name: str, labels: Dict[str, Any]):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self._start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.registry.observe(self.name, time.monotonic() - self._start, **self.labels)
+
+
+#: Process wide registry used by requests and citizen actions
+REGISTRY = MetricsRegistry()
+REGISTRY.describe("erepublik_requests_total", "Requests by endpoint, method and status class")
+REGISTRY.describe("erepublik_request_seconds", "Request latency by endpoint and method")
+REGISTRY.describe("erepublik_request_bytes_total", "Request and response body bytes by endpoint and direction")
+REGISTRY.describe("erepublik_throttle_seconds_total", "Time requests spent waiting for throttle")
+REGISTRY.describe("erepublik_request_retries_total", "Request retries by endpoint and reason")
+REGISTRY.describe("erepublik_csrf_refreshes_total", "CSRF token refreshes")
+REGISTRY.describe("erepublik_action_seconds", "Citizen action run time")
+
+
+def timed(action: str, registry: MetricsRegistry = REGISTRY) -> Callable:
+    """Decorator recording the run time of citizen action into `erepublik_action_seconds`"""
+
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with registry.time("erepublik_action_seconds", action=action):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def start_metrics_server(
+    port: int = 9105, host: str = "127.0.0.1", registry: MetricsRegistry = REGISTRY
+) -> ThreadingHTTPServer:
+    """Serve metrics in Prometheus text format on `http://host:port/metrics` from a daemon thread
+
+    :return: Server, call its `shutdown()` to stop
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):  # noqa
+            if self.path.split("?")[0] not in ["/", "/metrics"]:
+                self.send_error(404)
+                return
+            body = registry.to_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics_server", daemon=True).start()
+    return server
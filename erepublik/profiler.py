@@ -0,0 +1,138 @@
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from types import FrameType
+from typing import Dict, Optional
+
+from erepublik import utils
+
+__all__ = ["SamplingProfiler"]
+
+
+def _frame_label(frame: FrameType) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ":")
+
+
+class SamplingProfiler:
+    """Samples stacks of all threads every `interval` seconds and writes them in collapsed stack format
+
+    Output is written to `output_dir/profile_<date>_<hour>.folded` once per hour (open with speedscope, flamegraph.pl
+    or inferno). `snapshot()` - also triggered by `signum` if the signal handler is installed - writes the current
+    hour's stacks right away. Stops when `stop()` is called or `stop_event` is set, writing out what it has.
+    """
+
+    interval: float
+    output_dir: Path
+    samples: int
+    _stacks: Counter
+
+    def __init__(self, interval: float = 0.01, output_dir: str = "log/profile", stop_event: threading.Event = None):
+        self.interval = interval
+        self.output_dir = Path(output_dir)
+        self.stop_event = stop_event or threading.Event()
+        self.samples = 0
+        self._stacks = Counter()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._snapshot_requested = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._hour = self._current_hour()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def as_dict(self) -> Dict[str, object]:
+        return dict(running=self.running, interval=self.interval, samples=self.samples, output_dir=self.output_dir)
+
+    @staticmethod
+    def _current_hour() -> str:
+        return utils.now().strftime("%Y-%m-%d_%H")
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling_profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def install_signal_handler(self, signum: int = None):
+        """Request snapshot on signal, must be called from the main thread
+
+        :param signum: Signal to handle, defaults to SIGUSR1 - must be given where SIGUSR1 doesn't exist (Windows)
+        """
+        if signum is None:
+            signum = getattr(signal, "SIGUSR1", None)
+            if signum is None:
+                raise ValueError("SIGUSR1 is not available on this platform, signal must be given explicitly")
+        signal.signal(signum, lambda *_: self._snapshot_requested.set())
+
+    def sample(self):
+        """Add the current stack of every other thread"""
+        own_id = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        frames = sys._current_frames()
+        with self._lock:
+            for thread_id, frame in frames.items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)).replace(";", ":"))
+                self._stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self) -> str:
+        """Current hour's stacks in collapsed stack format"""
+        with self._lock:
+            return "".join(f"{stack} {count}\n" for stack, count in self._stacks.most_common())
+
+    def _write(self, filename: str) -> Path:
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        path = self.output_dir / filename
+        with path.open("a", encoding="utf-8") as f:
+            f.write(self.collapsed())
+        return path
+
+    def snapshot(self) -> Path:
+        """Write current hour's stacks to a separate file"""
+        return self._write(f"profile_snapshot_{utils.now().strftime('%Y-%m-%d_%H-%M-%S')}.folded")
+
+    def rotate(self) -> Optional[Path]:
+        """Append collected stacks to the hourly file and start collecting anew"""
+        path = self._write(f"profile_{self._hour}.folded") if self._stacks else None
+        with self._lock:
+            self._stacks.clear()
+        self._hour = self._current_hour()
+        return path
+
+    def _run(self):
+        next_sample = time.monotonic()
+        while not (self._stop.is_set() or self.stop_event.is_set()):
+            self.sample()
+            if self._snapshot_requested.is_set():
+                self._snapshot_requested.clear()
+                self.snapshot()
+            if self._current_hour() != self._hour:
+                self.rotate()
+            next_sample += self.interval
+            delay = next_sample - time.monotonic()
+            if delay < 0:
+                # Fell behind (eg. GIL held by a long task), don't try to catch up
+                next_sample = time.monotonic()
+                delay = 0
+            self._stop.wait(delay)
+        self.rotate()
@@ -0,0 +1,197 @@
+import heapq
+import itertools
+import threading
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from erepublik import utils
+
+__all__ = ["Scheduler", "Task"]
+
+
+class Task:
+    """Scheduled task. Task function returns the next time it must run or None when it is done."""
+
+    name: str
+    func: Callable[[], Optional[datetime]]
+    run_at: datetime
+    after: Tuple[str, ...]
+    cancelled: bool
+    runs: int
+    last_run: Optional[datetime]
+
+    def __init__(self, name: str, func: Callable[[], Optional[datetime]], run_at: datetime, after: Iterable[str] = ()):
+        self.name = name
+        self.func = func
+        self.run_at = run_at
+        self.after = tuple(after)
+        self.cancelled = False
+        self.runs = 0
+        self.last_run = None
+        self._seq = -1
+
+    def __repr__(self):
+        return f"<Task {self.name} at {self.run_at.strftime('%F %T')}>"
+
+    @property
+    def as_dict(self) -> Dict[str, object]:
+        return dict(name=self.name, run_at=self.run_at, after=self.after, runs=self.runs, last_run=self.last_run)
+
+
+class Scheduler:
+    """Heap of timed tasks which can be shared between several citizens
+
+    Tasks are run in the thread calling `run()` (or `run_pending()`), one at a time, in order of their run time. A task
+    which lists other task names in `after` is also run right after any of those tasks has been run successfully - eg.
+    work overtime after work. `run()` sleeps until the earliest task is due, waking up early if tasks are added or
+    rescheduled, and returns as soon as `stop_event` is set.
+    """
+
+    stop_event: threading.Event
+    retry_delay: timedelta
+    _heap: List[Tuple[datetime, int, Task]]
+    _tasks: Dict[str, Task]
+
+    def __init__(
+        self,
+        stop_event: threading.Event = None,
+        on_error: Callable[[Task, Exception], None] = None,
+        retry_delay: timedelta = timedelta(minutes=5),
+    ):
+        """
+        :param stop_event: Event to stop the scheduler, usually `Citizen.stop_threads`
+        :param on_error: Called with task and exception if task raises, task is retried after `retry_delay`
+        :param retry_delay: Delay before failed task is run again
+        """
+        self.stop_event = stop_event or threading.Event()
+        self.on_error = on_error
+        self.retry_delay = retry_delay
+        self._heap = []
+        self._tasks = {}
+        self._counter = itertools.count()
+        self._lock = threading.RLock()
+        self._wakeup = threading.Event()
+
+    def _push(self, task: Task):
+        task._seq = next(self._counter)
+        heapq.heappush(self._heap, (task.run_at, task._seq, task))
+        self._wakeup.set()
+
+    def add(
+        self,
+        name: str,
+        func: Callable[[], Optional[datetime]],
+        run_at: datetime = None,
+        after: Iterable[str] = (),
+    ) -> Task:
+        """Add task, task with the same name is replaced
+
+        :param name: Unique task name, eg. prefixed with citizen name if scheduler is shared
+        :param func: Task function, returns next run time or None if task is done
+        :param run_at: First run time, defaults to now
+        :param after: Names of tasks after which this task must run
+        """
+        task = Task(name, func, run_at or utils.now(), after)
+        with self._lock:
+            self.cancel(name)
+            self._tasks[name] = task
+            self._push(task)
+        return task
+
+    def cancel(self, name: str) -> bool:
+        with self._lock:
+            task = self._tasks.pop(name, None)
+            if task is None:
+                return False
+            task.cancelled = True
+            self._wakeup.set()
+            return True
+
+    def reschedule(self, name: str, run_at: datetime) -> bool:
+        with self._lock:
+            task = self._tasks.get(name)
+            if task is None:
+                return False
+            task.run_at = run_at
+            self._push(task)
+            return True
+
+    @property
+    def tasks(self) -> List[Task]:
+        with self._lock:
+            return sorted(self._tasks.values(), key=lambda t: t.run_at)
+
+    def next_run_time(self) -> Optional[datetime]:
+        with self._lock:
+            while self._heap:
+                run_at, seq, task = self._heap[0]
+                if task.cancelled or task._seq != seq:
+                    # Stale entry of cancelled or rescheduled task
+                    heapq.heappop(self._heap)
+                    continue
+                return run_at
+            return None
+
+    def _pop_due(self, now: datetime) -> Optional[Task]:
+        with self._lock:
+            run_at = self.next_run_time()
+            if run_at is None or run_at > now:
+                return None
+            return heapq.heappop(self._heap)[2]
+
+    def _run_task(self, task: Task):
+        task.runs += 1
+        task.last_run = utils.now()
+        succeeded = False
+        try:
+            next_time = task.func()
+            succeeded = True
+        except Exception as e:  # noqa
+            if self.on_error is not None:
+                self.on_error(task, e)
+            next_time = utils.good_timedelta(utils.now(), self.retry_delay)
+        with self._lock:
+            if task.cancelled:
+                return
+            if next_time is None:
+                self._tasks.pop(task.name, None)
+            else:
+                task.run_at = next_time
+                self._push(task)
+            if not succeeded:
+                return
+            now = utils.now()
+            for dependant in self._tasks.values():
+                if task.name in dependant.after and dependant.run_at > now:
+                    dependant.run_at = now
+                    self._push(dependant)
+
+    def run_pending(self) -> Optional[datetime]:
+        """Run all due tasks without waiting
+
+        :return: Next run time or None if there are no tasks left
+        """
+        while not self.stop_event.is_set():
+            task = self._pop_due(utils.now())
+            if task is None:
+                break
+            self._run_task(task)
+        return self.next_run_time()
+
+    def run(self, poll_interval: float = 1.0):
+        """Run tasks until `stop_event` is set or no tasks are left
+
+        :param poll_interval: Max seconds between `stop_event` checks
+        """
+        while not self.stop_event.is_set():
+            self._wakeup.clear()
+            next_time = self.run_pending()
+            if next_time is None:
+                break
+            sleep_seconds = (next_time - utils.now()).total_seconds()
+            if sleep_seconds > 0:
+                self._wakeup.wait(min(sleep_seconds, poll_interval))
+
+    def stop(self):
+        self.stop_event.set()
+        self._wakeup.set()
@@ -0,0 +1,221 @@
+import contextvars
+import functools
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from erepublik import utils
+
+__all__ = ["JsonlExporter", "OtlpJsonExporter", "Span", "TRACER", "Tracer", "span", "traced"]
+
+
+class Span:
+    """Timed operation with attributes, child spans share their root span's `trace_id`"""
+
+    __slots__ = ["name", "trace_id", "span_id", "parent_id", "start", "end", "attributes", "error"]
+
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str]
+    start: float
+    end: Optional[float]
+    attributes: Dict[str, Any]
+    error: Optional[str]
+
+    def __init__(self, name: str, parent: "Span" = None, attributes: Dict[str, Any] = None):
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.trace_id = parent.trace_id if parent is not None else os.urandom(16).hex()
+        self.parent_id = parent.span_id if parent is not None else None
+        self.start = time.time()
+        self.end = None
+        self.attributes = dict(attributes or {})
+        self.error = None
+
+    def __repr__(self):
+        return f"<Span {self.name} {self.duration:.3f}s>"
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.time()) - self.start
+
+    @property
+    def as_dict(self) -> Dict[str, Any]:
+        return dict(
+            name=self.name,
+            trace_id=self.trace_id,
+            span_id=self.span_id,
+            parent_id=self.parent_id,
+            start=self.start,
+            end=self.end,
+            duration=self.duration,
+            attributes=self.attributes,
+            error=self.error,
+        )
+
+    @property
+    def as_otlp(self) -> Dict[str, Any]:
+        ret = dict(
+            traceId=self.trace_id,
+            spanId=self.span_id,
+            name=self.name,
+            kind=1,
+            startTimeUnixNano=str(int(self.start * 1e9)),
+            endTimeUnixNano=str(int((self.end or time.time()) * 1e9)),
+            attributes=[dict(key=k, value=_otlp_value(v)) for k, v in self.attributes.items()],
+            status=dict(code=2, message=self.error) if self.error else dict(code=1),
+        )
+        if self.parent_id:
+            ret.update(parentSpanId=self.parent_id)
+        return ret
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return dict(boolValue=value)
+    if isinstance(value, int):
+        return dict(intValue=str(value))
+    if isinstance(value, float):
+        return dict(doubleValue=value)
+    return dict(stringValue=str(value))
+
+
+class JsonlExporter:
+    """Appends every span of finished trace to a file as a JSON line"""
+
+    def __init__(self, filename: str = "log/traces.jsonl"):
+        self.path = Path(filename)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def _lines(self, spans: List[Span]) -> List[str]:
+        return [utils.json_dumps(s.as_dict) for s in spans]
+
+    def export(self, spans: List[Span]):
+        lines = self._lines(spans)
+        with self._lock, self.path.open("a", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+class OtlpJsonExporter(JsonlExporter):
+    """Appends finished trace to a file as an OTLP/JSON `ExportTraceServiceRequest` line (OTel file exporter format)"""
+
+    def __init__(self, filename: str = "log/traces.otlp.jsonl", service_name: str = "erepublik"):
+        super().__init__(filename)
+        self.service_name = service_name
+
+    def _lines(self, spans: List[Span]) -> List[str]:
+        resource = dict(attributes=[dict(key="service.name", value=dict(stringValue=self.service_name))])
+        scope_spans = [dict(scope=dict(name="erepublik"), spans=[s.as_otlp for s in spans])]
+        return [utils.json_dumps(dict(resourceSpans=[dict(resource=resource, scopeSpans=scope_spans)]))]
+
+
+class Tracer:
+    """Collects spans per trace and hands finished traces to exporters
+
+    Tracing is off until an exporter is added - `span()` then costs a single attribute check. Current span is kept in a
+    context variable, so spans opened in other threads start their own traces.
+    """
+
+    exporters: List[JsonlExporter]
+    max_spans: int = 10000
+
+    def __init__(self):
+        self.exporters = []
+        self._current: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("erepublik_span", default=None)
+        self._traces: Dict[str, List[Span]] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.exporters)
+
+    def add_exporter(self, exporter: JsonlExporter):
+        self.exporters.append(exporter)
+
+    def remove_exporter(self, exporter: JsonlExporter):
+        self.exporters.remove(exporter)
+
+    @property
+    def current_span(self) -> Optional[Span]:
+        return self._current.get()
+
+    def span(self, name: str, **attributes) -> "_SpanContext":
+        return _SpanContext(self, name, attributes)
+
+    def _start(self, name: str, attributes: Dict[str, Any]) -> Span:
+        new_span = Span(name, self._current.get(), attributes)
+        with self._lock:
+            spans = self._traces.setdefault(new_span.trace_id, [])
+            if len(spans) < self.max_spans:
+                spans.append(new_span)
+        return new_span
+
+    def _finish(self, finished: Span):
+        finished.end = time.time()
+        if finished.parent_id is not None:
+            return
+        with self._lock:
+            spans = self._traces.pop(finished.trace_id, [])
+        for exporter in list(self.exporters):
+            try:
+                exporter.export(spans)
+            except OSError:
+                pass
+
+
+class _SpanContext:
+    __slots__ = ["tracer", "name", "attributes", "span", "_token"]
+
+    def __init__(self, tracer: Tracer, name: str, attributes: Dict[str, Any]):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.span = None
+        self._token = None
+
+    def __enter__(self) -> Optional[Span]:
+        if self.tracer.enabled:
+            self.span = self.tracer._start(self.name, self.attributes)
+            self._token = self.tracer._current.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.span is not None:
+            if exc_type is not None:
+                self.span.error = f"{exc_type.__name__}: {exc_val}"
+            self.tracer._current.reset(self._token)
+            self.tracer._finish(self.span)
+
+
+#: Process wide tracer, enable by adding an exporter: `TRACER.add_exporter(JsonlExporter())`
+TRACER = Tracer()
+
+
+def span(name: str, **attributes) -> _SpanContext:
+    """Open span in the process wide tracer, yields None when tracing is disabled"""
+    return TRACER.span(name, **attributes)
+
+
+def traced(name: str = None) -> Callable:
+    """Decorator running the function in a span named after it"""
+
+    def decorator(func: Callable) -> Callable:
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not TRACER.enabled:
+                return func(*args, **kwargs)
+            with TRACER.span(span_name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
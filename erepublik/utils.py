@@ -30,6 +30,7 @@ __all__ = [
     "date_from_eday",
     "deprecation",
     "eday_from_date",
+    "from_fixed",
     "get_air_hit_dmg_value",
     "get_file",
     "get_final_hit_dmg",
@@ -49,10 +50,12 @@ __all__ = [
     "now",
     "silent_sleep",
     "slugify",
+    "to_fixed",
     "write_file",
 ]
 
 VERSION: str = __version__
+FIXED_POINT_SCALE: int = 100
 
 
 def now() -> datetime.datetime:
@@ -243,6 +246,18 @@ def get_final_hit_dmg(
     return Decimal(dmg)
 
 
+def to_fixed(value: Union[int, float, str, Decimal]) -> int:
+    """Convert value to scaled integer (hundredths of units)"""
+    return round(float(value) * FIXED_POINT_SCALE)
+
+
+def from_fixed(value: Union[int, Decimal]) -> Decimal:
+    """Convert scaled integer (hundredths of units) back to Decimal, Decimal values are returned as is"""
+    if isinstance(value, Decimal):
+        return value
+    return Decimal(value) / FIXED_POINT_SCALE
+
+
 def deprecation(message):
     warnings.warn(message, DeprecationWarning, stacklevel=2)
 
@@ -3,9 +3,42 @@
 
 """Tests for `erepublik` package."""
 
+import gzip
+import io
+import logging
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import urllib.request
+from datetime import timedelta
+from decimal import Decimal
+from pathlib import Path
+from logging.handlers import QueueListener
+from unittest import mock
 
-from erepublik import Citizen
+from requests import ConnectionError, Response
+
+from erepublik import Citizen, constants, events, fleet, tracing, utils
+from erepublik._logging import ErepublikErrorHTTTPHandler, ErepublikFormatter, ErepublikQueueHandler
+from erepublik.access_points import RateController, SlowRequests
+from erepublik.classes import (
+    Company,
+    ErepublikException,
+    Holding,
+    LockTimeoutError,
+    MyCompanies,
+    OfferItem,
+    StateDiffTracker,
+    TelegramReporter,
+)
+from erepublik.fleet import FleetSupervisor
+from erepublik.metrics import MetricsRegistry, endpoint_name, start_metrics_server
+from erepublik.profiler import SamplingProfiler
+from erepublik.scheduler import Scheduler
 
 
 class TestErepublik(unittest.TestCase):
@@ -26,6 +59,955 @@ class TestErepublik(unittest.TestCase):
         self.citizen.energy.energy = 1000
         self.assertFalse(self.citizen.should_do_levelup)
 
+    def test_market_price_stats(self):
+        stats = self.citizen.market_stats
+        for best in [1.10, 1.00, 0.90, 0.80]:
+            stats.add_offers(2, 5, 71, [OfferItem(best + 0.10, amount=300), OfferItem(best, amount=100)])
+        stats.add_offers(2, 5, 35, [OfferItem(0.50, amount=10)])
+
+        self.assertEqual(stats.best_offer(2, 5, 71).price, 0.80)
+        self.assertAlmostEqual(stats.percentile(2, 5, 71, 50), 0.95)
+        self.assertAlmostEqual(stats.vwap(2, 5, 71), 0.875)
+        self.assertAlmostEqual(stats.vwap(2, 5, 71, depth=1), 0.80)
+        self.assertAlmostEqual(stats.spread(2, 5, 71), 0.30)
+        self.assertIsNone(stats.percentile(2, 4, 71))
+        self.assertIsNone(stats.last_update(2, 4, 71))
+
+        # Empty market is scanned too, but doesn't add to price history
+        stats.add_offers(2, 4, 71, [])
+        self.assertIsNotNone(stats.last_update(2, 4, 71))
+        self.assertIsNone(stats.best_offer(2, 4, 71))
+        self.assertIsNone(stats.percentile(2, 4, 71))
+        stats.add_offers(2, 5, 35, [])
+        self.assertIsNone(stats.best_offer(2, 5, 35))
+        self.assertEqual(stats.global_min(2, 5), 0.80)
+        self.assertAlmostEqual(stats.percentile(2, 5, 35, 50), 0.50)
+
+        # Sell price doesn't rescan empty market
+        self.citizen.details.citizenship = constants.COUNTRIES[71]
+        with mock.patch.object(self.citizen, "_post_economy_marketplace") as marketplace:
+            marketplace.return_value.json.return_value = {"offers": []}
+            self.citizen._get_sell_price("Weapon", 3)
+            self.citizen._get_sell_price("Weapon", 3)
+            self.assertEqual(marketplace.call_count, 1)
+
+    def test_select_wam_companies(self):
+        my_companies = self.citizen.my_companies
+        holding = Holding(1, 1, self.citizen, "Test holding")
+        for _id in (1, 2):
+            holding.add_company(
+                Company(holding, _id, 1, True, Decimal(1), Decimal(0), Decimal(20), True, True, "", 12, False, 0)
+            )
+        for _id in (3, 4, 5):
+            holding.add_company(
+                Company(holding, _id, 1, False, Decimal(1), Decimal(1), Decimal(10), True, True, "", 2, False, 0)
+            )
+        inv_raw = {"weaponRaw": {0: {"amount": 5}}}
+        prices = {12: Decimal("0.2"), 2: Decimal(1)}
+
+        def unit_value(company):
+            return company.products_made * prices[company.industry]
+
+        selected = my_companies.select_wam_companies(holding.get_wam_companies(), 3, 10000, inv_raw, unit_value)
+        self.assertEqual(sorted(c.id for c in selected), [1, 3, 4])
+
+        selected = my_companies.select_wam_companies(holding.get_wam_companies(), 5, 1500, inv_raw, unit_value)
+        self.assertEqual(sorted(c.id for c in selected), [])
+
+        inv_raw = {"weaponRaw": {0: {"amount": 25}}}
+        selected = my_companies.select_wam_companies(holding.get_wam_companies(), 5, 1500, inv_raw, unit_value)
+        self.assertEqual(sorted(c.id for c in selected), [3, 4])
+
+        # Without prices every product is worth the same
+        selected = my_companies.select_wam_companies(holding.get_wam_companies(), 3, 10000, inv_raw)
+        self.assertEqual(sorted(c.id for c in selected), [1, 2, 3])
+
+        # Higher quality isn't worth more, if it makes less
+        food = Company(holding, 6, 1, False, Decimal(1), Decimal(1), Decimal(100), True, True, "", 1, False, 0)
+        weapon = Company(holding, 7, 2, False, Decimal(1), Decimal(1), Decimal(10), True, True, "", 2, False, 0)
+        inv_raw = {"foodRaw": {0: {"amount": 100}}, "weaponRaw": {0: {"amount": 100}}}
+        prices.update({1: Decimal(1), 2: Decimal(2)})
+        selected = my_companies.select_wam_companies([food, weapon], 1, 10000, inv_raw, unit_value)
+        self.assertEqual([c.id for c in selected], [6])
+        # Or if it takes less storage
+        selected = my_companies.select_wam_companies([food, weapon], 2, 100, inv_raw, unit_value)
+        self.assertEqual([c.id for c in selected], [6])
+        selected = my_companies.select_wam_companies([food, weapon], 2, 110, inv_raw, unit_value)
+        self.assertEqual([c.id for c in selected], [6, 7])
+
+    def test_company_aggregates(self):
+        my_companies = self.citizen.my_companies
+        my_companies.prepare_holdings({"1": dict(id=1, region_id=1, name="Test holding")})
+        company = dict(holding_company_id=1, quality=1, effective_bonus=100, base_production=10, wam_enabled=True)
+        my_companies.prepare_companies(
+            {
+                "1": dict(company, id=1, is_raw=True, industry_id=12, preset_works=2),
+                "2": dict(company, id=2, is_raw=False, industry_id=2, upgrades={"1": dict(raw_usage=1)}),
+            }
+        )
+        raw, factory = my_companies.get_company(1), my_companies.get_company(2)
+        self.assertEqual(my_companies.get_total_wam_count(), 2)
+        self.assertEqual(my_companies.get_needed_inventory_usage([raw, factory]), 1010)
+        self.assertEqual(my_companies.get_employable_factories(), {1: 2})
+        self.assertEqual([h.id for h in my_companies.get_wam_holdings()], [1, 0])
+
+        # Aggregates are cached until companies change
+        with mock.patch.object(MyCompanies, "companies", new_callable=mock.PropertyMock) as companies:
+            self.assertEqual(my_companies.get_total_wam_count(), 2)
+            self.assertEqual(my_companies.get_employable_factories(), {1: 2})
+            self.assertEqual(my_companies.get_needed_inventory_usage([raw, factory]), 1010)
+            companies.assert_not_called()
+        my_companies.get_employable_factories()[2] = 5
+        self.assertEqual(my_companies.get_employable_factories(), {1: 2})
+
+        self.citizen._inventory.raw = {"weaponRaw": {0: {"amount": 10.0}}}
+        response = {"status": True, "result": {"production": {"weapon": {"1": 10}}}}
+        self.assertTrue(self.citizen._apply_wam_response([factory], {}, response))
+        self.assertEqual(my_companies.get_total_wam_count(), 1)
+
+        with mock.patch.object(self.citizen, "_post_economy_assign_to_holding"):
+            self.citizen.assign_company_to_holding(raw, my_companies.holdings[0])
+        self.assertEqual([h.id for h in my_companies.get_wam_holdings()], [0, 1])
+        self.assertEqual(my_companies.holdings[0].companies, [raw])
+        self.assertEqual(my_companies.holdings[1].companies, [factory])
+
+        my_companies.prepare_companies({})
+        self.assertEqual(my_companies.get_total_wam_count(), 0)
+        self.assertEqual(my_companies.get_employable_factories(), {})
+
+    def test_fixed_point_companies(self):
+        my_companies = self.citizen.my_companies
+        holding = Holding(1, 1, self.citizen, "Test holding")
+        raw = Company(holding, 1, 1, True, 150, 0, 2000, True, True, "", 12, False, 0, fixed_point=True)
+        factory = Company(holding, 2, 1, False, 100, 100, 1000, True, True, "", 2, False, 0, fixed_point=True)
+        self.assertEqual(raw.products_made, Decimal(30))
+        self.assertEqual(factory.raw_usage, Decimal(-10))
+        self.assertEqual(my_companies.get_raw_usage_for_companies(raw, factory), (0, Decimal(20), 0, 0))
+        self.assertEqual(my_companies.get_needed_inventory_usage([raw, factory]), Decimal(3010))
+
+        selected = my_companies.select_wam_companies([raw, factory], 2, 1500, {"weaponRaw": {0: {"amount": 15}}})
+        self.assertEqual([c.id for c in selected], [2])
+
+    def test_plan_employees(self):
+        my_companies = self.citizen.my_companies
+        holding = Holding(1, 1, self.citizen, "Test holding")
+        raw = Company(holding, 1, 1, True, Decimal(1), Decimal(0), Decimal(20), True, True, "", 12, False, 3)
+        factory = Company(holding, 2, 1, False, Decimal(1), Decimal(1), Decimal(10), True, True, "", 2, False, 5)
+        my_companies._companies = {raw.id: raw, factory.id: factory}
+
+        plan = my_companies.plan_employees(6, {}, lambda c: 0 if c.is_raw else 1)
+        self.assertEqual(plan, {1: 3, 2: 3})
+        self.assertEqual(my_companies.pending_employees, {2: 2})
+
+        plan = my_companies.plan_employees(6, {}, reserved=[factory])
+        self.assertEqual(plan, {1: 3, 2: 3})
+        # Factory left with unplaced work units is employed first
+        plan = my_companies.plan_employees(2, {"weaponRaw": {0: {"amount": 30}}})
+        self.assertEqual(plan, {2: 2})
+        self.assertEqual(my_companies.pending_employees, {1: 3, 2: 3})
+        plan = my_companies.plan_employees(2, {"weaponRaw": {0: {"amount": 15}}})
+        self.assertEqual(plan, {1: 2})
+
+    def test_lock_manager(self):
+        locks = self.citizen.locks
+        with locks.write("travel", "inventory"):
+            with locks.write("travel"), locks.read("travel"):
+                pass
+            results = []
+
+            def other_thread():
+                try:
+                    with locks.read("travel", timeout=0.05):
+                        results.append(True)
+                except LockTimeoutError:
+                    results.append(False)
+
+            thread = threading.Thread(target=other_thread, name="other")
+            thread.start()
+            thread.join()
+            self.assertEqual(results, [False])
+            self.assertEqual(locks.as_dict["travel"]["holder"], threading.current_thread().name)
+
+        thread = threading.Thread(target=other_thread)
+        thread.start()
+        thread.join()
+        self.assertEqual(results, [False, True])
+        self.assertEqual(locks.as_dict["travel"]["timeouts"], 1)
+        self.assertFalse(locks.as_dict["inventory"]["locked"])
+
+    def test_buy_and_refresh_lock_order(self):
+        citizen = self.citizen
+        citizen._update_timeout = citizen._concurrency_timeout = 2
+        errors = []
+        citizen.report_error = errors.append
+
+        def buy(self, offer, amount=None):
+            time.sleep(0.1)
+            self._travel(offer.country)
+            return dict(error=False)
+
+        def fetch_inventory():
+            time.sleep(0.05)
+            return "inventory"
+
+        parts = dict(inventory=(fetch_inventory, lambda data: None))
+        threads = [
+            threading.Thread(target=citizen.buy_market_offer, args=(OfferItem(country=71),)),
+            threading.Thread(target=citizen.refresh),
+        ]
+        with mock.patch("erepublik.citizen.CitizenEconomy.buy_market_offer", buy), mock.patch(
+            "erepublik.citizen.CitizenTravel._travel", lambda *_: True
+        ), mock.patch.object(citizen, "_refresh_parts", return_value=parts):
+            start = time.monotonic()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(5)
+        self.assertFalse(any(thread.is_alive() for thread in threads))
+        self.assertEqual(errors, [])
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_wam_and_buy_lock_order(self):
+        citizen = self.citizen
+        citizen._update_timeout = citizen._concurrency_timeout = 2
+        errors = []
+        citizen.report_error = errors.append
+
+        def work_as_manager(self, holding):
+            time.sleep(0.1)
+            # Error response refreshes token and citizen info
+            self.update_citizen_info("<html>")
+
+        def buy(self, offer, amount=None):
+            time.sleep(0.05)
+            self.update_inventory()
+
+        threads = [
+            threading.Thread(target=citizen._work_as_manager, args=(None,)),
+            threading.Thread(target=citizen.buy_market_offer, args=(OfferItem(),)),
+        ]
+        with mock.patch("erepublik.citizen.CitizenCompanies._work_as_manager", work_as_manager), mock.patch(
+            "erepublik.citizen.CitizenEconomy.buy_market_offer", buy
+        ), mock.patch("erepublik.citizen._Citizen.update_citizen_info"), mock.patch(
+            "erepublik.citizen.BaseCitizen.update_inventory"
+        ):
+            start = time.monotonic()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(5)
+        self.assertEqual(errors, [])
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_time_till_energy(self):
+        energy = self.citizen.energy
+        energy.energy, energy.limit, energy.interval = 50, 1000, 30
+        self.assertEqual(energy.time_till_energy(40), timedelta(0))
+        self.assertAlmostEqual(energy.time_till_energy(100).total_seconds(), 12 * 60, delta=5)
+        # Recovery rate isn't known yet
+        energy.interval = 0
+        self.assertEqual(energy.time_till_energy(100), timedelta(minutes=6))
+
+    def test_scheduler(self):
+        scheduler = Scheduler()
+        done = []
+        later = utils.good_timedelta(utils.now(), timedelta(hours=1))
+
+        def task(name, next_time=None):
+            def _task():
+                done.append(name)
+                return next_time
+
+            return _task
+
+        scheduler.add("work", task("work"))
+        scheduler.add("ot", task("ot", later), later, after=["work"])
+        scheduler.add("train", task("train"), later)
+        scheduler.add("cancelled", task("cancelled"))
+        scheduler.cancel("cancelled")
+
+        self.assertEqual(scheduler.run_pending(), later)
+        self.assertEqual(done, ["work", "ot"])
+        self.assertEqual([t.name for t in scheduler.tasks], ["ot", "train"])
+
+        # Dependants aren't run after failed task
+        errors = []
+        scheduler = Scheduler(on_error=lambda t, e: errors.append((t.name, str(e))))
+
+        def failing():
+            raise ValueError("failed")
+
+        scheduler.add("work", failing)
+        scheduler.add("ot", task("ot", later), later, after=["work"])
+        scheduler.run_pending()
+        self.assertEqual(errors, [("work", "failed")])
+        self.assertEqual(scheduler.tasks[-1].name, "ot")
+        self.assertEqual(scheduler.tasks[-1].runs, 0)
+
+    def test_refresh(self):
+        applied = []
+        self.citizen._refresh_parts = lambda: dict(
+            inventory=(lambda: "inventory", applied.append),
+            money=(lambda: "money", applied.append),
+            companies=(lambda: "companies", applied.append),
+        )
+        self.citizen.refresh()
+        self.assertEqual(applied, ["inventory", "money", "companies"])
+
+        applied.clear()
+        self.citizen.refresh("companies", "inventory")
+        self.assertEqual(applied, ["inventory", "companies"])
+        self.assertRaises(ErepublikException, self.citizen.refresh, "unknown")
+
+    def test_monetary_market_page_cache(self):
+        response = mock.Mock()
+        response.json.return_value = dict(ecash=dict(value=10), gold=dict(value=1), buy_mode="")
+        with mock.patch.object(self.citizen, "_post_economy_exchange_retrieve", return_value=response) as retrieve:
+            self.citizen.r = response
+            self.citizen.update_money()
+            self.citizen.update_money()
+            self.assertEqual(retrieve.call_count, 1)
+            key, resp, data, fetched_at = self.citizen._last_exchange_page
+            self.citizen._last_exchange_page = (key, resp, data, fetched_at - timedelta(minutes=5))
+            self.citizen.update_money()
+            self.assertEqual(retrieve.call_count, 2)
+        self.assertEqual((self.citizen.details.cc, self.citizen.details.gold), (10, 1))
+
+    def test_buy_gold(self):
+        def offer_html(offer_id, price, amount):
+            return (
+                f"<a id='purchase_{offer_id}' data-i18n='Buy for' data-currency='GOLD' "
+                f"data-price='{price:.2f}' data-max='{amount:.2f}' trigger='purchase'>"
+            )
+
+        pages = [offer_html(1, 100, 2) + offer_html(2, 101, 3), offer_html(3, 102, 10), offer_html(4, 103, 10)]
+
+        def retrieve(_, page, currency):
+            response = mock.Mock()
+            response.json.return_value = dict(
+                ecash=dict(value=1000), gold=dict(value=0), buy_mode=pages[page] if page < len(pages) else ""
+            )
+            return response
+
+        purchase = mock.Mock()
+        purchase.json.return_value = dict(ecash=dict(value=1000), gold=dict(value=0), error=False)
+        with mock.patch.object(self.citizen, "_post_economy_exchange_retrieve", side_effect=retrieve) as pages_mock:
+            with mock.patch.object(self.citizen, "_post_economy_exchange_purchase", return_value=purchase) as buy:
+                self.assertEqual(self.citizen.buy_gold(7), 7)
+        # Third page isn't needed to cover the amount
+        self.assertEqual([c.args[1] for c in pages_mock.call_args_list], [0, 1])
+        self.assertEqual([c.args for c in buy.call_args_list], [(2, 62, 1), (3, 62, 2), (2, 62, 3)])
+
+    def test_refresh_citizen_part(self):
+        citizen_js = dict(citizen=dict(citizenId=123, name="Refreshed"), settings=dict(eDay=5000))
+        response = Response()
+        response.status_code = 200
+        response._content = f"<script>var erepublik = {utils.json_dumps(citizen_js)},\n</script>".encode()
+        response.url = self.citizen.url
+        self.citizen._req.last_time = self.citizen.now - timedelta(minutes=20)
+
+        def get_csrf_token():
+            self.citizen._req.last_time = self.citizen.now
+
+        with mock.patch.object(self.citizen, "get_csrf_token", side_effect=get_csrf_token) as csrf, mock.patch.object(
+            self.citizen._req, "get", return_value=response
+        ), mock.patch.object(self.citizen, "_fetch_inventory", side_effect=lambda: self.citizen.get(self.citizen.url)):
+            with mock.patch.object(
+                self.citizen, "update_citizen_info", wraps=self.citizen.update_citizen_info
+            ) as info, mock.patch.object(self.citizen, "_update_inventory_data"):
+                self.citizen.refresh("citizen", "inventory")
+        self.assertEqual(csrf.call_count, 1)
+        # Parsed once, from the citizen part's apply step
+        self.assertEqual(info.call_count, 1)
+        self.assertEqual(self.citizen.name, "Refreshed")
+
+    def test_state_diff_tracker(self):
+        tracker = StateDiffTracker(full_every=4)
+        state = {"raw": {"weaponRaw": {"0": {"amount": 5}}}, "used": 10, "offers": {}}
+        self.assertEqual(tracker.changes(state), dict(full=True, version=1, state=state))
+        self.assertIsNone(tracker.changes(state))
+
+        state = {"raw": {"weaponRaw": {"0": {"amount": 7}}}, "used": 12, "offers": {"a/b": 1}}
+        changes = tracker.changes(state)
+        self.assertFalse(changes["full"])
+        self.assertEqual(changes["base"], 1)
+        self.assertEqual(
+            changes["patch"],
+            [
+                dict(op="replace", path="/raw/weaponRaw/0/amount", value=7),
+                dict(op="replace", path="/used", value=12),
+                dict(op="add", path="/offers/a~1b", value=1),
+            ],
+        )
+        del state["offers"]
+        self.assertEqual(tracker.changes(state)["patch"], [dict(op="remove", path="/offers")])
+        # Resync counts calls without changes too
+        self.assertTrue(tracker.changes(state)["full"])
+        for _ in range(3):
+            self.assertIsNone(tracker.changes(state))
+        self.assertTrue(tracker.changes(state)["full"])
+
+    def test_fleet_sharding(self):
+        accounts = [dict(email=f"player{i}@email.com", password="") for i in range(5)]
+        supervisor = FleetSupervisor(accounts, workers=2)
+        self.assertEqual([len(shard) for shard in supervisor.shards], [3, 2])
+
+        self.citizen._req.throttle = supervisor.throttle
+        start = time.monotonic()
+        for _ in range(3):
+            self.citizen._req._slow_down_requests()
+        self.assertGreaterEqual(time.monotonic() - start, 2 * self.citizen._req.timeout.total_seconds())
+
+        throttle = fleet.SharedThrottle(min_interval=0.2)
+        start = time.monotonic()
+        for _ in range(3):
+            throttle.wait(0.01)
+        self.assertGreaterEqual(time.monotonic() - start, 0.4)
+
+    def test_fleet_restarts(self):
+        supervisor = FleetSupervisor([dict(email="player@email.com", password="")], healthy_time=60)
+        crashed, running = mock.Mock(), mock.Mock()
+        crashed.is_alive.return_value = False
+        running.is_alive.return_value = True
+        supervisor.stop_event = mock.Mock()
+        supervisor.stop_event.wait.side_effect = [False, True]
+        supervisor._processes = {0: crashed}
+        supervisor.supervise()
+        self.assertEqual(supervisor._restarts, {0: 1})
+
+        supervisor._processes = {0: running}
+        supervisor._started = {0: time.time() - 30}
+        supervisor.stop_event.wait.side_effect = [False, True]
+        supervisor.supervise()
+        self.assertEqual(supervisor._restarts, {0: 1})
+        supervisor._started = {0: time.time() - 60}
+        supervisor.stop_event.wait.side_effect = [False, True]
+        supervisor.supervise()
+        self.assertEqual(supervisor._restarts, {0: 0})
+
+    def test_fleet_worker_corrupted_snapshot(self):
+        stop_event = threading.Event()
+        stop_event.set()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            account = dict(email="corrupted@email.com", password="password")
+            with open(fleet._dump_filename(Path(tmp_dir), account), "wb") as f:
+                f.write(b"EREP" + bytes([Citizen._snapshot_version]) + b"not zlib")
+            throttle = fleet.SharedThrottle()
+            with mock.patch.object(Citizen, "login") as login, mock.patch.object(Citizen, "save_snapshot"):
+                with mock.patch.object(SlowRequests, "throttle", None):
+                    fleet._run_worker([account], throttle, stop_event, tmp_dir, 1, mock.Mock())
+                    self.assertIs(Citizen()._req.throttle, throttle)
+        self.assertTrue(login.called)
+
+    def test_rate_controller(self):
+        parent = RateController(interval=0.5)
+        rate = RateController(interval=0.5, step=0.1, parent=parent)
+        rate.success()
+        self.assertAlmostEqual(rate.interval, 0.49)
+        parent.interval = 0.3
+        rate.success()
+        self.assertAlmostEqual(rate.interval, 0.3)
+        rate.slow_down()
+        self.assertAlmostEqual(rate.interval, 0.6)
+        self.assertAlmostEqual(parent.interval, 0.58)
+        self.assertEqual((parent.successes, parent.slowdowns), (2, 1))
+        for _ in range(10):
+            rate.slow_down()
+        self.assertEqual(rate.interval, rate.max_interval)
+
+    def test_reporter_queue(self):
+        class FakeSession:
+            fail = True
+            posted = []
+
+            def post(self, url, json=None, **kwargs):
+                if self.fail:
+                    raise ConnectionError("Reporter is down")
+                response = Response()
+                response.status_code = 400 if json["log"]["action"] == "INVALID" else 200
+                if response.ok:
+                    self.posted.append(json["log"]["action"])
+                return response
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            reporter = self.citizen.reporter
+            reporter.queue_file = os.path.join(tmp_dir, "queue.sqlite")
+            reporter.max_queue = 2
+            reporter._req = FakeSession()
+            reporter._open_queue()
+            for action in ["FIRST", "SECOND", "THIRD"]:
+                reporter._enqueue(dict(log=dict(action=action)))
+            self.assertEqual(reporter.queue_size, 2)
+
+            self.assertFalse(reporter.flush())
+            reporter._req.fail = False
+            self.assertTrue(reporter.flush())
+            self.assertEqual(reporter._req.posted, ["SECOND", "THIRD"])
+            self.assertEqual(reporter.queue_size, 0)
+
+            for action in ["INVALID", "FOURTH"]:
+                reporter._enqueue(dict(log=dict(action=action)))
+            self.assertTrue(reporter.flush())
+            self.assertEqual(reporter._req.posted, ["SECOND", "THIRD", "FOURTH"])
+            self.assertEqual(reporter._db.execute("SELECT status FROM dead_letter").fetchall(), [(400,)])
+
+            reporter._enqueue(dict(log=dict(action="LAST")))
+            reporter._citizen = lambda: None
+            reporter._run_uploader()
+            self.assertEqual(reporter._req.posted[-1], "LAST")
+            reporter._db.close()
+
+    def test_telegram_batching(self):
+        telegram = self.citizen.telegram
+        self.assertEqual(telegram._split_message(["a" * 5, "b" * 3, "c" * 12], 10), ["aaaaa\n\nbbb", "c" * 10, "cc"])
+
+        sent = []
+        telegram._TelegramReporter__request = lambda method, json=None, **kwargs: sent.append(json["text"]) or True
+        telegram._TelegramReporter__send_batch(
+            [
+                ("message", "Started"),
+                ("full_energy", "Full energy (100hp/200hp +10hp/6min)"),
+                ("medal", "New award: *Hard worker*"),
+                ("full_energy", "Full energy (200hp/200hp +10hp/6min)"),
+                ("medal", "New award: *Hard worker*"),
+            ]
+        )
+        self.assertEqual(
+            sent,
+            ["Started\n\nFull energy (200hp/200hp +10hp/6min) (x2)\n\nNew award: *Hard worker* (x2)"],
+        )
+
+    def test_telegram_retry(self):
+        stop_event = threading.Event()
+        telegram = TelegramReporter(stop_event=stop_event)
+        telegram.batch_delay, telegram.min_interval = 0, 0.05
+        results, sent = [False, False], []
+
+        def request(method, json=None, **kwargs):
+            ok = results.pop(0) if results else True
+            if ok:
+                sent.append(json["text"])
+            return ok
+
+        telegram._TelegramReporter__request = request
+        telegram.send_message("Started")
+        telegram._TelegramReporter__start_sender()
+        deadline = time.monotonic() + 5
+        while not sent and time.monotonic() < deadline:
+            time.sleep(0.05)
+        stop_event.set()
+        telegram._thread.join(5)
+        self.assertEqual(sent, ["Started"])
+        self.assertEqual((telegram._failed, telegram.as_dict["retrying"]), (0, 0))
+
+    def test_error_handler_dedup(self):
+        handler = ErepublikErrorHTTTPHandler(self.citizen.reporter)
+
+        def make_record(exc_class):
+            try:
+                raise exc_class("Boom")
+            except exc_class:
+                return logging.LogRecord("test", logging.ERROR, __file__, 1, "Error", (), sys.exc_info())
+
+        self.assertEqual(handler._is_duplicate(make_record(ValueError)), (False, 0))
+        self.assertEqual(handler._is_duplicate(make_record(ValueError)), (True, 1))
+        self.assertEqual(handler._is_duplicate(make_record(KeyError)), (False, 0))
+        handler.dedup_window = 0
+        self.assertEqual(handler._is_duplicate(make_record(ValueError)), (False, 1))
+
+        handler.max_attachment_size = 4
+        name, (filename, content, mimetype) = handler._attachment("erepublik.log", "1234567890", keep_tail=True)
+        self.assertEqual((filename, gzip.decompress(content)), ("erepublik.log.gz", b"7890"))
+
+    def test_error_handler_upload_steps(self):
+        handler = ErepublikErrorHTTTPHandler(self.citizen.reporter)
+        with mock.patch.object(handler, "_get_instance_json", side_effect=AttributeError("gone")), mock.patch.object(
+            handler, "_get_log_tails", return_value=[]
+        ), mock.patch.object(handler, "_write_fallback") as fallback, mock.patch("requests.post") as post:
+            handler._upload(dict(msg="Error", files=[]))
+            self.assertTrue(post.called)
+            self.assertIn("instance.json", fallback.call_args[0][0])
+
+            post.side_effect = ConnectionError("Down")
+            handler._upload(dict(msg="Error", files=[]))
+            self.assertIn("Unable to upload error report 'Error'", fallback.call_args[0][0])
+
+    def test_queue_logging(self):
+        stream = io.StringIO()
+        stream_handler = logging.StreamHandler(stream)
+        stream_handler.setFormatter(ErepublikFormatter(datefmt="-"))
+        log_queue = queue.SimpleQueue()
+        listener = QueueListener(log_queue, stream_handler)
+        logger = logging.getLoggerClass()("queue_test")
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(ErepublikQueueHandler(log_queue))
+        listener.start()
+        try:
+            raise ValueError("Boom")
+        except ValueError:
+            logger.warning("Failed %s", "work", exc_info=True)
+        logger.info("Worked %d times", 2)
+        listener.stop()
+        output = stream.getvalue()
+        self.assertTrue(output.startswith("[-] WARNING: Failed work\nTraceback (most recent call last):\n"))
+        self.assertIn('raise ValueError("Boom")\nValueError: Boom\n', output)
+        self.assertTrue(output.endswith("ValueError: Boom\n[-] Worked 2 times\n"))
+
+    def test_metrics(self):
+        registry = MetricsRegistry(buckets=(0.1, 1))
+        self.assertEqual(
+            endpoint_name("https://www.erepublik.com/en/military/battle-console/123"), "/military/battle-console/:id"
+        )
+        registry.inc("requests_total", endpoint="/main", status="2xx")
+        registry.inc("requests_total", 2, endpoint="/main", status="2xx")
+        registry.observe("request_seconds", 0.5, endpoint="/main")
+        with registry.time("request_seconds", endpoint="/main"):
+            pass
+        self.assertEqual(registry.get("requests_total", status="2xx", endpoint="/main"), 3)
+        self.assertEqual(registry.get("request_seconds", endpoint="/main")["count"], 2)
+
+        server = start_metrics_server(port=0, registry=registry)
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{server.server_address[1]}/metrics") as response:
+                text = response.read().decode("utf-8")
+        finally:
+            server.shutdown()
+        self.assertIn('requests_total{endpoint="/main",status="2xx"} 3', text)
+        self.assertIn('request_seconds_bucket{endpoint="/main",le="0.1"} 1', text)
+        self.assertIn('request_seconds_bucket{endpoint="/main",le="1"} 2', text)
+        self.assertIn('request_seconds_count{endpoint="/main"} 2', text)
+
+    def test_tracing(self):
+        @tracing.traced()
+        def parse():
+            with tracing.span("inner", url="/main"):
+                pass
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            exporter = tracing.JsonlExporter(os.path.join(tmp_dir, "traces.jsonl"))
+            otlp_exporter = tracing.OtlpJsonExporter(os.path.join(tmp_dir, "traces.otlp.jsonl"))
+            with tracing.span("not_exported"):
+                parse()
+            tracing.TRACER.add_exporter(exporter)
+            tracing.TRACER.add_exporter(otlp_exporter)
+            try:
+                with tracing.span("work_as_manager") as root:
+                    parse()
+            finally:
+                tracing.TRACER.remove_exporter(exporter)
+                tracing.TRACER.remove_exporter(otlp_exporter)
+
+            with open(exporter.path) as f:
+                spans = {span["name"]: span for span in map(utils.json_loads, f)}
+            with open(otlp_exporter.path) as f:
+                otlp = [utils.json_loads(line) for line in f]
+        self.assertEqual(set(spans), {"work_as_manager", "parse", "inner"})
+        self.assertEqual({span["trace_id"] for span in spans.values()}, {root.trace_id})
+        self.assertEqual(spans["inner"]["parent_id"], spans["parse"]["span_id"])
+        self.assertEqual(spans["inner"]["attributes"], {"url": "/main"})
+        self.assertEqual(len(otlp[0]["resourceSpans"][0]["scopeSpans"][0]["spans"]), 3)
+
+    def test_sampling_profiler(self):
+        stop = threading.Event()
+
+        def busy_worker():
+            stop.wait()
+
+        worker = threading.Thread(target=busy_worker, name="busy")
+        worker.start()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            profiler = SamplingProfiler(output_dir=tmp_dir)
+            profiler.sample()
+            profiler.sample()
+            self.assertIn("busy;", profiler.collapsed())
+            self.assertTrue(profiler.snapshot().exists())
+            path = profiler.rotate()
+            stop.set()
+            worker.join()
+            with open(path) as f:
+                lines = [line for line in f if line.startswith("busy;")]
+        self.assertEqual(len(lines), 1)
+        self.assertIn("busy_worker (test_erepublik_script.py:", lines[0])
+        self.assertTrue(lines[0].endswith(" 2\n"))
+
+        # Ctrl+C isn't taken over where SIGUSR1 doesn't exist
+        with mock.patch("erepublik.profiler.signal", spec=["signal", "SIGINT"]) as signal_module:
+            self.assertRaises(ValueError, profiler.install_signal_handler)
+            signal_module.signal.assert_not_called()
+            profiler.install_signal_handler(signal_module.SIGINT)
+            signal_module.signal.assert_called_once()
+        self.assertEqual(profiler.collapsed(), "")
+
+    def test_action_journal_citizen_id(self):
+        citizen = Citizen(email="journal@example.com", password="password")
+        citizen._log_listener = mock.Mock()
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.chdir(tmp_dir)
+            try:
+                # Logger is initialised before resuming session, when citizen id isn't known yet
+                citizen._init_journal()
+                self.assertIsNone(citizen.journal)
+                citizen_js = dict(citizen=dict(citizenId=123, name="Journal"), settings=dict(eDay=5000))
+                citizen.update_citizen_info(f"<script>var erepublik = {utils.json_dumps(citizen_js)},\n</script>")
+                journal = citizen.journal
+                self.assertEqual(journal.path.name, "actions_123.jsonl")
+                citizen._init_journal()
+                self.assertIs(citizen.journal, journal)
+            finally:
+                os.chdir(cwd)
+                citizen._log_listener = None
+                citizen.stop_threads.set()
+
+    def test_action_journal(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            citizen = Citizen(email="journal@example.com", password="password")
+            citizen.config.telegram = False
+            citizen.reporter.allowed = True
+            reported, logged = [], []
+            citizen.reporter.report_action = lambda action, json_val=None, value=None: reported.append((action, value))
+            citizen.write_log = logged.append
+            citizen.journal = events.ActionJournal(os.path.join(tmp_dir, "actions.jsonl"), max_bytes=400)
+            citizen.events.subscribe(citizen.journal)
+
+            citizen._report_action("WORK", "Worked", kwargs=dict(status=True))
+            citizen._publish_action("LEVEL_UP", value="5", duration=timedelta(seconds=1))
+            citizen._report_action("TRAIN", "Trained")
+            self.assertEqual(logged, ["Worked", "Trained"])
+            # Stopping delivers queued events and drops exit hook
+            with mock.patch("erepublik.citizen.atexit.unregister") as unregister:
+                citizen.set_locks()
+            unregister.assert_called_once_with(citizen.events.flush)
+
+            self.assertEqual(reported, [("WORK", "Worked"), ("LEVEL_UP", "5"), ("TRAIN", "Trained")])
+            entries = list(citizen.journal.read())
+            self.assertEqual([entry["action"] for entry in entries], ["WORK", "LEVEL_UP", "TRAIN"])
+            self.assertTrue(os.path.exists(os.path.join(tmp_dir, "actions.jsonl.1")))
+            self.assertEqual(entries[0]["kwargs"], {"kwargs": {"status": True}})
+            self.assertEqual(entries[1]["duration"], 1.0)
+            self.assertEqual([entry["action"] for entry in citizen.journal.read(action="TRAIN")], ["TRAIN"])
+
+    def test_snapshot(self):
+        self.citizen.r = Response()
+        full = self.citizen.snapshot()
+        self.assertNotIn("response", full)
+        self.assertIn("health_info", full["_properties"])
+        self.assertIn("response", self.citizen.snapshot(include_response=True))
+
+        snapshot = self.citizen.snapshot(["energy.limit", "_properties.health_info", "name"])
+        self.assertEqual(
+            snapshot,
+            dict(
+                energy=dict(limit=self.citizen.energy.limit),
+                _properties=dict(health_info=self.citizen.health_info),
+                name=self.citizen.name,
+            ),
+        )
+        shallow = self.citizen.snapshot(["energy", "locks"], depth=1)
+        self.assertTrue(shallow["energy"].endswith(" keys>"))
+        self.assertTrue(shallow["locks"].endswith(" keys>"))
+        self.assertRaises(ErepublikException, self.citizen.snapshot, ["no_such_field"])
+        self.assertEqual(utils.json_loads(self.citizen.to_json(fields=["eday"])), dict(eday=self.citizen.eday))
+
+    def test_session_snapshot(self):
+        citizen = Citizen(email="snapshot@example.com", password="password")
+        citizen_js = dict(
+            citizen=dict(citizenId=123, name="Snapshot", energy=500, userLevel=30, dailyOrderDone=True),
+            settings=dict(eDay=5000),
+        )
+        html = f"<script>var new_date = '600';var erepublik = {utils.json_dumps(citizen_js)},\n</script>"
+        with mock.patch.object(Citizen, "_post_military_group_missions") as missions:
+            citizen.update_citizen_info(html)
+        self.assertTrue(missions.called)
+        citizen.token = "a" * 32
+        citizen.logged_in = True
+        citizen.details.gold = 12.5
+        citizen._last_full_update = citizen.now
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filename = os.path.join(tmp_dir, "snapshot.bin")
+            citizen.save_snapshot(filename)
+            self.assertEqual(os.listdir(tmp_dir), ["snapshot.bin"])
+            with mock.patch.object(Citizen, "_init_reporters"), mock.patch.object(Citizen, "init_logger"):
+                with mock.patch.object(Citizen, "_resume_session") as resume, mock.patch.object(
+                    Citizen, "_post_military_group_missions"
+                ) as missions:
+                    restored = Citizen.load_from_snapshot(filename)
+                self.assertFalse(resume.called or missions.called)
+
+            with open(filename, "r+b") as f:
+                f.seek(4)
+                f.write(bytes([99]))
+            self.assertRaises(ErepublikException, Citizen.load_from_snapshot, filename)
+
+        self.assertTrue(restored.restored_from_snapshot)
+        self.assertEqual((restored.name, restored.details.citizen_id, restored.eday), ("Snapshot", 123, 5000))
+        self.assertEqual((restored.energy.energy, restored.details.level), (500, 30))
+        self.assertEqual((restored.token, restored.details.gold), ("a" * 32, 12.5))
+        self.assertEqual(restored._last_full_update, citizen._last_full_update.replace(microsecond=0))
+        self.assertEqual(restored.energy._recovery_time, citizen.energy._recovery_time)
+
+    def test_plan_wam_route(self):
+        citizen = self.citizen
+        holdings = []
+        for _id, region, is_raw, industry, production in [
+            (1, 2, False, 2, 200),
+            (2, 3, False, 2, 200),
+            (3, 4, True, 12, 20),
+        ]:
+            holding = Holding(_id, region, citizen, f"Holding {_id}")
+            holding.add_company(
+                Company(
+                    holding,
+                    _id,
+                    1,
+                    is_raw,
+                    Decimal(1),
+                    Decimal(1),
+                    Decimal(production),
+                    True,
+                    True,
+                    "",
+                    industry,
+                    False,
+                    0,
+                )
+            )
+            holdings.append(holding)
+        citizen.details.current_region = 1
+        citizen._region_distances = {(1, 2): 100, (1, 3): 50, (2, 3): 30, (1, 4): 5, (2, 4): 10, (3, 4): 600}
+        citizen.energy.energy = 1000
+        citizen.energy.interval = 30
+        citizen._inventory.total = 1000
+        citizen._inventory.used = 750
+        citizen._last_inventory_update = citizen.now
+
+        with mock.patch.object(citizen, "get_travel_regions") as get_travel_regions:
+            # Raw company doesn't fit storage, after the closest holding there's no storage left for the other one
+            self.assertEqual(citizen.plan_wam_route(holdings), [holdings[1]])
+            citizen._inventory.used = 0
+            self.assertEqual(citizen.plan_wam_route(holdings), [holdings[1], holdings[0]])
+            citizen.energy.energy = 10
+            self.assertEqual(citizen.plan_wam_route(holdings), [holdings[1]])
+            get_travel_regions.assert_not_called()
+
+    def test_get_holding_distance(self):
+        citizen = self.citizen
+        citizen.details.current_region = 1
+        holding = Holding(1, 5, citizen, "Test holding")
+        regions = {"5": {"id": 5, "distanceInKm": 120}, "6": {"id": 6, "distanceInKm": 300}}
+        with mock.patch.object(citizen, "_post_main_travel_data") as travel_data:
+            travel_data.return_value.json.return_value = {"regions": regions}
+            self.assertEqual(citizen.get_holding_distance(holding), 120)
+            travel_data.assert_called_once_with(holdingId=1, battleId=0, countryId=0)
+            # Distances are cached in both directions
+            self.assertEqual(citizen.get_holding_distance(holding), 120)
+            self.assertEqual(citizen.get_cached_region_distance(6, 1), 300)
+            self.assertEqual(citizen.get_holding_distance(Holding(2, 1, citizen, "Local holding")), 0)
+            self.assertEqual(travel_data.call_count, 1)
+
+            self.assertIsNone(citizen.get_holding_distance(Holding(3, 7, citizen, "Unknown holding")))
+            self.assertEqual(travel_data.call_count, 2)
+
+    def test_sell_produced_products(self):
+        citizen = self.citizen
+        citizen.config.auto_sell = ["weapon", "weaponRaw", "food"]
+        citizen.details.citizenship = constants.COUNTRIES[71]
+        citizen._inventory.final = {"Weapon": {1: {"amount": 10}, 2: {"amount": 5}}, "Food": {1: {"amount": 100}}}
+        citizen._inventory.raw = {"weaponRaw": {0: {"amount": 20}}}
+        production = {
+            "weapon": {"1": 10, "2": 5},
+            "weaponRaw": 20,
+            "food": {"1": 30},
+            "house": {"1": 2},
+            "airplane": {},
+        }
+        offer = dict(priceWithTaxes=2.0, country_id=71, amount=100, id=1, citizen_id=2)
+        calls = []
+
+        def marketplace(country_id, industry, quality):
+            calls.append(("scan", industry, quality))
+            return mock.Mock(json=mock.Mock(return_value={"offers": [offer]}))
+
+        def post_market_offer(industry, quality, amount, price):
+            calls.append(("post", industry, quality, amount))
+
+        with mock.patch.object(
+            citizen, "work_as_manager_in_holding", return_value={"status": True, "result": {"production": production}}
+        ), mock.patch.object(
+            citizen, "get_inventory", return_value=citizen._inventory
+        ) as get_inventory, mock.patch.object(
+            citizen, "_post_economy_marketplace", side_effect=marketplace
+        ), mock.patch.object(
+            citizen, "post_market_offer", side_effect=post_market_offer
+        ):
+            citizen._wam(Holding(1, 1, citizen, "Test holding"))
+        get_inventory.assert_called_once_with(force=True)
+        # Every cell is scanned once, all offers are posted after scanning - one per industry and quality
+        self.assertEqual(
+            calls,
+            [
+                ("scan", 2, 1),
+                ("scan", 2, 2),
+                ("scan", 12, 1),
+                ("scan", 1, 1),
+                ("post", 2, 1, 10),
+                ("post", 2, 2, 5),
+                ("post", 12, 1, 20),
+                ("post", 1, 1, 30),
+            ],
+        )
+
+    def test_apply_wam_response(self):
+        holding = Holding(1, 1, self.citizen, "Test holding")
+        raw = Company(holding, 1, 1, True, Decimal(1), Decimal(0), Decimal(20), True, True, "", 12, False, 0)
+        factory = Company(holding, 2, 1, False, Decimal(1), Decimal(1), Decimal(10), True, True, "", 2, False, 0)
+        self.citizen._inventory.raw = {"weaponRaw": {0: {"amount": 5.0}}}
+        self.citizen._inventory.used = 100
+
+        response = {"status": True, "result": {"production": {"weaponRaw": 20}}}
+        self.assertFalse(self.citizen._apply_wam_response([raw, factory], {}, response))
+
+        self.citizen._inventory.raw = {"weaponRaw": {0: {"amount": 5.0}}}
+        self.citizen._inventory.used = 100
+        response = {"status": True, "result": {"production": {"weaponRaw": 20, "weapon": {"1": 10}}}}
+        self.assertTrue(self.citizen._apply_wam_response([raw, factory], {}, response))
+        self.assertEqual(self.citizen._inventory.raw["weaponRaw"][0]["amount"], 15)
+        self.assertEqual(self.citizen._inventory.final["Weapon"][1]["amount"], 10)
+        self.assertEqual(self.citizen._inventory.used, 120)
+        self.assertTrue(raw.already_worked and factory.already_worked)
+        # Snapshot doesn't restore pre-WAM pages as fresh state
+        self.citizen._snapshot_sources.update(inventory=({}, []), companies="")
+        self.citizen._last_inventory_update = self.citizen._last_companies_update = self.citizen.now
+        self.citizen._inventory.raw = {"weaponRaw": {0: {"amount": 5.0}}}
+        raw.already_worked = factory.already_worked = False
+        self.assertTrue(self.citizen._apply_wam_response([raw, factory], {}, response))
+        state = self.citizen._snapshot_state()
+        self.assertNotIn("inventory", state["sources"])
+        self.assertEqual(state["_last_inventory_update"], constants.min_datetime)
+        self.assertEqual(state["_last_companies_update"], constants.min_datetime)
+
+        # Aircraft raw is named airplaneRaw in work response, but aircraftRaw in inventory
+        arm = Company(holding, 3, 1, True, Decimal(1), Decimal(0), Decimal(20), True, True, "", 24, False, 0)
+        aircraft = Company(holding, 4, 1, False, Decimal(1), Decimal(5), Decimal(10), True, True, "", 23, False, 0)
+        self.citizen._inventory.raw = {"aircraftRaw": {0: {"amount": 10.0}}}
+        self.citizen._inventory.final = {}
+        self.citizen._inventory.used = 100
+        response = {"status": True, "result": {"production": {"airplaneRaw": 20, "airplane": {"1": 10}}}}
+        # Not enough raw, nothing is changed
+        self.assertFalse(self.citizen._apply_wam_response([arm, aircraft], {}, response))
+        self.assertEqual(self.citizen._inventory.raw, {"aircraftRaw": {0: {"amount": 10.0}}})
+        self.assertEqual(self.citizen._inventory.final, {})
+        self.assertEqual(self.citizen._inventory.used, 100)
+        self.assertFalse(arm.already_worked or aircraft.already_worked)
+
+        self.citizen._inventory.raw = {"aircraftRaw": {0: {"amount": 40.0}}}
+        self.assertTrue(self.citizen._apply_wam_response([arm, aircraft], {}, response))
+        self.assertEqual(self.citizen._inventory.raw["aircraftRaw"][0]["amount"], 10)
+        self.assertEqual(self.citizen._inventory.final["Aircraft"][1]["amount"], 10)
+        self.assertEqual(self.citizen._inventory.used, 80)
+        self.assertTrue(arm.already_worked and aircraft.already_worked)
+
     # def deprecated_test_should_travel_to_fight(self):
     #     self.citizen.config.always_travel = True
     #     self.assertTrue(self.citizen.should_travel_to_fight())